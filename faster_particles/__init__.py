@@ -1,11 +1,9 @@
-# Define Matplotlib backend
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+# Define Matplotlib backend, used whenever matplotlib gets imported
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
 
 #from toydata.toydata_generator import ToydataGenerator
 #from larcvdata.larcvdata_generator import LarcvGenerator
-from config import cfg
 
 __all__ = [
     'base_net',
@@ -184,9 +184,10 @@ class UResNet(BaseNet):
                              slim.fully_connected],
                             normalizer_fn=slim.batch_norm,
                             trainable=is_training):
-            _, _ = self.build_base_net(self.image_placeholder,
-                                         is_training=is_training,
-                                         reuse=reuse, scope=scope)
+            # F3 and F5 feature maps, can be shared with PPN
+            self.base_layers = self.build_base_net(self.image_placeholder,
+                                                   is_training=is_training,
+                                                   reuse=reuse, scope=scope)
             net = self.net
             with tf.variable_scope(scope, reuse=self.reuse):
                 # Decoding steps
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
-from faster_particles.config import cfg
+from faster_particles.config import PPNConfig
 
 def main():
-    cfg.parse_args()
+    PPNConfig().parse_args()
 
 if __name__ == '__main__':
     main()
@@ -1,11 +1,26 @@
 import argparse
+import importlib
 import os
+import sys
 import numpy as np
-import tensorflow as tf
 
+# Subcommands, as `module:function`. Modules are only imported when their
+# subcommand runs, so that `ppn --help` or a CSV-only job does not load
+# Tensorflow, matplotlib or the data backends it does not use.
+COMMANDS = {
+    'train': 'faster_particles.train_net:train',
+    'demo': 'faster_particles.demo_ppn:inference',
+    'export': 'faster_particles.export:export',
+    'server': 'faster_particles.server:serve',
+    'sweep': 'faster_particles.sweep:sweep',
+    'metrics': 'faster_particles.metrics.sink:rebuild',
+    'evaluate': 'faster_particles.evaluator:evaluate'
+}
 
-from demo_ppn import inference
-from train_net import train
+
+def load_function(name):
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
 
 
 os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
@@ -31,11 +46,25 @@ class PPNConfig(object):
     OUTPUT_DIR = "output"
     LOG_DIR = "log"
     DISPLAY_DIR = "display"
+    DISPLAY_WORKERS = 2  # processes rendering displays, 0 = synchronous
+    DISPLAY_QUEUE = 4  # displays rendered at a time before coalescing
+    DISPLAY_MAX_VOXELS = 20000  # 3D images with more voxels drawn as points
+    METRICS_STREAMING = False  # histograms instead of lists of metric values
+    METRICS_FLUSH = 0  # write metric values to disk every N events, 0 = at the end only
+    METRICS_RESUME = False  # extend the metric values written by a previous run
     MAX_STEPS = 100
     LEARNING_RATE = 0.001
     PROFILE = False
     PROFILE_TIMELINE = 'timeline.json'
+    PROFILE_EVERY = 100  # trace every Nth session run, 0 = never
+    PROFILE_START = None  # trace session runs in [START, STOP) as well
+    PROFILE_STOP = None
+    PROFILE_DIR = None  # defaults to LOG_DIR/profile
+    TIMING_INTERVAL = 100  # steps between writes of stage timings, 0 = never
     DETAIL_LOG = False
+    STREAMING = False  # inference one event at a time
+    TEST_EVERY = 10  # iterations between test steps in training, 0 = never
+    CHECKPOINT_EVERY = 1000  # steps between checkpoints in training
 
     # PPN
     R = 20
@@ -68,6 +97,7 @@ class PPNConfig(object):
     BASE_NUM_OUTPUTS = 16  # For UResNet
     NUM_STRIDES = 5  # spatial depth for UResNet
     SPARSE = False
+    SPARSE_BACKEND = 'scn'  # PyTorch sparse UResNet: 'scn' or 'torch'
 
     # Data configuration
     BATCH_SIZE = 1
@@ -77,6 +107,7 @@ class PPNConfig(object):
     DATA = "/data/dlprod_ppn_v08_p01/test.root"
     TEST_DATA = ""
     DATA_3D = False
+    DATA_WORKERS = 2  # DataLoader worker processes (PyTorch UResNet)
 
     # Track configuration
     MAX_TRACKS = 5
@@ -95,13 +126,31 @@ class PPNConfig(object):
     SHOWER_N_IMAGES = 2
     SHOWER_OUT_PNG = False
 
+    # Inference server
+    FROZEN_BASE = None  # Frozen graphs written by `ppn export`
+    FROZEN_PPN = None
+    SERVER_HOST = '127.0.0.1'
+    SERVER_PORT = 8000
+    MAX_BATCH_SIZE = 8
+    MAX_LATENCY = 0.01  # in seconds
+
+    # Checkpoint sweep
+    CHECKPOINT_DIR = None
+    CACHE_DIR = None  # defaults to DISPLAY_DIR/sweep_cache (evaluate_cache)
+    NUM_WORKERS = 4
+    INTRA_OP_THREADS = 1
+
+    # Checkpoints evaluation during training
+    EVALUATE_INTERVAL = 60  # seconds between checks for new checkpoints
+    EVALUATE_TIMEOUT = 3600  # stop after this long without new checkpoint
+
     # Environment variables
     GPU = '1'
 
     def __init__(self, **kwargs):
         # Set random seed for reproducibility
         np.random.seed(self.SEED)
-        tf.set_random_seed(self.SEED)
+        self.set_tf_seed()
 
         if kwargs:
             self.__dict__.update(kwargs)
@@ -126,17 +175,58 @@ class PPNConfig(object):
         self.train_parser.add_argument("-lppn2", "--lambda-ppn2", default=self.LAMBDA_PPN2, type=float, help="Lambda PPN2")
         self.train_parser.add_argument("-wl", "--weight-loss", default=self.WEIGHT_LOSS, action='store_true', help="Weight the loss (balance track and shower)")
         self.train_parser.add_argument("-f", "--freeze", default=self.FREEZE, action='store_true', help="Freeze the base net weights.")
+        self.train_parser.add_argument("-te", "--test-every", default=self.TEST_EVERY, type=int, help="Number of iterations between test steps, 0 to disable (see `ppn evaluate`).")
+        self.train_parser.add_argument("-ce", "--checkpoint-every", default=self.CHECKPOINT_EVERY, type=int, help="Number of steps between checkpoints.")
 
         self.demo_parser = subparsers.add_parser("demo", help="Run Pixel Proposal Network demo.")
+
+        self.export_parser = subparsers.add_parser("export", help="Freeze trained weights into an inference-only graph.")
+        self.export_parser.add_argument("-o", "--output-dir", action='store', type=str, required=True, help="Path to output directory.")
+        self.export_parser.add_argument("-c", "--num-classes", default=self.NUM_CLASSES, type=int, help="Number of classes (including background).")
+
+        self.server_parser = subparsers.add_parser("server", help="Serve frozen networks over HTTP with dynamic batching.")
+        self.server_parser.add_argument("-fb", "--frozen-base", type=str, help="Frozen graph of the base network.")
+        self.server_parser.add_argument("-fp", "--frozen-ppn", type=str, help="Frozen graph of PPN.")
+        self.server_parser.add_argument("-host", "--server-host", default=self.SERVER_HOST, type=str, help="Address to listen on.")
+        self.server_parser.add_argument("-port", "--server-port", default=self.SERVER_PORT, type=int, help="Port to listen on.")
+        self.server_parser.add_argument("-mbs", "--max-batch-size", default=self.MAX_BATCH_SIZE, type=int, help="Maximum number of events per batch.")
+        self.server_parser.add_argument("-ml", "--max-latency", default=self.MAX_LATENCY, type=float, help="Maximum time (in seconds) an event waits for its batch to fill.")
+
+        self.sweep_parser = subparsers.add_parser("sweep", help="Evaluate all checkpoints of a directory in parallel.")
+        self.sweep_parser.add_argument("-cd", "--checkpoint-dir", type=str, required=True, help="Directory of checkpoint files to evaluate.")
+        self.sweep_parser.add_argument("-cache", "--cache-dir", default=self.CACHE_DIR, type=str, help="Directory of decoded events cache.")
+        self.sweep_parser.add_argument("-nw", "--num-workers", default=self.NUM_WORKERS, type=int, help="Number of checkpoints evaluated concurrently.")
+        self.sweep_parser.add_argument("-it", "--intra-op-threads", default=self.INTRA_OP_THREADS, type=int, help="Number of Tensorflow intra-op threads per worker.")
+        self.evaluate_parser = subparsers.add_parser("evaluate", help="Evaluate new checkpoints of a training run as they are written.")
+        self.evaluate_parser.add_argument("-o", "--output-dir", action='store', type=str, required=True, help="Output directory of the training run.")
+        self.evaluate_parser.add_argument("-l", "--log-dir", action='store', type=str, required=True, help="Log directory of the training run.")
+        self.evaluate_parser.add_argument("-cache", "--cache-dir", default=self.CACHE_DIR, type=str, help="Directory of decoded events cache.")
+        self.evaluate_parser.add_argument("-ei", "--evaluate-interval", default=self.EVALUATE_INTERVAL, type=float, help="Seconds between checks for new checkpoints.")
+        self.evaluate_parser.add_argument("-eto", "--evaluate-timeout", default=self.EVALUATE_TIMEOUT, type=float, help="Stop after this many seconds without new checkpoint.")
+        self.evaluate_parser.add_argument("-it", "--intra-op-threads", default=self.INTRA_OP_THREADS, type=int, help="Number of Tensorflow intra-op threads.")
+
+        self.metrics_parser = subparsers.add_parser("metrics", help="Rebuild metrics plots and CSV files from the values written during a run.")
         # self.demo_full_parser = subparsers.add_parser("demo-full", help="Run Pixel Proposal Network combined with base UResNet demo.")
 
         self.common_arguments(self.train_parser)
         self.common_arguments(self.demo_parser)
+        self.common_arguments(self.export_parser)
+        self.common_arguments(self.server_parser)
+        self.common_arguments(self.sweep_parser)
+        self.common_arguments(self.metrics_parser)
+        self.common_arguments(self.evaluate_parser)
+        for parser in [self.train_parser, self.demo_parser, self.sweep_parser, self.metrics_parser, self.evaluate_parser]:
+            parser.add_argument("-d", "--display-dir", action='store', type=str, required=True, help="Path to display directory.")
         # self.common_arguments(self.demo_full_parser)
 
-        self.demo_parser.set_defaults(func=inference)
+        self.demo_parser.set_defaults(func=COMMANDS['demo'])
         # self.demo_full_parser.set_defaults(func=inference_full)
-        self.train_parser.set_defaults(func=train)
+        self.train_parser.set_defaults(func=COMMANDS['train'])
+        self.export_parser.set_defaults(func=COMMANDS['export'])
+        self.server_parser.set_defaults(func=COMMANDS['server'])
+        self.sweep_parser.set_defaults(func=COMMANDS['sweep'])
+        self.metrics_parser.set_defaults(func=COMMANDS['metrics'])
+        self.evaluate_parser.set_defaults(func=COMMANDS['evaluate'])
 
     def common_arguments(self, parser):
         parser.add_argument("-m", "--max-steps", default=self.MAX_STEPS, type=int, help="Maximum number of training iterations.")
@@ -167,7 +257,6 @@ class PPNConfig(object):
         parser.add_argument("-nimages", "--shower-n-images", default=self.SHOWER_N_IMAGES, type=int, help="")
         parser.add_argument("-png", "--shower-out-png", default=self.SHOWER_OUT_PNG, action='store_true')
         parser.add_argument("-ms", "--min-score", default=self.MIN_SCORE, type=float, help="Minimum score above which PPN predictions should be kept")
-        parser.add_argument("-d", "--display-dir", action='store', type=str, required=True, help="Path to display directory.")
         parser.add_argument("-ni", "--next-index", default=self.NEXT_INDEX, type=int, help="Index from which to start reading LArCV data file.")
         parser.add_argument("-ec", "--enable-crop", default=self.ENABLE_CROP, action='store_true', help="Crop original data to smaller windows.")
         parser.add_argument("-ss", "--slice-size", action='store', default=self.SLICE_SIZE, type=int, help="Width (and height) of cropped slice from image.")
@@ -185,7 +274,19 @@ class PPNConfig(object):
         parser.add_argument("-ppn2i", "--ppn2-index", action='store', default=self.PPN2_INDEX, type=int, help="Index of last feature map for PPN2.")
         parser.add_argument("-p", "--profile", action='store_true', default=self.PROFILE, help="Profile TF model.")
         parser.add_argument("-pn", "--profile-timeline", action='store', default=self.PROFILE_TIMELINE, type=str, help="Timeline name (profiling).")
+        parser.add_argument("-pe", "--profile-every", action='store', default=self.PROFILE_EVERY, type=int, help="Trace every Nth session run, 0 to disable (profiling).")
+        parser.add_argument("-ps", "--profile-start", action='store', default=self.PROFILE_START, type=int, help="First session run of the traced window (profiling).")
+        parser.add_argument("-pst", "--profile-stop", action='store', default=self.PROFILE_STOP, type=int, help="Session run ending the traced window (profiling).")
+        parser.add_argument("-pd", "--profile-dir", action='store', default=self.PROFILE_DIR, type=str, help="Directory of timelines and profiling summary (default LOG_DIR/profile).")
+        parser.add_argument("-ti", "--timing-interval", action='store', default=self.TIMING_INTERVAL, type=int, help="Number of steps between writes of stage timings (timing.jsonl), 0 to disable.")
+        parser.add_argument("-dw", "--display-workers", action='store', default=self.DISPLAY_WORKERS, type=int, help="Number of processes rendering displays, 0 to draw them synchronously.")
+        parser.add_argument("-dq", "--display-queue", action='store', default=self.DISPLAY_QUEUE, type=int, help="Max number of displays rendered at a time, further ones are coalesced.")
+        parser.add_argument("-dmv", "--display-max-voxels", action='store', default=self.DISPLAY_MAX_VOXELS, type=int, help="3D displays with more voxels are drawn as a point cloud instead of cubes.")
+        parser.add_argument("-stm", "--metrics-streaming", default=self.METRICS_STREAMING, action='store_true', help="Accumulate metrics in constant memory histograms instead of lists of values.")
+        parser.add_argument("-mf", "--metrics-flush", action='store', default=self.METRICS_FLUSH, type=int, help="Write metric values to DISPLAY_DIR/metrics every N events, 0 to disable.")
+        parser.add_argument("-mr", "--metrics-resume", default=self.METRICS_RESUME, action='store_true', help="Load and extend the metric values written by an interrupted run.")
         parser.add_argument("-dl", "--detail-log", default=self.DETAIL_LOG, action='store_true', help="Keep all training weights and save at least one every 30min.")
+        parser.add_argument("-st", "--streaming", default=self.STREAMING, action='store_true', help="Run inference one event at a time instead of retrieving all data first.")
         parser.add_argument("-sparse", "--sparse", default=self.SPARSE, action='store_true', help="Use sparse UResNet.")
 
     def parse_args(self):
@@ -201,7 +302,14 @@ class PPNConfig(object):
 
         os.environ['CUDA_VISIBLE_DEVICES'] = self.GPU
 
-        args.func(self)
+        func = load_function(args.func)
+        self.set_tf_seed()
+        func(self)
+
+    def set_tf_seed(self):
+        # Only seed Tensorflow if it is used (already imported)
+        if 'tensorflow' in sys.modules:
+            sys.modules['tensorflow'].set_random_seed(self.SEED)
 
     def update(self, args):
         for name in args:
@@ -209,4 +317,12 @@ class PPNConfig(object):
                 setattr(self, name.upper(), args[name])
 
 
-cfg = PPNConfig()
+class ConfigSnapshot(object):
+    """
+    Picklable copy of the (uppercase) configuration attributes, to be sent
+    to worker processes.
+    """
+    def __init__(self, cfg):
+        for name in dir(cfg):
+            if name.isupper():
+                setattr(self, name, getattr(cfg, name))
@@ -0,0 +1,33 @@
+# *-* encoding: utf-8 *-*
+# Custom Crop op (build crop_op.so with `make cpu` or `make gpu`)
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tensorflow as tf
+
+CROP_OP_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'crop_op.so')
+_crop_module = []
+
+
+def load_crop_op():
+    """
+    Returns the module of the compiled Crop op, or None if crop_op.so has
+    not been built (or cannot be loaded).
+    crop_module.crop(image, crop_centers, crop_size) with image of shape
+    (1, N, N, [N,] C) and integer crop_centers of shape (num_crops, dim)
+    returns crops of shape (num_crops, crop_size, crop_size, [crop_size,] C),
+    zero-padded outside of the image.
+    """
+    if not _crop_module:
+        module = None
+        if os.path.isfile(CROP_OP_LIBRARY):
+            try:
+                module = tf.load_op_library(CROP_OP_LIBRARY)
+            except tf.errors.NotFoundError as e:
+                print("WARNING Could not load %s: %s" % (CROP_OP_LIBRARY, e))
+        _crop_module.append(module)
+    return _crop_module[0]
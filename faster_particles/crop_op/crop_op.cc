@@ -1,23 +1,58 @@
+#define EIGEN_USE_THREADS
+
 #include "crop_op.h"
+#include "tensorflow/core/framework/shape_inference.h"
+#include <algorithm>
+#include <type_traits>
 
 using namespace tensorflow;
+using shape_inference::DimensionHandle;
+using shape_inference::InferenceContext;
+using shape_inference::ShapeHandle;
 
 // Register TF operation
+// image: (1, N, N, C) or (1, N, N, N, C)
+// crop_centers: (num_crops, dim) integer coordinates in the image
+// crops: (num_crops, crop_size, crop_size[, crop_size], C), zero outside
+// of the image.
 REGISTER_OP("Crop")
     .Attr("T: {float, int32} = DT_FLOAT")
-    .Input("image: float32")
+    .Input("image: T")
     .Input("crop_centers: int32")
     .Input("crop_size: int32")
-    .Output("crops: float32");
-    /*.SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
-      c->set_output(0, c->input(1));
+    .Output("crops: T")
+    .SetShapeFn([](InferenceContext* c) {
+      ShapeHandle image, crop_centers, crop_size;
+      TF_RETURN_IF_ERROR(c->WithRankAtLeast(c->input(0), 4, &image));
+      TF_RETURN_IF_ERROR(c->WithRankAtMost(image, 5, &image));
+      TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 2, &crop_centers));
+      TF_RETURN_IF_ERROR(c->WithRank(c->input(2), 0, &crop_size));
+      const int dim = c->Rank(image) - 2;
+      DimensionHandle unused;
+      TF_RETURN_IF_ERROR(c->WithValue(c->Dim(crop_centers, 1), dim, &unused));
+
+      // Crop size is only known if it is a constant
+      DimensionHandle size = c->UnknownDim();
+      const Tensor* crop_size_tensor = c->input_tensor(2);
+      if (crop_size_tensor != nullptr) {
+        size = c->MakeDim(crop_size_tensor->scalar<int32>()());
+      }
+      std::vector<DimensionHandle> dims;
+      dims.push_back(c->Dim(crop_centers, 0));
+      for (int d = 0; d < dim; ++d) dims.push_back(size);
+      dims.push_back(c->Dim(image, dim + 1));
+      c->set_output(0, c->MakeShape(dims));
       return Status::OK();
-    });*/
+    });
 
 using CPUDevice = Eigen::ThreadPoolDevice;
 using GPUDevice = Eigen::GpuDevice;
 
 // CPU specialization of actual computation.
+// A crop is made of crop_size^(dim-1) rows of crop_size * channels
+// contiguous values (last spatial axis and channels). Rows of all crops
+// are sharded over the Eigen threadpool, each row is copied from the
+// image with std::copy and zero-filled where it falls outside.
 template <typename T>
 struct CropFunctor<CPUDevice, T> {
   void operator()(
@@ -28,9 +63,59 @@ struct CropFunctor<CPUDevice, T> {
     int image_size,
     int channels,
     int num_crops,
+    int dim,
     T* crops_ptr
   ) {
+    int64 rows_per_crop = 1;
+    for (int k = 0; k < dim - 1; ++k) rows_per_crop *= crop_size;
+    const int64 row_length = static_cast<int64>(crop_size) * channels;
+    const int half = crop_size / 2;
+
+    auto work = [&](int64 start, int64 end) {
+      for (int64 row = start; row < end; ++row) {
+        const int64 crop_id = row / rows_per_crop;
+        const int* center = crop_centers_ptr + crop_id * dim;
+        T* out = crops_ptr + row * row_length;
 
+        // Image offset of the row along the first dim-1 spatial axes
+        int64 r = row % rows_per_crop;
+        int64 image_offset = 0;
+        int64 stride = 1;
+        bool inside = true;
+        for (int k = dim - 2; k >= 0; --k) {
+          const int image_coord = center[k] - half + static_cast<int>(r % crop_size);
+          r /= crop_size;
+          if (image_coord < 0 || image_coord >= image_size) {
+            inside = false;
+            break;
+          }
+          image_offset += image_coord * stride;
+          stride *= image_size;
+        }
+        if (!inside) {
+          std::fill(out, out + row_length, T(0));
+          continue;
+        }
+
+        // Valid range along the last spatial axis
+        const int z0 = center[dim - 1] - half;
+        const int begin = std::max(0, -z0);
+        const int finish = std::min(crop_size, image_size - z0);
+        if (begin >= finish) {
+          std::fill(out, out + row_length, T(0));
+          continue;
+        }
+        std::fill(out, out + begin * channels, T(0));
+        const T* in = image_ptr + (image_offset * image_size + z0 + begin) * channels;
+        std::copy(in, in + static_cast<int64>(finish - begin) * channels,
+                  out + begin * channels);
+        std::fill(out + finish * channels, out + row_length, T(0));
+      }
+    };
+    const double row_bytes = static_cast<double>(row_length * sizeof(T));
+    d.parallelFor(num_crops * rows_per_crop,
+                  Eigen::TensorOpCost(row_bytes, row_bytes, row_length),
+                  work);
   }
 };
 
@@ -46,44 +131,42 @@ class CropOp : public OpKernel {
     const Tensor& image = context->input(0);
     const Tensor& crop_centers = context->input(1);
     const Tensor& crop_size_tensor = context->input(2);
-    // FIXME
     OP_REQUIRES(context, TensorShapeUtils::IsScalar(crop_size_tensor.shape()), errors::InvalidArgument("crop_size must be scalar, has shape ", crop_size_tensor.shape().DebugString()));
-    //const int crop_size = crop_size_tensor.scalar<int32>()();
-    const int crop_size = 64;
+    const int crop_size = crop_size_tensor.scalar<int32>()();
+    OP_REQUIRES(context, crop_size > 0, errors::InvalidArgument("crop_size must be positive, got ", crop_size));
 
     // Basic shape checks on input image and crop centers
-    // OP_REQUIRES(context, image.dims() == 4, errors::InvalidArgument("Input image must be 4-D", image.shape().DebugString()));
-    // //OP_REQUIRES(context, image.dim_size(0) == image.dim_size(1) == image.dim_size(2), errors::InvalidArgument("Expected square input tensor."));
-    // OP_REQUIRES(context, crop_centers.dims() == 2, errors::InvalidArgument("Expected shape of size 2 for crop centers."));
-    // OP_REQUIRES(context, crop_size <= image.dim_size(0), errors::InvalidArgument("Crops size must be less or equal than image size."));
-    // OP_REQUIRES(context, crop_centers.dim_size(1) == image.dims() - 1, errors::InvalidArgument("Crop centers dimensions must match image dimensions."));
+    OP_REQUIRES(context, image.dims() == 4 || image.dims() == 5, errors::InvalidArgument("Input image must be 4-D or 5-D, has shape ", image.shape().DebugString()));
+    OP_REQUIRES(context, image.dim_size(0) == 1, errors::InvalidArgument("Expected a batch size of 1, got ", image.dim_size(0)));
+    const int dim = image.dims() - 2;
+    for (int d = 2; d <= dim; ++d) {
+      OP_REQUIRES(context, image.dim_size(d) == image.dim_size(1), errors::InvalidArgument("Expected square input image, has shape ", image.shape().DebugString()));
+    }
+    OP_REQUIRES(context, crop_centers.dims() == 2 && crop_centers.dim_size(1) == dim, errors::InvalidArgument("Expected crop centers of shape (num_crops, ", dim, "), got ", crop_centers.shape().DebugString()));
+    OP_REQUIRES(context, image.NumElements() <= tensorflow::kint32max, errors::InvalidArgument("Too many elements in input tensor"));
 
     // Get shapes of input tensors
-    const TensorShape& image_shape = image.shape();
-    const TensorShape& crop_centers_shape = crop_centers.shape();
-    int image_size = image_shape.dim_size(1);
-    int channels = image_shape.dim_size(3);
-    int num_crops = crop_centers_shape.dim_size(0);
-    int dim = crop_centers_shape.dim_size(1);
+    int image_size = image.dim_size(1);
+    int channels = image.dim_size(dim + 1);
+    int num_crops = crop_centers.dim_size(0);
 
     // Create an output tensor
     Tensor* crops = NULL;
     // create output shape
     TensorShape crops_shape;
     crops_shape.AddDim(num_crops);
-    crops_shape.AddDim(crop_size);
-    crops_shape.AddDim(crop_size);
-    crops_shape.AddDim(crop_size);
+    for (int d = 0; d < dim; ++d) {
+      crops_shape.AddDim(crop_size);
+    }
     crops_shape.AddDim(channels);
     OP_REQUIRES_OK(context, context->allocate_output(0, crops_shape,
                                                      &crops));
+    if (num_crops == 0) return;
+#if GOOGLE_CUDA
+    OP_REQUIRES(context, dim == 3 || !std::is_same<Device, GPUDevice>::value, errors::Unimplemented("GPU Crop kernel is only implemented in 3D."));
+#endif
 
     // Do the computation.
-    // OP_REQUIRES(context, image.NumElements() <= tensorflow::kint32max,
-    //             errors::InvalidArgument("Too many elements in input tensor"));
-    // OP_REQUIRES(context, crop_centers.NumElements() <= tensorflow::kint32max,
-    //             errors::InvalidArgument("Too many elements in crop centers tensor"));
-
     CropFunctor<Device, T>()(
         context->eigen_device<Device>(),
         image.flat<T>().data(),
@@ -92,6 +175,7 @@ class CropOp : public OpKernel {
         image_size,
         channels,
         num_crops,
+        dim,
         crops->flat<T>().data()
       );
 
@@ -115,6 +199,7 @@ REGISTER_CPU(int32);
   REGISTER_KERNEL_BUILDER( \
       Name("Crop")      \
       .Device(DEVICE_GPU)   \
+      .HostMemory("crop_size") \
       .TypeConstraint<T>("T"),  \
     CropOp<GPUDevice, T>);
 REGISTER_GPU(float);
@@ -16,6 +16,7 @@ struct CropFunctor {
     int image_size,
     int channels,
     int num_crops,
+    int dim,
     T* crops_ptr
   );
 };
@@ -32,6 +33,7 @@ struct CropFunctor<Eigen::GpuDevice, T> {
     int image_size,
     int channels,
     int num_crops,
+    int dim,
     T* crops_ptr
   );
 };
@@ -107,9 +107,10 @@ void CropFunctor<GPUDevice, T>::operator()(
     int image_size,
     int channels,
     int num_crops,
+    int dim,
     T* crops_ptr
   ) {
-  // Launch the cuda kernel.
+  // Launch the cuda kernel (3D only).
   //
   // See core/util/cuda_kernel_helper.h for example of computing
   // block count and thread_per_block count.
@@ -5,12 +5,13 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np
 from faster_particles.ppn_utils import crop as crop_numpy
+from faster_particles.crop_op import load_crop_op
 import time
 
 
 class CropTest(tf.test.TestCase):
     def testCrop(self):
-        crop_module = tf.load_op_library('./faster_particles/crop_op/crop_op.so')
+        crop_module = load_crop_op()
 
         np.random.seed(123)
         tf.set_random_seed(123)
@@ -45,6 +46,34 @@ class CropTest(tf.test.TestCase):
             # print(tf_result, np_result)
             self.assertAllClose(tf_result, np_result)
 
+    def crop_reference(self, image, crop_centers, crop_size):
+        # Zero-pad the image so that every crop is inside
+        dim = crop_centers.shape[1]
+        padded = np.pad(image[0], [(2 * crop_size, 2 * crop_size)] * dim + [(0, 0)],
+                        'constant')
+        starts = crop_centers - crop_size // 2 + 2 * crop_size
+        return np.stack([padded[tuple(slice(s, s + crop_size) for s in start)]
+                         for start in starts])
+
+    def testCropBorders(self):
+        crop_module = load_crop_op()
+        np.random.seed(123)
+        N, CROP_SIZE = 32, 8
+        for dim in [2, 3]:
+            image_np = np.random.rand(*((1,) + (N,) * dim + (2,))).astype(np.float32)
+            # Include crops partially and fully outside of the image
+            crop_centers_np = np.random.randint(-CROP_SIZE, high=N + CROP_SIZE,
+                                                size=(50, dim)).astype(np.int32)
+            crops = crop_module.crop(tf.constant(image_np),
+                                     tf.constant(crop_centers_np),
+                                     CROP_SIZE)
+            self.assertEqual(crops.get_shape().as_list(),
+                             [50] + [CROP_SIZE] * dim + [2])
+            with self.test_session():
+                tf_result = crops.eval()
+            self.assertAllClose(tf_result, self.crop_reference(
+                image_np, crop_centers_np, CROP_SIZE))
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -1,5 +1,6 @@
 from octree import Octree
 from probabilistic import Probabilistic
+from batching import PatchBatcher
 
 cropping_algorithms = {
     "proba": Probabilistic,
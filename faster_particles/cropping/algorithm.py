@@ -1,7 +1,7 @@
 import numpy as np
-from sklearn.cluster import DBSCAN
 from faster_particles.ppn_utils import crop as crop_util
 from faster_particles.display_utils import extract_voxels
+from faster_particles.profiler.stages import timer
 
 
 class CroppingAlgorithm(object):
@@ -27,11 +27,17 @@ class CroppingAlgorithm(object):
 
     def process(self, original_blob):
         # FIXME cfg.SLICE_SIZE vs patch_size
-        patch_centers, patch_sizes = self.crop(original_blob['voxels'])
-        return self.extract(patch_centers, patch_sizes, original_blob)
+        with timer.stage('crop_planning'):
+            patch_centers, patch_sizes = self.crop(original_blob['voxels'])
+        with timer.stage('patch_extraction'):
+            return self.extract(patch_centers, patch_sizes, original_blob)
 
     def extract(self, patch_centers, patch_sizes, original_blob):
-        batch_blobs = []
+        """
+        Returns the patches blobs together with the centers and sizes of
+        the patches which were kept.
+        """
+        batch_blobs, kept = [], []
         for i in range(len(patch_centers)):
             patch_center, patch_size = patch_centers[i], patch_sizes[i]
             blob = {}
@@ -95,7 +101,8 @@ class CroppingAlgorithm(object):
             # Make sure there is at least one ground truth pixel in the patch (for training)
             if self.cfg.NET not in ['ppn', 'ppn_ext', 'full'] or len(blob['gt_pixels']) > 0:
                 batch_blobs.append(blob)
-        return batch_blobs, patch_centers, patch_sizes
+                kept.append(i)
+        return batch_blobs, patch_centers[kept], patch_sizes[kept]
 
     def compute_overlap(self, coords, patch_centers, sizes=None):
         """
@@ -128,6 +135,7 @@ class CroppingAlgorithm(object):
         coords = np.concatenate([border_idx, padded_idx], axis=0)
         artificial_gt_pixels = []
         if coords.shape[0]:
+            from sklearn.cluster import DBSCAN
             db = DBSCAN(eps=10, min_samples=3).fit_predict(coords)
             for v in np.unique(db):
                 cluster = coords[db == v]
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class PatchBatcher(object):
+    """
+    Pack patches from one or more events into batches of batch_size.
+    Each patch is tracked by a slot (event, patch) so that results can be
+    split back per event and patch. When there are not enough patches left
+    to fill the last batch, it is run at its true size: padding it with
+    empty patches would change the batch normalization statistics applied
+    to the real ones.
+    """
+    # PPN results are not batched (batch size of 1)
+    UNBATCHED_RESULTS = ['im_proposals', 'im_scores', 'im_labels', 'rois']
+    IGNORED_RESULTS = ['dim1', 'dim2']
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, event, blobs):
+        """
+        Queue the patches `blobs` of event `event`.
+        """
+        for patch, blob in enumerate(blobs):
+            self.pending.append((event, patch, blob))
+
+    def batches(self, flush=True):
+        """
+        Yield (batch blob, slots) for all full batches, and for the (smaller)
+        remainder if flush is True. slots[j] = (event, patch) of the j-th
+        patch in the batch.
+        """
+        while len(self.pending) >= self.batch_size or (flush and self.pending):
+            items = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            yield self.pack([b for _, _, b in items]), \
+                [(event, patch) for event, patch, _ in items]
+
+    def pack(self, blobs):
+        """
+        Concatenate blobs along the first axis of each key.
+        """
+        if len(blobs) == 1:
+            return dict(blobs[0])
+        return dict((key, np.concatenate([b[key] for b in blobs]))
+                    for key in blobs[0])
+
+    @classmethod
+    def split(cls, result, slots, keepdims=False):
+        """
+        Split the results of a batch per slot.
+        Returns a list of (event, patch, result).
+        If keepdims is True, batched results keep a batch axis of size 1.
+        """
+        split_results = []
+        for j, (event, patch) in enumerate(slots):
+            r = {}
+            for key in result:
+                if key in cls.UNBATCHED_RESULTS:
+                    r[key] = result[key]
+                elif key in cls.IGNORED_RESULTS:
+                    pass
+                elif keepdims:
+                    r[key] = result[key][j:j+1]
+                else:
+                    r[key] = result[key][j]
+            split_results.append((event, patch, r))
+        return split_results
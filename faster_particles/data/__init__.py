@@ -1,4 +1,37 @@
-from hdf5data import HDF5Generator
-from larcvdata import LarcvGenerator
-from toydata import ToydataGenerator
-from csvdata import CSVGenerator
+# Data generators are imported on first access, so that a job only loads
+# the backend it uses (ROOT/larcv, PyTables, pandas...).
+import importlib
+import sys
+
+_generators = {
+    'HDF5Generator': 'faster_particles.data.hdf5data.hdf5data_generator',
+    'LarcvGenerator': 'faster_particles.data.larcvdata.larcvdata_generator',
+    'ToydataGenerator': 'faster_particles.data.toydata.toydata_generator',
+    'CSVGenerator': 'faster_particles.data.csvdata.csvdata_generator'
+}
+
+
+def load_generator(name):
+    """
+    Import and return the data generator class `name`, e.g. 'HDF5Generator'.
+    """
+    if name not in _generators:
+        raise Exception("Unknown data generator %s, choose among %s."
+                        % (name, ', '.join(sorted(_generators))))
+    return getattr(importlib.import_module(_generators[name]), name)
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # Module attribute lookup fallback (PEP 562)
+        if name in _generators:
+            return load_generator(name)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    # No module __getattr__: import the generators whose backend is
+    # installed.
+    for _name in _generators:
+        try:
+            globals()[_name] = load_generator(_name)
+        except ImportError:
+            pass
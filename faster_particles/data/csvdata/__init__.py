@@ -1,3 +1,3 @@
-from csvdata_generator import CSVGenerator
+from faster_particles.data.csvdata.csvdata_generator import CSVGenerator
 
 __all__ = ['csvdata_generator']
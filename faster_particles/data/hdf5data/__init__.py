@@ -1,3 +1,3 @@
-from hdf5data_generator import HDF5Generator
+from faster_particles.data.hdf5data.hdf5data_generator import HDF5Generator
 
 __all__ = ['hdf5data_generator']
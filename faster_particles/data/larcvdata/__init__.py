@@ -1,3 +1,3 @@
-from larcvdata_generator import LarcvGenerator
+from faster_particles.data.larcvdata.larcvdata_generator import LarcvGenerator
 
 __all__ = ['larcvdata_generator']
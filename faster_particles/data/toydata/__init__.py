@@ -1,3 +1,3 @@
-from toydata_generator import ToydataGenerator
+from faster_particles.data.toydata.toydata_generator import ToydataGenerator
 
 __all__ = ['shower_generator', 'track_generator', 'toydata_generator']
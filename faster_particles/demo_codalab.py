@@ -6,13 +6,123 @@ import numpy as np
 import tensorflow as tf
 import os
 import time
+import threading
 import tables
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 from faster_particles.display_utils import display_uresnet
 from faster_particles.base_net import basenets
 from faster_particles.metrics import UResNetMetrics
 from faster_particles.demo_ppn import get_data, load_weights
 
+FILTERS = tables.Filters(complevel=5, complib='zlib', shuffle=True,
+                         bitshuffle=False, fletcher32=False,
+                         least_significant_digit=None)
+
+
+class SparseSubmissionWriter(object):
+    """
+    Write predictions at the nonzero voxels of each event: coordinates
+    (uint16), labels (uint8) and optionally softmax scores (float16), all
+    events concatenated in chunked and compressed EArrays. Event i spans
+    rows offsets[i]:offsets[i+1]. Events are appended by a writer thread so
+    that compression does not block inference.
+    """
+    def __init__(self, filename, dim=3, num_classes=3, softmax=False,
+                 expected_voxels=None, max_queue=16):
+        self.file = tables.open_file(filename, 'w', filters=FILTERS)
+        self.coords = self.file.create_earray('/', 'coords',
+                                              tables.UInt16Atom(), (0, dim),
+                                              expectedrows=expected_voxels)
+        self.labels = self.file.create_earray('/', 'labels',
+                                              tables.UInt8Atom(), (0,),
+                                              expectedrows=expected_voxels)
+        self.softmax = None
+        if softmax:
+            self.softmax = self.file.create_earray('/', 'softmax',
+                                                   tables.Float16Atom(),
+                                                   (0, num_classes),
+                                                   expectedrows=expected_voxels)
+        self.offsets = self.file.create_earray('/', 'offsets',
+                                               tables.Int64Atom(), (0,))
+        self.offsets.append(np.zeros((1,), dtype=np.int64))
+        self.num_voxels = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, coords, labels, softmax=None):
+        """
+        coords: (N, dim) voxel indices, labels: (N,) predicted labels,
+        softmax: (N, num_classes) scores if the writer stores them.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((np.asarray(coords, dtype=np.uint16),
+                        np.asarray(labels, dtype=np.uint8),
+                        None if softmax is None or self.softmax is None
+                        else np.asarray(softmax, dtype=np.float16)))
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            coords, labels, softmax = item
+            try:
+                self.coords.append(coords)
+                self.labels.append(labels)
+                if self.softmax is not None:
+                    self.softmax.append(softmax)
+                self.num_voxels += coords.shape[0]
+                self.offsets.append(np.array([self.num_voxels], dtype=np.int64))
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def read_event(f, i):
+    """
+    Returns coords, labels (and softmax or None) of event i from an open
+    sparse submission file.
+    """
+    start, end = f.root.offsets[i], f.root.offsets[i+1]
+    softmax = f.root.softmax[start:end] if '/softmax' in f else None
+    return f.root.coords[start:end], f.root.labels[start:end], softmax
+
+
+def sparse_to_dense(filename, output, N=192):
+    """
+    Convert a sparse submission file to the dense layout: one
+    (N, N, N) UInt32 array of labels per event in the EArray /pred, zero
+    outside of the nonzero voxels.
+    """
+    with tables.open_file(filename, 'r') as f:
+        num_events = f.root.offsets.shape[0] - 1
+        with tables.open_file(output, 'w', filters=FILTERS) as f_dense:
+            preds_array = f_dense.create_earray('/', 'pred',
+                                                tables.UInt32Atom(),
+                                                (0, N, N, N),
+                                                expectedrows=num_events)
+            for i in range(num_events):
+                coords, labels, _ = read_event(f, i)
+                preds = np.zeros((1, N, N, N), dtype=np.uint32)
+                preds[(0,) + tuple(coords.T.astype(np.int64))] = labels
+                preds_array.append(preds)
+
 
 def inference(cfg, is_testing=False):
     """
@@ -35,14 +145,9 @@ def inference(cfg, is_testing=False):
     duration = 0
 
     metrics = UResNetMetrics(cfg)
-    FILTERS = tables.Filters(complevel=5, complib='zlib', shuffle=True,
-                             bitshuffle=False, fletcher32=False,
-                             least_significant_digit=None)
-    f_submission = tables.open_file('/data/codalab/submission_5-6.hdf5', 'w',
-                                    filters=FILTERS)
-    preds_array = f_submission.create_earray('/', 'pred', tables.UInt32Atom(),
-                                             (0, 192, 192, 192),
-                                             expectedrows=data.n)
+    writer = SparseSubmissionWriter(cfg.SUBMISSION_FILE, dim=net.dim,
+                                    num_classes=cfg.NUM_CLASSES,
+                                    softmax=cfg.SUBMISSION_SOFTMAX)
 
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
@@ -60,15 +165,23 @@ def inference(cfg, is_testing=False):
             # display_uresnet(blob, cfg, index=i, **results)
             if not is_testing:
                 metrics.add(blob, results)
-            mask = np.where(blob['data'][..., 0] > 0)
-            preds = np.reshape(results['predictions'], (1, 192, 192, 192))
-            print(np.count_nonzero(preds[mask] > 0))
-            preds[mask] = 0
-            preds_array.append(preds)
-            print(preds.shape)
+                metrics.commit()
+            # Only keep predictions at the nonzero voxels of the event
+            coords = np.asarray(blob['voxels'], dtype=np.int64)
+            index = (0,) + tuple(coords.T)
+            shape = blob['data'].shape[:-1]
+            softmax = None
+            if cfg.SUBMISSION_SOFTMAX:
+                softmax = np.reshape(results['softmax'], shape + (-1,))[index]
+            writer.add(coords,
+                       np.reshape(results['predictions'], shape)[index],
+                       softmax)
 
-    preds_array.close()
-    f_submission.close()
+    writer.close()
+    if cfg.SUBMISSION_DENSE:
+        sparse_to_dense(cfg.SUBMISSION_FILE,
+                        cfg.SUBMISSION_FILE.replace('.hdf5', '_dense.hdf5'),
+                        N=cfg.IMAGE_SIZE)
 
     duration /= cfg.MAX_STEPS
     print("Average duration of inference = %f ms" % duration)
@@ -104,6 +217,12 @@ if __name__ == '__main__':
         PPN2_INDEX = 3
         PPN1_INDEX = 1
         NUM_STRIDES = 3
+        SUBMISSION_FILE = '/data/codalab/submission_5-6.hdf5'
+        SUBMISSION_SOFTMAX = False
+        SUBMISSION_DENSE = False  # also write the dense layout
+        METRICS_STREAMING = False
+        METRICS_FLUSH = 0
+        METRICS_RESUME = False
 
     cfg = MyCfg()
     os.environ['CUDA_VISIBLE_DEVICES'] = cfg.GPU
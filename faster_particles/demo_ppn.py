@@ -7,12 +7,10 @@ from __future__ import print_function
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.python.client import timeline
 import os
 import glob
 import time
 import re
-from sklearn.cluster import DBSCAN
 
 from faster_particles.display_utils import display, display_uresnet, \
                                             display_ppn_uresnet, display_blob
@@ -20,10 +18,13 @@ from faster_particles.ppn import PPN
 from faster_particles.base_net.uresnet import UResNet
 from faster_particles.base_net import basenets
 from faster_particles.metrics import PPNMetrics, UResNetMetrics
-from faster_particles.data import ToydataGenerator, LarcvGenerator, \
-                                HDF5Generator, CSVGenerator
-from faster_particles.cropping import cropping_algorithms
+from faster_particles.metrics.sink import resume_events
+from faster_particles.cropping import cropping_algorithms, PatchBatcher
+from faster_particles.crop_op import load_crop_op
 from faster_particles.display_utils import extract_voxels
+from faster_particles.display_pool import DisplayPool
+from faster_particles.profiler.stages import timer
+from faster_particles.profiler.tracing import TraceHook, traced
 
 
 def get_data(cfg):
@@ -32,16 +33,21 @@ def get_data(cfg):
     """
     if cfg.TEST_DATA == "":
         cfg.TEST_DATA = cfg.DATA
+    # Only import the backend in use (e.g. no ROOT needed for CSV data)
     if cfg.DATA_TYPE == 'toydata':
+        from faster_particles.data.toydata import ToydataGenerator
         train_data = ToydataGenerator(cfg)
         test_data = ToydataGenerator(cfg)
     elif cfg.DATA_TYPE == 'hdf5':
+        from faster_particles.data.hdf5data import HDF5Generator
         train_data = HDF5Generator(cfg, filelist=cfg.DATA)
         test_data = HDF5Generator(cfg, filelist=cfg.TEST_DATA, is_testing=True)
     elif cfg.DATA_TYPE == 'csv':
+        from faster_particles.data.csvdata import CSVGenerator
         train_data = CSVGenerator(cfg, filelist=cfg.DATA)
         test_data = CSVGenerator(cfg, filelist=cfg.TEST_DATA)
     else:  # default is LArCV data
+        from faster_particles.data.larcvdata import LarcvGenerator
         train_data = LarcvGenerator(cfg, ioname="train",
                                     filelist=get_filelist(cfg.DATA))
         test_data = LarcvGenerator(cfg, ioname="test",
@@ -55,12 +61,18 @@ def load_weights(cfg, sess):
     """
     print("Restoring checkpoint file...")
     scopes = []
-    if cfg.WEIGHTS_FILE_PPN is not None:
+    if cfg.NET == 'full' and cfg.WEIGHTS_FILE_PPN is not None \
+            and cfg.WEIGHTS_FILE_BASE is not None:
+        # Fused graph (see FullNet): whole UResNet from the base checkpoint,
+        # PPN layers from the PPN checkpoint.
+        scopes.append((lambda x: x.startswith('uresnet/'), cfg.WEIGHTS_FILE_BASE))
+        scopes.append((lambda x: x.startswith('ppn/'), cfg.WEIGHTS_FILE_PPN))
+    elif cfg.WEIGHTS_FILE_PPN is not None:
         scopes.append((lambda x: 'small_uresnet' not in x, cfg.WEIGHTS_FILE_PPN))
     # Restore variables for base net if given checkpoint file
     elif cfg.WEIGHTS_FILE_BASE is not None:
         if cfg.NET in ['ppn', 'ppn_ext', 'full']: # load only relevant layers of base network
-		    scopes.append((lambda x: cfg.BASE_NET in x and "optimizer" not in x, cfg.WEIGHTS_FILE_BASE))
+            scopes.append((lambda x: cfg.BASE_NET in x and "optimizer" not in x, cfg.WEIGHTS_FILE_BASE))
             #scopes.append((lambda x: cfg.BASE_NET in x, cfg.WEIGHTS_FILE_BASE))
         else: # load for full base network
             scopes.append((lambda x: cfg.BASE_NET in x, cfg.WEIGHTS_FILE_BASE))
@@ -91,10 +103,13 @@ def get_filelist(ls_command):
     return str(filelist).replace('\'', '\"').replace(" ", "")
 
 
-def inference_simple(cfg, blobs, net, num_test=10, scope=None, test_image=None, **net_args):
+def inference_simple(cfg, blobs, net, num_test=10, scope=None, test_image=None,
+                     batch_size=1, trace_hook=None, **net_args):
     """
     Assumes blobs[i] is a list of blobs (crops).
     Returns inference[i] = list of results for each crop.
+    Crops are run in batches of batch_size (the last one may be smaller).
+    If given, trace_hook samples the network runs (profiling).
     """
     net.init_placeholders(**net_args)
     if scope is None:
@@ -104,21 +119,29 @@ def inference_simple(cfg, blobs, net, num_test=10, scope=None, test_image=None,
     if test_image is None:
         test_image = net.test_image
 
-    inference = []
+    inference = [[None] * len(blobs[i]) for i in range(num_test)]
     duration = []
+    batcher = PatchBatcher(batch_size)
+    with timer.stage('batching'):
+        for i in range(num_test):
+            batcher.add(i, blobs[i])
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
         sess.run(tf.local_variables_initializer())
         load_weights(cfg, sess)
-        for i in range(num_test):
-            inference_blob = []
-            for j, blob in enumerate(blobs[i]):
-                start = time.time()
-                summary, results = test_image(sess, blob)
-                end = time.time()
-                duration.append(end - start)
-                inference_blob.append(results)
-            inference.append(inference_blob)
+        for batch, slots in timer.iterate('batching', batcher.batches()):
+            start = time.time()
+            with timer.stage('sess_run'):
+                summary, results = test_image(traced(sess, trace_hook), batch)
+            end = time.time()
+            duration.append((end - start) / len(slots))
+            if batch_size == 1:
+                i, j = slots[0]
+                inference[i][j] = results
+            else:
+                for i, j, r in PatchBatcher.split(results, slots,
+                                                  keepdims=True):
+                    inference[i][j] = r
     print("Average duration of inference = %f s" % np.array(duration).mean())
     return inference
 
@@ -141,6 +164,9 @@ def inference_detail_log(cfg, blobs, weights_dir, net, num_tests):
             w = w[:-5]
             step = int(re.findall(r'model-(\d+)', w)[0])
             print(w, step)
+            # Already evaluated by an interrupted run (cfg.METRICS_RESUME)
+            if cfg.NET in ['full', 'base'] and step in metrics_uresnet.steps:
+                continue
             if cfg.NET in ['full', 'base']:
                 cfg.WEIGHTS_FILE_BASE = w
             if cfg.NET in ['full', 'ppn', 'ppn_ext']:
@@ -154,6 +180,10 @@ def inference_detail_log(cfg, blobs, weights_dir, net, num_tests):
                         metrics_uresnet.add(blob, r)
                     if cfg.NET in ['full', 'ppn', 'ppn_ext']:
                         metrics_ppn.add(blob, r)
+                if cfg.NET in ['full', 'base']:
+                    metrics_uresnet.commit()
+                if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+                    metrics_ppn.commit()
             if cfg.NET in ['full', 'base']:
                 metrics_uresnet.snapshot(step)
             if cfg.NET in ['full', 'ppn', 'ppn_ext']:
@@ -164,11 +194,397 @@ def inference_detail_log(cfg, blobs, weights_dir, net, num_tests):
         metrics_ppn.plot_snapshot()
 
 
+class FullNet(object):
+    """
+    UResNet and PPN in a single graph, sharing the UResNet backbone: the
+    encoder runs once per image and feeds both the segmentation decoder
+    and PPN1/PPN2. Same interface as the other networks for inference.
+    Since the backbone is shared, it is restored from the base checkpoint
+    (see load_weights).
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.net_ppn = PPN(cfg=cfg, base_net=UResNet)
+        self.net_base = self.net_ppn.base_net
+
+    def init_placeholders(self):
+        placeholders = self.net_ppn.init_placeholders()
+        self.net_base.init_placeholders(image=self.net_ppn.image_placeholder)
+        self.image_placeholder = self.net_ppn.image_placeholder
+        return placeholders
+
+    def create_architecture(self, is_training=False):
+        if is_training:
+            raise Exception("FullNet is only available for inference.")
+        self.net_base.create_architecture(is_training=False)
+        self.net_ppn.create_architecture(
+            is_training=False, base_layers=self.net_base.base_layers)
+        self.dim1, self.dim2 = self.net_ppn.dim1, self.net_ppn.dim2
+
+    def test_image(self, sess, blob):
+        keys = ['predictions', 'scores', 'softmax',
+                'im_proposals', 'im_labels', 'im_scores', 'rois']
+        results = sess.run([
+            self.net_base._predictions,
+            self.net_base._scores,
+            self.net_base._softmax,
+            self.net_ppn._predictions['im_proposals'],
+            self.net_ppn._predictions['im_labels'],
+            self.net_ppn._predictions['im_scores'],
+            self.net_ppn._predictions['rois']
+            ], feed_dict={
+                self.net_ppn.image_placeholder: blob['data'],
+                self.net_ppn.gt_pixels_placeholder: blob['gt_pixels']
+            })
+        return None, dict(zip(keys, results))
+
+
+def get_small_uresnet(cfg, net_ppn):
+    """
+    Define small UResNet running on crops around PPN proposals, in the
+    graph of net_ppn. Returns the network, the arguments of its
+    init_placeholders and the corresponding test_image function.
+    """
+    # FIXME better way to control the number of crops here?
+    crops = crop_proposals(cfg, net_ppn.image_placeholder, net_ppn._predictions['im_proposals'])[:512]
+    # Cannot use tf.train.batch because the call to tf.train.start_queue_runners
+    # requires image placeholder to be fed already
+    #crops = tf.train.batch([crops], 1, shapes=[tf.TensorShape((cfg.CROP_SIZE, cfg.CROP_SIZE))], dynamic_pad=True, allow_smaller_final_batch=False, enqueue_many=True)
+    net_uresnet = UResNet(cfg=cfg, N=cfg.CROP_SIZE)
+    crop_shape = (cfg.CROP_SIZE,) * net_uresnet.dim
+    # FIXME remove dependency on labels at test time
+    net_args = {
+        'image': tf.reshape(crops, (-1,) + crop_shape + (1,)),
+        'labels': tf.cast(tf.reshape(crops, (-1,) + crop_shape),
+                          dtype=tf.int32)
+    }
+
+    def test_image_small_uresnet(sess, blob):
+        results = sess.run([
+            crops,
+            net_uresnet._predictions,
+            net_uresnet._scores
+        ], feed_dict={net_ppn.image_placeholder: blob['data'], net_ppn.gt_pixels_placeholder: blob['gt_pixels']})
+        return None, {'crops': results[0], 'predictions_small': results[1], 'scores_small': results[2]}
+
+    return net_uresnet, net_args, test_image_small_uresnet
+
+
+def postprocess(cfg, blob, results, index, real_step,
+                metrics_ppn=None, metrics_uresnet=None, dim1=None, dim2=None,
+                display_pool=None):
+    """
+    Display results of all networks for one blob (crop), add them to the
+    metrics and run the ad-hoc clustering. Displays are drawn by
+    display_pool if given, synchronously otherwise.
+    """
+    if display_pool is None:
+        display_pool = DisplayPool(num_workers=0)
+    if cfg.NET == 'full':
+        with timer.stage('display'):
+            display_pool.submit(
+                display_ppn_uresnet,
+                blob,
+                cfg,
+                index=index,
+                directory=os.path.join(cfg.DISPLAY_DIR, 'demo_full'),
+                **results
+            )
+        with timer.stage('metrics'):
+            metrics_ppn.add(blob, results)
+            metrics_uresnet.add(blob, results)
+    elif cfg.NET in ['ppn', 'ppn_ext']:
+        with timer.stage('display'):
+            display_pool.submit(
+                display,
+                blob,
+                cfg,
+                index=real_step,
+                dim1=dim1,
+                dim2=dim2,
+                directory=os.path.join(cfg.DISPLAY_DIR, 'demo'),
+                **results
+            )
+        with timer.stage('metrics'):
+            metrics_ppn.add(blob, results)
+    elif cfg.NET == 'base' and cfg.BASE_NET == 'uresnet':
+        with timer.stage('display'):
+            display_pool.submit(display_uresnet, blob, cfg,
+                                index=real_step,
+                                directory=os.path.join(cfg.DISPLAY_DIR, 'demo'),
+                                **results)
+        with timer.stage('metrics'):
+            metrics_uresnet.add(blob, results)
+    else:  # No display function available, just print results.
+        print(blob, results)
+    if cfg.NET == 'ppn_ext':
+        N = cfg.IMAGE_SIZE
+        cfg.IMAGE_SIZE = cfg.CROP_SIZE
+        crop_shape = (1,) + (cfg.CROP_SIZE,) * (3 if cfg.DATA_3D else 2)
+        for k, crop in enumerate(results['crops']):
+            blob_j = {'data': np.reshape(crop, crop_shape + (1,))}
+            # FIXME generate labels from gt ?
+            blob_j['labels'] = blob_j['data'][..., 0]
+            pred = np.reshape(results['predictions_small'][k], crop_shape)
+            scores = np.reshape(results['scores_small'][k], crop_shape)
+            with timer.stage('display'):
+                display_pool.submit(display_uresnet, blob_j, cfg,
+                                    index=real_step*100+k,
+                                    name='display_small',
+                                    directory=os.path.join(cfg.DISPLAY_DIR, 'demo_small'),
+                                    vmin=0,
+                                    vmax=1,
+                                    predictions=pred,
+                                    scores=scores)
+
+        cfg.IMAGE_SIZE = N
+
+    # 3. Ad-hoc clustering
+    # --------------------
+    # Clustering and crops reconciliation expect squeezed softmax and
+    # predictions with a batch dimension
+    if 'predictions' in results:
+        results['softmax'] = np.squeeze(results['softmax'])
+        results['predictions'] = np.squeeze(results['predictions'])[np.newaxis, ...]
+    if cfg.NET != 'base':
+        with timer.stage('clustering'):
+            cluster(cfg, blob, results, index, name='cluster_full',
+                    directory=os.path.join(cfg.DISPLAY_DIR, 'cluster_full'),
+                    display_pool=display_pool)
+
+
+def postprocess_event(cfg, crop_algorithm, index, real_step, batch_blobs,
+                      blob_results, patch_centers=None, patch_sizes=None,
+                      **kwargs):
+    """
+    Postprocess all the blobs (crops) of an event, then reconcile crops
+    results if cropping is enabled.
+    Returns final results for the event and updated real_step.
+    """
+    if cfg.ENABLE_CROP:
+        N = cfg.IMAGE_SIZE
+        cfg.IMAGE_SIZE = cfg.SLICE_SIZE
+    for j, blob in enumerate(batch_blobs):
+        print("%d - %d/%d" % (index, j, len(batch_blobs)))
+        real_step += 1
+        postprocess(cfg, blob, blob_results[j], index, real_step, **kwargs)
+    for metrics in [kwargs.get('metrics_ppn'), kwargs.get('metrics_uresnet')]:
+        if metrics is not None:
+            metrics.commit()
+
+    if cfg.ENABLE_CROP:
+        cfg.IMAGE_SIZE = N
+        with timer.stage('reconcile'):
+            final_blob_results = crop_algorithm.reconcile(blob_results,
+                                                          patch_centers,
+                                                          patch_sizes)
+
+        # display(blob,
+        #          cfg,
+        #          index=i,
+        #          name='display_train_final',
+        #          directory=os.path.join(self.cfg.DISPLAY_DIR,
+        #                                 'train'),
+        #          **final_results)
+    else:
+        final_blob_results = blob_results[0]
+    return final_blob_results, real_step
+
+
+def skip_resumed_events(cfg, data):
+    """
+    With cfg.METRICS_RESUME, read and skip the events whose metrics were
+    written by the interrupted run (data must come in the same order).
+    Returns their number.
+    """
+    names = []
+    if (cfg.NET == 'base' and cfg.BASE_NET == 'uresnet') or cfg.NET == 'full':
+        names.append('uresnet')
+    if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+        names.append('ppn')
+    skip = min(resume_events(cfg, names), cfg.MAX_STEPS)
+    if skip:
+        print("Skipping %d events already evaluated..." % skip)
+    for i in range(skip):
+        data.forward()
+    return skip
+
+
+def plot_metrics(metrics_ppn, metrics_uresnet):
+    """
+    Plot (and write the last values of) all the metrics computed.
+    """
+    print('Plot metrics...')
+    for metrics in [metrics_uresnet, metrics_ppn]:
+        if metrics is not None:
+            metrics.plot()
+    print("Done.")
+
+
+def start_session(cfg):
+    """
+    Start a session on the default graph and restore weights.
+    """
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+    load_weights(cfg, sess)
+    return sess
+
+
+class StreamingInference(object):
+    """
+    Build every network required by cfg.NET once, each in its own graph
+    and session (UResNet and PPN share a single graph for `full`), then
+    run them one event at a time. Nothing is kept from
+    one event to the next.
+    """
+    def __init__(self, cfg, trace_hook=None):
+        self.cfg = cfg
+        self.trace_hook = trace_hook
+        self.crop_algorithm = cropping_algorithms[cfg.CROP_ALGO](cfg)
+        self.sess_base, self.sess_ppn = None, None
+        self.dim1, self.dim2 = None, None
+        weights_file_ppn = cfg.WEIGHTS_FILE_PPN
+
+        if cfg.NET == 'base':
+            print("Base network...")
+            cfg.WEIGHTS_FILE_PPN = None
+            with tf.Graph().as_default():
+                self.net_base = basenets[cfg.BASE_NET](cfg=cfg)
+                self.net_base.init_placeholders()
+                self.net_base.create_architecture(is_training=False)
+                self.sess_base = start_session(cfg)
+            cfg.WEIGHTS_FILE_PPN = weights_file_ppn
+
+        if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+            print("PPN network...")
+            with tf.Graph().as_default():
+                if cfg.NET == 'full':
+                    self.net_ppn = FullNet(cfg)
+                else:
+                    self.net_ppn = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
+                self.net_ppn.init_placeholders()
+                self.net_ppn.create_architecture(is_training=False)
+                self.dim1, self.dim2 = self.net_ppn.dim1, self.net_ppn.dim2
+                self.test_image_small_uresnet = None
+                if cfg.NET == 'ppn_ext':
+                    net_uresnet, net_args, self.test_image_small_uresnet = \
+                        get_small_uresnet(cfg, self.net_ppn)
+                    net_uresnet.init_placeholders(**net_args)
+                    net_uresnet.create_architecture(is_training=False,
+                                                    scope='small_uresnet')
+                self.sess_ppn = start_session(cfg)
+        print("Done.")
+
+    def run(self, batch_blobs):
+        """
+        Run all networks on the blobs (crops) of an event.
+        Returns a list of results dictionaries, one per blob.
+        """
+        blob_results = [{} for _ in batch_blobs]
+        if self.sess_base is not None:
+            batcher = PatchBatcher(
+                self.cfg.BATCH_SIZE if self.cfg.ENABLE_CROP else 1)
+            with timer.stage('batching'):
+                batcher.add(0, batch_blobs)
+            for batch, slots in timer.iterate('batching', batcher.batches()):
+                with timer.stage('sess_run'):
+                    _, results = self.net_base.test_image(
+                        traced(self.sess_base, self.trace_hook), batch)
+                if batcher.batch_size == 1:
+                    blob_results[slots[0][1]].update(results)
+                else:
+                    for _, j, r in PatchBatcher.split(results, slots,
+                                                      keepdims=True):
+                        blob_results[j].update(r)
+        if self.sess_ppn is not None:
+            sess_ppn = traced(self.sess_ppn, self.trace_hook)
+            for j, blob in enumerate(batch_blobs):
+                with timer.stage('sess_run'):
+                    _, results = self.net_ppn.test_image(sess_ppn, blob)
+                blob_results[j].update(results)
+                if self.test_image_small_uresnet is not None:
+                    with timer.stage('sess_run'):
+                        _, results = self.test_image_small_uresnet(sess_ppn,
+                                                                   blob)
+                    blob_results[j].update(results)
+        return blob_results
+
+    def close(self):
+        for sess in [self.sess_base, self.sess_ppn]:
+            if sess is not None:
+                sess.close()
+
+
+def inference_streaming(cfg):
+    """
+    Streaming inference for `ppn`, `base`, `full`, `ppn_ext`: each event
+    goes through all networks, displays and metrics before the next event
+    is read, so that memory usage does not depend on MAX_STEPS.
+    """
+    batch_size = cfg.BATCH_SIZE
+    if cfg.ENABLE_CROP:
+        cfg.BATCH_SIZE = 1
+    train_data, data = get_data(cfg)
+    cfg.BATCH_SIZE = batch_size
+
+    trace_hook = TraceHook.from_config(cfg)
+    display_pool = DisplayPool.from_config(cfg)
+    streaming = StreamingInference(cfg, trace_hook=trace_hook)
+    metrics_ppn, metrics_uresnet = None, None
+    if streaming.sess_ppn is not None:
+        metrics_ppn = PPNMetrics(cfg, dim1=streaming.dim1, dim2=streaming.dim2)
+    if (cfg.NET == 'base' and cfg.BASE_NET == 'uresnet') or cfg.NET == 'full':
+        metrics_uresnet = UResNetMetrics(cfg)
+
+    real_step = 0
+    duration = []
+    timing_file = os.path.join(cfg.DISPLAY_DIR, 'timing.jsonl')
+    timer.reset()
+    for i in range(skip_resumed_events(cfg, data), cfg.MAX_STEPS):
+        with timer.stage('data'):
+            blob = data.forward()
+        patch_centers, patch_sizes = None, None
+        if cfg.ENABLE_CROP:
+            batch_blobs, patch_centers, patch_sizes = streaming.crop_algorithm.process(blob)
+        else:
+            batch_blobs = [blob]
+        start = time.time()
+        blob_results = streaming.run(batch_blobs)
+        duration.append(time.time() - start)
+        _, real_step = postprocess_event(cfg, streaming.crop_algorithm, i,
+                                         real_step, batch_blobs, blob_results,
+                                         patch_centers=patch_centers,
+                                         patch_sizes=patch_sizes,
+                                         metrics_ppn=metrics_ppn,
+                                         metrics_uresnet=metrics_uresnet,
+                                         dim1=streaming.dim1,
+                                         dim2=streaming.dim2,
+                                         display_pool=display_pool)
+        if cfg.TIMING_INTERVAL > 0 and (i + 1) % cfg.TIMING_INTERVAL == 0:
+            timer.write(i, timing_file)
+    streaming.close()
+    display_pool.close()
+    print("Average duration of inference per event = %f s" % np.array(duration).mean())
+    if cfg.TIMING_INTERVAL > 0 and timer.stages:
+        timer.report()
+        timer.write(cfg.MAX_STEPS - 1, timing_file)
+
+    if trace_hook is not None:
+        trace_hook.report()
+
+    plot_metrics(metrics_ppn, metrics_uresnet)
+    del train_data
+    del data
+
+
 def inference(cfg):
     """
     Inference for `ppn`, `base`, `full`.
     Retrieves in a loop all the data first and stores it.
-    Memory issues could arise if too many steps are requested.
+    Memory issues could arise if too many steps are requested,
+    use streaming mode (cfg.STREAMING) in that case.
     """
     # if cfg.WEIGHTS_FILE_BASE is None or cfg.WEIGHTS_FILE_PPN is None:
     #     raise Exception("Need both weights files for full inference.")
@@ -176,6 +592,9 @@ def inference(cfg):
     if not os.path.isdir(cfg.DISPLAY_DIR):
         os.makedirs(cfg.DISPLAY_DIR)
 
+    if cfg.STREAMING and not cfg.DETAIL_LOG:
+        return inference_streaming(cfg)
+
     num_test = cfg.MAX_STEPS
     inference_base, inference_ppn, blobs = [], [], []
     weights_file_ppn = cfg.WEIGHTS_FILE_PPN
@@ -185,88 +604,81 @@ def inference(cfg):
     # --------------------------------------
     # Memory issues could arise here if we ask for too many steps.
     print("Retrieving data...")
+    # With cropping, the batch size applies to patches rather than events
+    batch_size = cfg.BATCH_SIZE
+    if cfg.ENABLE_CROP:
+        cfg.BATCH_SIZE = 1
     train_data, data = get_data(cfg)
+    cfg.BATCH_SIZE = batch_size
+    if not cfg.DETAIL_LOG:
+        num_test -= skip_resumed_events(cfg, data)
     patch_centers_list, patch_sizes_list = [], []
+    timer.reset()
     for i in range(num_test):
-        blob = data.forward()
+        with timer.stage('data'):
+            blob = data.forward()
         # Cropping pre-processing
         patch_centers, patch_sizes = None, None
         if cfg.ENABLE_CROP:
             batch_blobs, patch_centers, patch_sizes = crop_algorithm.process(blob)
-            patch_centers_list.append(patch_centers)
-            patch_sizes_list.append(patch_sizes)
         else:
             batch_blobs = [blob]
+        patch_centers_list.append(patch_centers)
+        patch_sizes_list.append(patch_sizes)
         blobs.append(batch_blobs)
     print("Done.")
 
-    if cfg.PROFILE:
-        print('WARNING PROFILING ENABLED')
-        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-        # print(getargspec(self.sess.run))
-        run_metadata = tf.RunMetadata()
-        old_run = tf.Session.run
-        new_run = lambda self, fetches, feed_dict=None: old_run(self, fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
-        tf.Session.run = new_run
+    trace_hook = TraceHook.from_config(cfg)
 
     # 1. Run inference of all the networks.
     # -------------------------------------
     # Depending on cfg.NET value, build and run the networks inferences.
 
-    # First base
+    # First base (for `full` the base network is fused with PPN below)
     inference_base = None
-    if cfg.NET in ['full', 'base']:
+    if cfg.NET == 'base' or (cfg.NET == 'full' and cfg.DETAIL_LOG):
         print("Base network...")
         cfg.WEIGHTS_FILE_PPN = None
         net_base = basenets[cfg.BASE_NET](cfg=cfg)
         if cfg.DETAIL_LOG:
             return inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_BASE, net_base, num_test)
-        inference_base = inference_simple(cfg, blobs, net_base, num_test=num_test)
+        inference_base = inference_simple(
+            cfg, blobs, net_base, num_test=num_test,
+            batch_size=cfg.BATCH_SIZE if cfg.ENABLE_CROP else 1,
+            trace_hook=trace_hook)
         print("Done.")
 
     tf.reset_default_graph()
 
     # Then PPN
     inference_ppn = None
-    if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+    if cfg.NET == 'full':
+        print("PPN + base network...")
+        cfg.WEIGHTS_FILE_PPN = weights_file_ppn
+        net_ppn = FullNet(cfg)
+        inference_ppn = inference_simple(cfg, blobs, net_ppn, num_test=num_test,
+                                         trace_hook=trace_hook)
+        print("Done.")
+    elif cfg.NET in ['ppn', 'ppn_ext']:
         print("PPN network...")
         cfg.WEIGHTS_FILE_PPN = weights_file_ppn
         net_ppn = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
         if cfg.DETAIL_LOG:
             return inference_detail_log(cfg, blobs, cfg.WEIGHTS_FILE_PPN, net_ppn, num_test)
-        inference_ppn = inference_simple(cfg, blobs, net_ppn, num_test=num_test)
+        inference_ppn = inference_simple(cfg, blobs, net_ppn, num_test=num_test,
+                                         trace_hook=trace_hook)
         print("Done.")
 
     # Small UResNet (try to get better precision after PPN?)
     inference_small_uresnet = None
     if cfg.NET == 'ppn_ext':
         print("Small UResNet + PPN network...")
-        # FIXME better way to control the number of crops here?
-        crops = crop_proposals(cfg, net_ppn.image_placeholder, net_ppn._predictions['im_proposals'])[:512]
-        print(crops)
-        # Cannot use tf.train.batch because the call to tf.train.start_queue_runners
-        # requires image placeholder to be fed already
-        #crops = tf.train.batch([crops], 1, shapes=[tf.TensorShape((cfg.CROP_SIZE, cfg.CROP_SIZE))], dynamic_pad=True, allow_smaller_final_batch=False, enqueue_many=True)
-        net_uresnet = UResNet(cfg=cfg, N=cfg.CROP_SIZE)
-        # FIXME remove dependency on labels at test time
-        net_args = {
-            'image': tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE, 1)),
-            'labels': tf.cast(tf.reshape(crops, (-1, cfg.CROP_SIZE, cfg.CROP_SIZE)),
-                           dtype=tf.int32)
-        }
-
-        def test_image_small_uresnet(sess, blob):
-            results = sess.run([
-                crops,
-                net_uresnet._predictions,
-                net_uresnet._scores
-            ], feed_dict={net_ppn.image_placeholder: blob['data'], net_ppn.gt_pixels_placeholder: blob['gt_pixels']})
-            return None, {'crops': results[0], 'predictions_small': results[1], 'scores_small': results[2]}
-
+        net_uresnet, net_args, test_image_small_uresnet = get_small_uresnet(cfg, net_ppn)
         inference_small_uresnet = inference_simple(cfg, blobs, net_uresnet,
                                                    num_test=num_test,
                                                    scope='small_uresnet',
                                                    test_image=test_image_small_uresnet,
+                                                   trace_hook=trace_hook,
                                                    **net_args)
         print("Done.")
 
@@ -275,181 +687,91 @@ def inference(cfg):
     # Also computes associated metrics if relevant.
 
     print("Saving displays...")
+    metrics_ppn, metrics_uresnet = None, None
     if inference_ppn is not None:
         metrics_ppn = PPNMetrics(cfg, dim1=net_ppn.dim1, dim2=net_ppn.dim2)
-    if inference_base is not None and cfg.BASE_NET == 'uresnet':
+    if (cfg.NET == 'base' and cfg.BASE_NET == 'uresnet') or cfg.NET == 'full':
         metrics_uresnet = UResNetMetrics(cfg)
 
     real_step = 0
     final_results = []
+    display_pool = DisplayPool.from_config(cfg)
     for i in range(num_test):
-        if cfg.ENABLE_CROP:
-            N = cfg.IMAGE_SIZE
-            cfg.IMAGE_SIZE = cfg.SLICE_SIZE
-        final_blob_results = []
-        for j, blob in enumerate(blobs[i]):
-            print("%d - %d/%d" % (i, j, len(blobs[i])))
-            real_step += 1
+        blob_results = []
+        for j in range(len(blobs[i])):
             results = {}
             if inference_base is not None:
                 results.update(inference_base[i][j])
             if inference_ppn is not None:
                 results.update(inference_ppn[i][j])
-            final_blob_results.append(results)
-
-            if cfg.NET == 'full':
-                display_ppn_uresnet(
-                    blob,
-                    cfg,
-                    index=i,
-                    directory=os.path.join(cfg.DISPLAY_DIR, 'demo_full'),
-                    **results
-                )
-                metrics_ppn.add(blob, results)
-                metrics_uresnet.add(blob, results)
-            elif cfg.NET in ['ppn', 'ppn_ext']:
-                display(
-                    blob,
-                    cfg,
-                    index=real_step,
-                    dim1=net_ppn.dim1,
-                    dim2=net_ppn.dim2,
-                    directory=os.path.join(cfg.DISPLAY_DIR, 'demo'),
-                    **results
-                )
-                metrics_ppn.add(blob, results)
-            elif cfg.NET == 'base' and cfg.BASE_NET == 'uresnet':
-                display_uresnet(blob, cfg,
-                                index=real_step,
-                                directory=os.path.join(cfg.DISPLAY_DIR, 'demo'),
-                                **results)
-                metrics_uresnet.add(blob, results)
-            else:  # No display function available, just print results.
-                print(blob, results)
-            if cfg.NET == 'ppn_ext':
-                N = cfg.IMAGE_SIZE
-                cfg.IMAGE_SIZE = cfg.CROP_SIZE
-                for k, crop in enumerate(results['crops']):
-                    blob_j = {'data': np.reshape(crop, (1, cfg.CROP_SIZE, cfg.CROP_SIZE, 1))}
-                    # FIXME generate labels from gt ?
-                    blob_j['labels'] = blob_j['data'][:, :, :, 0]
-                    pred = np.reshape(results['predictions_small'][k], (1, cfg.CROP_SIZE, cfg.CROP_SIZE))
-                    scores = np.reshape(results['scores_small'][k], (1, cfg.CROP_SIZE, cfg.CROP_SIZE))
-                    display_uresnet(blob_j, cfg,
-                                    index=real_step*100+k,
-                                    name='display_small',
-                                    directory=os.path.join(cfg.DISPLAY_DIR, 'demo_small'),
-                                    vmin=0,
-                                    vmax=1,
-                                    predictions=pred,
-                                    scores=scores)
-
-                cfg.IMAGE_SIZE = N
-
-            # 3. Ad-hoc clustering
-            # --------------------
-            # FIXME why is this reshape necessary?
-            results['predictions'] = results['predictions'][np.newaxis, ...]
-            if cfg.NET != 'base':
-                cluster(cfg, blob, results, i, name='cluster_full', directory=os.path.join(cfg.DISPLAY_DIR, 'cluster_full'))
-
-        if cfg.ENABLE_CROP:
-            cfg.IMAGE_SIZE = N
-            final_blob_results = crop_algorithm.reconcile(final_blob_results,
-                                                     patch_centers_list[i],
-                                                     patch_sizes_list[i])
-
-            # display(blob,
-            #          cfg,
-            #          index=i,
-            #          name='display_train_final',
-            #          directory=os.path.join(self.cfg.DISPLAY_DIR,
-            #                                 'train'),
-            #          **final_results)
-        else:
-            final_blob_results = final_blob_results[0]
+            if inference_small_uresnet is not None:
+                results.update(inference_small_uresnet[i][j])
+            blob_results.append(results)
+        final_blob_results, real_step = postprocess_event(
+            cfg, crop_algorithm, i, real_step, blobs[i], blob_results,
+            patch_centers=patch_centers_list[i],
+            patch_sizes=patch_sizes_list[i],
+            metrics_ppn=metrics_ppn,
+            metrics_uresnet=metrics_uresnet,
+            dim1=net_ppn.dim1 if inference_ppn is not None else None,
+            dim2=net_ppn.dim2 if inference_ppn is not None else None,
+            display_pool=display_pool)
         final_results.append(final_blob_results)
+    display_pool.close()
 
+    plot_metrics(metrics_ppn, metrics_uresnet)
 
-    print('Plot metrics...')
-    if (cfg.NET == 'base' and cfg.BASE_NET == 'uresnet') or cfg.NET == 'full':
-        metrics_uresnet.plot()
-    elif cfg.NET in ['ppn', 'full']:
-        metrics_ppn.plot()
-    print("Done.")
+    # Each stage runs on all events before the next one, a single write
+    # covers the whole run.
+    if cfg.TIMING_INTERVAL > 0:
+        timer.report()
+        timer.write(num_test - 1, os.path.join(cfg.DISPLAY_DIR, 'timing.jsonl'))
 
-    if cfg.PROFILE:
-        # Create the Timeline object, and write it to a json
-        tl = timeline.Timeline(run_metadata.step_stats)
-        ctf = tl.generate_chrome_trace_format()
-        with open(cfg.PROFILE_NAME, 'w') as f:
-            f.write(ctf)
-            print("Wrote timeline to %s" % cfg.PROFILE_NAME)
-
-        # # Print to stdout an analysis of the memory usage and the timing information
-        # # broken down by python codes.
-        # ProfileOptionBuilder = tf.profiler.ProfileOptionBuilder
-        # opts = ProfileOptionBuilder(ProfileOptionBuilder.time_and_memory()
-        #     ).with_node_names(show_name_regexes=['*']).build()
-        #
-        # tf.profiler.profile(
-        #     tf.get_default_graph(),
-        #     run_meta=run_metadata,
-        #     cmd='code',
-        #     options=opts)
-        #
-        # # Print to stdout an analysis of the memory usage and the timing information
-        # # broken down by operation types.
-        # tf.profiler.profile(
-        #     tf.get_default_graph(),
-        #     run_meta=run_metadata,
-        #     cmd='op',
-        #     options=tf.profiler.ProfileOptionBuilder.time_and_memory())
+    if trace_hook is not None:
+        trace_hook.report()
     del train_data
     del data
     return blobs, final_results
 
 
-def crop_step(crops, coords0, coords1, data, N):
-    j = tf.shape(crops)[0]-1
-    j = tf.Print(j, [j])
-    padding = []
-    dim = coords0.get_shape()[1]
-    for d in range(dim):
-        pad = tf.maximum(N - (coords1[j, d] - coords0[j, d]), 0)
-        if coords0[j, d] == 0.0:
-            padding.append((pad, 0))
-        else:
-            padding.append((0, pad))
-    new_crop = tf.pad(data[0, coords0[j, 0]:coords1[j, 0], coords0[j, 1]:coords1[j, 1], 0], padding, mode='constant')
-    crops = tf.concat([crops, [new_crop]], axis=0)
-    return crops, coords0, coords1, data, N
-
-
 def crop_proposals(cfg, data, proposals):
+    """
+    Crops of size cfg.CROP_SIZE centered on proposals (with a random smear)
+    in data of shape (1, N, N, [N,] 1), zero-padded outside of the image.
+    Returns crops of shape (num_proposals, CROP_SIZE, CROP_SIZE[, CROP_SIZE]).
+    """
     N = cfg.CROP_SIZE
-    coords0 = tf.cast(tf.floor(proposals - N/2.0), tf.int32)
-    coords1 = tf.cast(tf.floor(proposals + N/2.0), tf.int32)
     dim = 3 if cfg.DATA_3D else 2
     smear = tf.random_uniform((dim,), minval=-3, maxval=3, dtype=tf.int32)
-    coords0 = tf.clip_by_value(coords0 + smear, 0, cfg.IMAGE_SIZE-1)
-    coords1 = tf.clip_by_value(coords1 + smear, 0, cfg.IMAGE_SIZE-1)
-    crops = tf.zeros((1, N, N))#tf.zeros((tf.shape(coords0)[0], N, N))
-    results = tf.while_loop(lambda crops, coords0, *args: tf.shape(crops)[0] <= tf.shape(coords0)[0],
-                            crop_step, [crops, coords0, coords1, data, N],
-                            shape_invariants=[tf.TensorShape((None, N, N)), coords0.get_shape(), coords1.get_shape(), data.get_shape(), tf.TensorShape(())])
-    crops = results[0][1:, :, :]
-    return crops
-
-
-def cluster(cfg, blob, results, index, name='cluster', directory=None):
+    crop_centers = tf.cast(tf.floor(proposals), tf.int32) + smear
+    crop_module = load_crop_op()
+    if crop_module is not None:
+        return crop_module.crop(data, crop_centers, N)[..., 0]
+    # Pad the image by N on each side, so that all crops intersecting the
+    # image are inside the padded image. Crops entirely outside of the image
+    # are clipped to the (empty) padding.
+    image = tf.pad(data[0, ..., 0], [[N, N]] * dim, mode='constant')
+    origins = tf.clip_by_value(crop_centers - N//2 + N, 0,
+                               tf.shape(data)[1] + N)
+    # Index grid of a crop relative to its origin, shape (N,)*dim + (dim,)
+    grid = tf.stack(tf.meshgrid(*[tf.range(N)] * dim, indexing='ij'), axis=-1)
+    indices = tf.reshape(origins, [-1] + [1] * dim + [dim]) + grid
+    return tf.gather_nd(image, indices)
+
+
+def cluster(cfg, blob, results, index, name='cluster', directory=None,
+            display_pool=None):
     """
     Ad-hoc clustering algorithm. Can use UResNet predictions as a mask for
     to cluster track and shower separately, if results includes `predictions`
     key. Erases a 7x7 window around each point predicted by PPN in the data,
     then applies DBSCAN algorithm to perform rough clustering of track/shower
-    instances.
+    instances. The clusters are drawn by display_pool if given, synchronously
+    otherwise.
     """
+    from sklearn.cluster import DBSCAN
+    if display_pool is None:
+        display_pool = DisplayPool(num_workers=0)
     data = blob['data']
     WINDOW_SIZE = 7
     # Hide window around each proposal
@@ -498,7 +820,8 @@ def cluster(cfg, blob, results, index, name='cluster', directory=None):
     if cfg.DATA_3D:
         kwargs['projection'] = '3d'
 
-    display_blob(new_blob, cfg, directory=directory, index=index, cmap='tab10', **kwargs)
+    display_pool.submit(display_blob, new_blob, cfg, directory=directory,
+                        index=index, cmap='tab10', **kwargs)
 
 # if __name__ == '__main__':
 #     inference(cfg)
@@ -0,0 +1,146 @@
+# *-* encoding: utf-8 *-*
+# Render event displays in worker processes
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import multiprocessing
+import os
+import traceback
+from collections import OrderedDict
+import numpy as np
+
+from faster_particles.config import ConfigSnapshot
+
+# Arrays at least this large and mostly zeros are sent as nonzero values
+SPARSE_MIN_SIZE = 4096
+
+
+class SparseArray(object):
+    """
+    Nonzero values of a (mostly empty) dense array, e.g. a 3D image.
+    """
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.indices = np.flatnonzero(array)
+        self.values = array.ravel()[self.indices]
+
+    def densify(self):
+        array = np.zeros(self.shape, dtype=self.dtype)
+        array.reshape(-1)[self.indices] = self.values
+        return array
+
+
+def snapshot(value):
+    """
+    Copy of value (arrays, or dict, list, tuple of arrays) that later
+    changes of value in the training/inference loop do not affect, with
+    sparse arrays stored as SparseArray.
+    """
+    if isinstance(value, np.ndarray):
+        if value.size >= SPARSE_MIN_SIZE and 2 * np.count_nonzero(value) < value.size:
+            return SparseArray(value)
+        return value.copy()
+    if isinstance(value, dict):
+        return dict((k, snapshot(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(v) for v in value)
+    return copy.deepcopy(value)
+
+
+def restore(value):
+    if isinstance(value, SparseArray):
+        return value.densify()
+    if isinstance(value, dict):
+        return dict((k, restore(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(restore(v) for v in value)
+    return value
+
+
+def render(function, cfg, blob, args, kwargs):
+    """
+    Runs in a worker process. Errors are printed rather than raised, a
+    failed display should not stop training.
+    """
+    try:
+        function(restore(blob), cfg, *restore(args), **restore(kwargs))
+    except Exception:
+        traceback.print_exc()
+
+
+class DisplayPool(object):
+    """
+    Runs display functions (display, display_uresnet, draw_slicing...)
+    in num_workers processes, on snapshots of the blob, configuration and
+    results taken when the display is requested.
+
+    At most max_pending displays are rendered at a time. Further requests
+    wait, and a request replaces the waiting one with the same function,
+    name and directory: when rendering cannot keep up, only the latest
+    display of each kind is drawn and submit never blocks.
+    With num_workers = 0, displays are drawn synchronously.
+    """
+    def __init__(self, num_workers=2, max_pending=4):
+        self.num_workers = num_workers
+        self.max_pending = max(max_pending, 1)
+        self.pending = []
+        self.waiting = OrderedDict()
+        self.dropped = 0
+        self.pool = None
+        if num_workers > 0:
+            # Workers must not inherit a forked Tensorflow state
+            context = multiprocessing.get_context('spawn') \
+                if hasattr(multiprocessing, 'get_context') else multiprocessing
+            self.pool = context.Pool(num_workers)
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(num_workers=cfg.DISPLAY_WORKERS,
+                   max_pending=cfg.DISPLAY_QUEUE)
+
+    def submit(self, function, blob, cfg, *args, **kwargs):
+        if self.pool is None:
+            return function(blob, cfg, *args, **kwargs)
+        # Avoid workers racing to create the same directory
+        directory = kwargs.get('directory')
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        request = (function, ConfigSnapshot(cfg), snapshot(blob),
+                   snapshot(args), snapshot(kwargs))
+        self.poll()
+        if len(self.pending) < self.max_pending:
+            self.pending.append(self.pool.apply_async(render, request))
+        else:
+            key = (function.__name__, kwargs.get('name'), directory)
+            if key in self.waiting:
+                self.dropped += 1
+                del self.waiting[key]
+            self.waiting[key] = request
+
+    def poll(self):
+        """
+        Forget finished displays and start waiting ones if possible.
+        """
+        self.pending = [r for r in self.pending if not r.ready()]
+        while self.waiting and len(self.pending) < self.max_pending:
+            _, request = self.waiting.popitem(last=False)
+            self.pending.append(self.pool.apply_async(render, request))
+
+    def close(self):
+        """
+        Wait for all requested displays to be drawn.
+        """
+        if self.pool is None:
+            return
+        while self.pending or self.waiting:
+            if self.pending:
+                self.pending[0].wait()
+            self.poll()
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        if self.dropped:
+            print("Skipped %d displays (display workers busy)" % self.dropped)
@@ -10,6 +10,21 @@ import matplotlib.patches as patches
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 from mpl_toolkits.mplot3d import Axes3D
 
+from faster_particles.profiler.stages import timer
+
+# Corners of the 6 faces of a unit cube and offset of the neighbour voxel
+# hiding each face.
+CUBE_FACES = np.array([
+    [[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0, 0]],
+    [[0, 0, 1], [0, 1, 1], [1, 1, 1], [1, 0, 1]],
+    [[0, 0, 0], [0, 1, 0], [0, 1, 1], [0, 0, 1]],
+    [[1, 0, 0], [1, 1, 0], [1, 1, 1], [1, 0, 1]],
+    [[0, 0, 0], [1, 0, 0], [1, 0, 1], [0, 0, 1]],
+    [[0, 1, 0], [1, 1, 0], [1, 1, 1], [0, 1, 1]]
+])
+FACE_NEIGHBOURS = np.array([[0, 0, -1], [0, 0, 1], [-1, 0, 0],
+                            [1, 0, 0], [0, -1, 0], [0, 1, 0]])
+
 
 def draw_voxel(x, y, z, size, ax, alpha=0.3, facecolors='pink', **kwargs):
     vertices = [
@@ -31,6 +46,65 @@ def draw_voxel(x, y, z, size, ax, alpha=0.3, facecolors='pink', **kwargs):
     ax.add_collection3d(poly)
 
 
+def cube_faces(origins, sizes):
+    """
+    Vertices of the faces of cubes, shape (N, 6, 4, 3).
+    sizes is a scalar or has one value per cube.
+    """
+    sizes = np.reshape(sizes, (-1, 1, 1, 1))
+    return origins[:, np.newaxis, np.newaxis, :] + CUBE_FACES[np.newaxis] * sizes
+
+
+def visible_faces(voxels):
+    """
+    Returns a boolean array (N, 6), False for the faces of unit voxels
+    which touch another voxel and cannot be seen.
+    """
+    if not np.all(np.mod(voxels, 1) == 0):
+        return np.ones((len(voxels), 6), dtype=bool)
+    # Shifted so that neighbours are >= 0, then flattened to an index
+    coords = voxels.astype(np.int64) - voxels.min(axis=0).astype(np.int64) + 1
+    shape = coords.max(axis=0) + 2
+    keys = np.sort(np.ravel_multi_index(coords.T, shape))
+    neighbours = coords[:, np.newaxis, :] + FACE_NEIGHBOURS[np.newaxis]
+    neighbour_keys = np.ravel_multi_index(
+        neighbours.reshape(-1, 3).T, shape).reshape(-1, 6)
+    found = np.minimum(np.searchsorted(keys, neighbour_keys), len(keys) - 1)
+    return keys[found] != neighbour_keys
+
+
+def draw_voxels(voxels, colors, ax, size=1, alpha=1.0, max_voxels=None,
+                **kwargs):
+    """
+    Draw voxels (N, 3) as a single collection of faces. colors is one
+    color or one RGBA color per voxel. For opaque unit voxels, faces
+    between two voxels are not drawn. Above max_voxels voxels, draw them
+    as a point cloud instead.
+    """
+    voxels = np.reshape(np.asarray(voxels, dtype=np.float64), (-1, 3))
+    if not len(voxels):
+        return None
+    colors = matplotlib.colors.to_rgba_array(colors)
+    colors = np.broadcast_to(colors, (len(voxels), 4))
+    if max_voxels is not None and len(voxels) > max_voxels:
+        centers = voxels + size / 2.0
+        return ax.scatter(centers[:, 0], centers[:, 1], centers[:, 2],
+                          c=colors, marker='s', s=1, alpha=alpha,
+                          linewidths=0.0, depthshade=False)
+    if alpha >= 1.0 and np.isscalar(size) and size == 1:
+        visible = visible_faces(voxels).ravel()
+    else:
+        visible = np.ones(6 * len(voxels), dtype=bool)
+    faces = cube_faces(voxels, size).reshape(-1, 4, 3)[visible]
+    poly = Poly3DCollection(faces, **kwargs)
+    # Bug in Matplotlib with transparency of Poly3DCollection
+    # see https://github.com/matplotlib/matplotlib/issues/10237
+    poly.set_alpha(alpha)
+    poly.set_facecolor(np.repeat(colors, 6, axis=0)[visible])
+    ax.add_collection3d(poly)
+    return poly
+
+
 def display_original_image(blob, cfg, ax, vmin=0, vmax=400, cmap='jet'):
     """
     Display original image.
@@ -41,31 +115,18 @@ def display_original_image(blob, cfg, ax, vmin=0, vmax=400, cmap='jet'):
     if cfg.DATA_3D:
         norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
         colorbar = matplotlib.cm.ScalarMappable(norm=norm, cmap=cmap)
+        voxels = np.asarray(blob['voxels'])
         if 'voxels_value' in blob:
-            colors = lambda i: colorbar.to_rgba(blob['voxels_value'][i])
+            values = np.asarray(blob['voxels_value'], dtype=np.float64)
+            colors = colorbar.to_rgba(values)
+            colors[values == 1] = matplotlib.colors.to_rgba('teal')  # track
+            colors[values == 2] = matplotlib.colors.to_rgba('gold')  # shower
         else:
-            colors = lambda i, j, k: colorbar.to_rgba(blob['data'][0, i, j, k, 0])
-        for i, voxel in enumerate(blob['voxels']):
-            if 'voxels_value' in blob:
-                if blob['voxels_value'][i] == 1:  # track
-                    draw_voxel(voxel[0], voxel[1], voxel[2], 1, ax,
-                               facecolors='teal', alpha=1.0,
-                               linewidths=0.0, edgecolors='black')
-                elif blob['voxels_value'][i] == 2:  # shower
-                    draw_voxel(voxel[0], voxel[1], voxel[2], 1, ax,
-                               facecolors='gold', alpha=1.0,
-                               linewidths=0.0, edgecolors='black')
-                else:
-                    c = colors(i)
-                    draw_voxel(voxel[0], voxel[1], voxel[2], 1, ax,
-                               facecolors=c, alpha=1.0,
-                               linewidths=0.0, edgecolors=c)
-            else:
-                voxel = voxel.astype(int)
-                c = colors(voxel[2], voxel[1], voxel[0])
-                draw_voxel(voxel[0], voxel[1], voxel[2], 1, ax,
-                           facecolors=c, alpha=1.0,
-                           linewidths=0.0, edgecolors=c)
+            voxels = voxels.astype(int)
+            colors = colorbar.to_rgba(
+                blob['data'][0, voxels[:, 2], voxels[:, 1], voxels[:, 0], 0])
+        draw_voxels(voxels, colors, ax, max_voxels=cfg.DISPLAY_MAX_VOXELS,
+                    linewidths=0.0)
         return colorbar
     else:
         return ax.imshow(blob['data'][0, ..., 0], cmap=cmap,
@@ -80,6 +141,7 @@ def set_image_limits(cfg, ax):
         ax.set_zlim(0, cfg.IMAGE_SIZE)
 
 
+@timer.timed('voxel_extraction')
 def extract_voxels(data):
     indices = np.where(data > 0)
     return np.stack(indices).T, data[indices]
@@ -100,39 +162,34 @@ def display_im_proposals(cfg, ax, im_proposals, im_scores, im_labels):
 
 
 def display_rois(cfg, ax, rois, dim1, dim2):
-    if rois is not None:
+    if rois is not None and cfg.DATA_3D:
+        if len(rois):
+            rois = np.asarray(rois)[:, [2, 1, 0]]
+            draw_voxels(rois * dim1 * dim2, 'pink', ax, size=dim1,
+                        linewidths=0.01, edgecolors='black', alpha=0.1)
+    elif rois is not None:
         for roi in rois:
-            if cfg.DATA_3D:
-                x, y, z = roi[2], roi[1], roi[0]
-                x, y, z = x*dim1*dim2, y*dim2*dim1, z*dim1*dim2
-                size = dim1
-                draw_voxel(x, y, z, size, ax,
-                    facecolors='pink',
-                    linewidths=0.01,
-                    edgecolors='black',
-                    alpha=0.1)
-            else:
-                x, y = roi[1], roi[0]
-                ax.add_patch(
-                    patches.Rectangle(
-                        (x*dim1*dim2, y*dim1*dim2), # bottom left of rectangle
-                        dim1, # width
-                        dim1, # height
-                        #fill=False,
-                        #hatch='\\',
-                        facecolor='pink',
-                        alpha = 0.3,
-                        linewidth=1.0,
-                        edgecolor='black',
-                    )
+            x, y = roi[1], roi[0]
+            ax.add_patch(
+                patches.Rectangle(
+                    (x*dim1*dim2, y*dim1*dim2), # bottom left of rectangle
+                    dim1, # width
+                    dim1, # height
+                    #fill=False,
+                    #hatch='\\',
+                    facecolor='pink',
+                    alpha = 0.3,
+                    linewidth=1.0,
+                    edgecolor='black',
                 )
+            )
 
 
 def display_gt_pixels(cfg, ax, gt_pixels):
     if cfg.DATA_3D:
-        for gt_pixel in gt_pixels:
-            x, y, z = gt_pixel[2], gt_pixel[1], gt_pixel[0]
-            draw_voxel(x, y, z, 1, ax, facecolors='red', alpha=1.0, linewidths=0.3, edgecolors='red')
+        if len(gt_pixels):
+            draw_voxels(np.asarray(gt_pixels)[:, [2, 1, 0]], 'red', ax,
+                        linewidths=0.3, edgecolors='red')
     else:
         for gt_pixel in gt_pixels:
             x, y = gt_pixel[1], gt_pixel[0]
@@ -347,30 +404,36 @@ def draw_cube(ax, coord, size):
     ax.add_collection3d(poly)
 
 
+def count_inside(coords, patch_centers, patch_sizes, chunk_size=4096):
+    """
+    Returns for each voxel the number of patches it belongs to.
+    Voxels are processed by chunks to bound the memory of the
+    (voxels, patches, dim) comparison.
+    """
+    coords = np.asarray(coords)
+    patch_centers = np.asarray(patch_centers)
+    lower = patch_centers - patch_sizes/2.0
+    upper = patch_centers + patch_sizes/2.0
+    counts = np.zeros(len(coords), dtype=np.int64)
+    for start in range(0, len(coords), chunk_size):
+        voxels = coords[start:start+chunk_size, np.newaxis, :]
+        counts[start:start+chunk_size] = np.sum(np.all(np.logical_and(
+            lower <= voxels, upper >= voxels), axis=2), axis=1)
+    return counts
+
+
 def compute_voxel_overlap(coords, patch_centers, patch_sizes):
     """
     Returns overlap value for each voxel.
     """
-    overlap = []
-    for voxel in coords:
-        overlap.append(np.sum(np.all(np.logical_and(
-            patch_centers-patch_sizes/2.0 <= voxel,
-            patch_centers + patch_sizes/2.0 >= voxel
-            ), axis=1)))
-    return overlap
+    return count_inside(coords, patch_centers, patch_sizes)
 
 
 def compute_voxel_core(coords, patch_centers, core_size):
     """
     Returns for each voxel whether it belongs to a core region.
     """
-    overlap = []
-    for voxel in coords:
-        overlap.append(np.any(np.all(np.logical_and(
-            patch_centers - core_size/2.0 <= voxel,
-            patch_centers + core_size/2.0 >= voxel
-            ), axis=1)))
-    return overlap
+    return count_inside(coords, patch_centers, core_size) > 0
 
 
 def draw_slicing(blob, cfg, patch_centers, patch_sizes,
@@ -388,11 +451,16 @@ def draw_slicing(blob, cfg, patch_centers, patch_sizes,
     fig = plt.figure()
     ax = fig.add_subplot(111, aspect='equal', **kwargs)
     display_original_image(blob, cfg, ax, vmin=0, vmax=1)
-    for i, p in enumerate(patch_centers):
-        if type(patch_sizes) == int or type(patch_sizes) == float:
-            draw_cube(ax, p - patch_sizes/2.0, patch_sizes)
-        else:
-            draw_cube(ax, p - patch_sizes[i]/2.0, patch_sizes[i])
+    if cfg.DATA_3D:
+        sizes = np.reshape(patch_sizes, (-1, 1))
+        draw_voxels(np.asarray(patch_centers) - sizes/2.0, 'cyan', ax,
+                    size=sizes, alpha=0, linewidths=0.1, edgecolors='r')
+    else:
+        for i, p in enumerate(patch_centers):
+            if type(patch_sizes) == int or type(patch_sizes) == float:
+                draw_cube(ax, p - patch_sizes/2.0, patch_sizes)
+            else:
+                draw_cube(ax, p - patch_sizes[i]/2.0, patch_sizes[i])
     set_image_limits(cfg, ax)
     if directory is None:
         print("Crops")
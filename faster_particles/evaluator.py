@@ -0,0 +1,87 @@
+# *-* encoding: utf-8 *-*
+# Evaluate new checkpoints of a training run as they are written
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+from faster_particles.config import ConfigSnapshot
+from faster_particles.sweep import prepare_cache, init_worker, \
+    evaluate_checkpoint, list_checkpoints, read_done, summary_fields, \
+    SUMMARY_METRICS
+
+
+def mean_summary(summaries, row):
+    """
+    Single summary with the mean of each scalar of the network summaries
+    (one per blob, None for networks without test summary such as FullNet)
+    and the metrics of row.
+    """
+    values = {}
+    for summary in summaries:
+        if summary is None:
+            continue
+        for value in tf.Summary.FromString(summary).value:
+            if value.HasField('simple_value'):
+                values.setdefault(value.tag, []).append(value.simple_value)
+    for name in SUMMARY_METRICS:
+        for attr in SUMMARY_METRICS[name]:
+            if attr in row:
+                values['metrics/%s' % attr] = [row[attr]]
+    return tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=np.mean(v))
+                             for tag, v in sorted(values.items())])
+
+
+def evaluate(cfg):
+    """
+    Watch cfg.OUTPUT_DIR for new checkpoints written by `ppn train` (run
+    with -te 0 so that it does not test in its training loop) and evaluate
+    each of them on the same cfg.MAX_STEPS cached test events, with the
+    inference graph. Mean network summaries and metrics are written to
+    LOG_DIR/test at the checkpoint step, and one row per checkpoint to
+    DISPLAY_DIR/evaluate.csv; checkpoints already in that file are skipped.
+    Stops when no new checkpoint appeared for cfg.EVALUATE_TIMEOUT seconds.
+    """
+    if cfg.NET not in ['ppn', 'base', 'full']:
+        raise Exception("Evaluation is only available for `ppn`, `base` and `full` nets.")
+    cfg = ConfigSnapshot(cfg)
+    cache_dir = prepare_cache(cfg, 'evaluate_cache')
+    init_worker(cfg, cache_dir)
+    summary_writer_test = tf.summary.FileWriter(os.path.join(cfg.LOG_DIR, 'test'))
+
+    filename = os.path.join(cfg.DISPLAY_DIR, 'evaluate.csv')
+    done = read_done(filename)
+    write_header = not os.path.isfile(filename)
+    last_checkpoint = time.time()
+    with open(filename, 'a') as f:
+        writer = csv.DictWriter(f, summary_fields(), restval='')
+        if write_header:
+            writer.writeheader()
+        while time.time() - last_checkpoint < cfg.EVALUATE_TIMEOUT:
+            checkpoints = [c for c in list_checkpoints(cfg.OUTPUT_DIR)
+                           if c[1] not in done]
+            if not checkpoints:
+                time.sleep(cfg.EVALUATE_INTERVAL)
+                continue
+            for step, w in checkpoints:
+                done.add(w)
+                # Old checkpoints are deleted by the trainer saver
+                if not os.path.isfile(w + '.index'):
+                    print("Skipping deleted checkpoint %s" % w)
+                    continue
+                summaries = []
+                row = evaluate_checkpoint((step, w), summaries=summaries)
+                writer.writerow(row)
+                f.flush()
+                summary_writer_test.add_summary(mean_summary(summaries, row), step)
+                summary_writer_test.flush()
+                print("Evaluated step %d" % step)
+            last_checkpoint = time.time()
+    summary_writer_test.close()
+    print("No new checkpoint for %g s, done." % cfg.EVALUATE_TIMEOUT)
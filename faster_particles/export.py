@@ -0,0 +1,168 @@
+# *-* encoding: utf-8 *-*
+# Export PPN or base network weights to a frozen inference graph
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow as tf
+
+from faster_particles.ppn import PPN
+from faster_particles.base_net import basenets
+from faster_particles.demo_ppn import load_weights
+from faster_particles.ppn_postprocessing import filter_points, nms_numpy, \
+    dbscan_eps, NMS_THRESHOLD, NMS_SIZE
+
+# Name scope of the identity nodes marking the outputs of a frozen graph.
+OUTPUTS_SCOPE = "outputs"
+
+# Graph transforms applied after freezing. Batch norm folding only applies
+# to layers normalizing with moving statistics; layers normalizing with
+# batch statistics are kept as they are.
+TRANSFORMS = [
+    'remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'strip_unused_nodes',
+    'sort_by_execution_order'
+]
+
+
+def build_inference_graph(cfg):
+    """
+    Build the inference-only network selected by cfg.NET in the default
+    graph. PPN outputs are taken before postprocessing (NMS or DBSCAN),
+    which runs in Python and cannot be serialized with the graph.
+    @return: network, dictionary of output tensors
+    """
+    if cfg.NET == 'base':
+        net = basenets[cfg.BASE_NET](cfg=cfg)
+        net.init_placeholders()
+        net.create_architecture(is_training=False)
+        outputs = {
+            'predictions': net._predictions,
+            'scores': net._scores,
+            'softmax': net._softmax
+        }
+    elif cfg.NET == 'ppn':
+        net = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
+        net.init_placeholders()
+        net.create_architecture(is_training=False)
+        outputs = {
+            'im_proposals': net.before_nms,
+            'im_scores': net.before_nms_scores,
+            'im_labels': net.before_nms_labels,
+            'rois': net._predictions['rois']
+        }
+    else:
+        raise Exception("Export is only available for `ppn` and `base` nets.")
+    return net, outputs
+
+
+def export(cfg):
+    """
+    Freeze trained weights into an inference-only GraphDef written to
+    OUTPUT_DIR/frozen_<NET>.pb. Training ops, summaries and debug fetches
+    are stripped and constants are folded.
+    """
+    if not os.path.isdir(cfg.OUTPUT_DIR):
+        os.makedirs(cfg.OUTPUT_DIR)
+
+    net, outputs = build_inference_graph(cfg)
+    output_names = []
+    with tf.name_scope(OUTPUTS_SCOPE):
+        for key in outputs:
+            output_names.append(tf.identity(outputs[key], name=key).op.name)
+    input_names = [net.image_placeholder.op.name]
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        load_weights(cfg, sess)
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, sess.graph.as_graph_def(), output_names)
+    print("Frozen graph: %d nodes" % len(graph_def.node))
+
+    from tensorflow.tools.graph_transforms import TransformGraph
+    graph_def = TransformGraph(graph_def, input_names, output_names,
+                               TRANSFORMS)
+    print("Optimized graph: %d nodes" % len(graph_def.node))
+
+    filename = os.path.join(cfg.OUTPUT_DIR, "frozen_%s.pb" % cfg.NET)
+    with tf.gfile.GFile(filename, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print("Wrote %s" % filename)
+    return filename
+
+
+def load_frozen_graph(filename):
+    """
+    Load a GraphDef written by `export` into a new graph.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    return graph
+
+
+class FrozenNet(object):
+    """
+    Lightweight inference network loaded from a frozen graph.
+    Exposes the same test_image interface as PPN and base networks, so that
+    it can be used in place of them at inference time.
+    """
+    def __init__(self, cfg, filename, config=None):
+        self.cfg = cfg
+        self.graph = load_frozen_graph(filename)
+        placeholders = [op for op in self.graph.get_operations()
+                        if op.type == 'Placeholder']
+        if len(placeholders) != 1:
+            raise Exception("Expected a single input in %s, found %d." %
+                            (filename, len(placeholders)))
+        self.image_placeholder = placeholders[0].outputs[0]
+        self.outputs = {}
+        for op in self.graph.get_operations():
+            if op.name.startswith(OUTPUTS_SCOPE + '/'):
+                self.outputs[op.name.split('/', 1)[1]] = op.outputs[0]
+        self.is_ppn = 'im_proposals' in self.outputs
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def run(self, blob):
+        """
+        Run inference on blob['data'] and apply PPN postprocessing.
+        @return: dictionary of results
+        """
+        keys = sorted(self.outputs)
+        values = self.sess.run([self.outputs[key] for key in keys],
+                               feed_dict={self.image_placeholder: blob['data']})
+        results = dict(zip(keys, values))
+        if self.is_ppn:
+            if self.cfg.POSTPROCESSING == 'nms':
+                _, keep = nms_numpy(results['im_proposals'],
+                                    results['im_scores'],
+                                    NMS_THRESHOLD, NMS_SIZE)
+                keep = np.array(keep, dtype=np.int64)
+                results['im_proposals'] = results['im_proposals'][keep]
+                results['im_scores'] = results['im_scores'][keep]
+            else:
+                results['im_proposals'], results['im_scores'], keep = filter_points(
+                    results['im_proposals'],
+                    results['im_scores'],
+                    dbscan_eps(self.cfg))
+                results['im_labels'] = results['im_labels'][keep]
+        return results
+
+    def test_image(self, sess, blob):
+        """
+        Same signature as the networks test_image. `sess` is ignored, the
+        frozen graph runs in its own session.
+        """
+        return None, self.run(blob)
+
+    def close(self):
+        self.sess.close()
@@ -1,2 +1,2 @@
-from metrics_ppn import PPNMetrics
-from metrics_uresnet import UResNetMetrics
+from faster_particles.metrics.metrics_ppn import PPNMetrics
+from faster_particles.metrics.metrics_uresnet import UResNetMetrics
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class RunningStats(object):
+    """
+    Count, mean, variance, min and max of a series of values, updated by
+    batches and mergeable (Chan et al. parallel algorithm).
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values):
+            mean = values.mean()
+            self.combine(len(values), mean, np.sum((values - mean)**2),
+                         values.min(), values.max())
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    def combine(self, count, mean, m2, vmin, vmax):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+
+class LogHistogram(object):
+    """
+    Histogram with bins of relative width `precision` above `low + scale`
+    (and absolute width scale * precision close to low), so that any range
+    of values fits in a few thousand bins. Each bin keeps the count and the
+    sum of its values: the mean of a bin is exact for discrete values.
+    Values below low are counted in the first bin.
+    """
+    def __init__(self, low=0.0, scale=0.1, precision=1e-3):
+        self.low = low
+        self.scale = scale
+        self.precision = precision
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+
+    def index(self, values):
+        x = np.maximum(values - self.low, 0.0) / self.scale
+        return np.floor(np.log1p(x) / np.log1p(self.precision)).astype(np.int64)
+
+    def resize(self, num_bins):
+        if num_bins > len(self.counts):
+            extra = num_bins - len(self.counts)
+            self.counts = np.concatenate([self.counts, np.zeros(extra, dtype=np.int64)])
+            self.sums = np.concatenate([self.sums, np.zeros(extra)])
+
+    def add(self, values):
+        if not len(values):
+            return
+        indices = self.index(values)
+        self.resize(indices.max() + 1)
+        self.counts += np.bincount(indices, minlength=len(self.counts))
+        self.sums += np.bincount(indices, weights=values, minlength=len(self.sums))
+
+    def merge(self, other):
+        if (self.low, self.scale, self.precision) != (other.low, other.scale, other.precision):
+            raise Exception("Cannot merge histograms with different bins.")
+        self.resize(len(other.counts))
+        self.counts[:len(other.counts)] += other.counts
+        self.sums[:len(other.sums)] += other.sums
+
+
+class StreamingSeries(object):
+    """
+    Constant memory summary of a series of values (one metric), replacing
+    the list of all values: exact count, mean, std, min and max, and a
+    LogHistogram for histograms and percentiles. NaN values are counted
+    separately and otherwise ignored.
+    """
+    def __init__(self, low=0.0, scale=0.1, precision=1e-3):
+        self.stats = RunningStats()
+        self.histogram = LogHistogram(low=low, scale=scale, precision=precision)
+        self.nan = 0
+
+    def __len__(self):
+        return self.stats.count
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        self.nan += len(values) - np.count_nonzero(finite)
+        values = values[finite]
+        self.stats.add(values)
+        self.histogram.add(values)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.histogram.merge(other.histogram)
+        self.nan += other.nan
+
+    def mean(self):
+        return self.stats.mean if self.stats.count else np.nan
+
+    def samples(self):
+        """
+        Returns (values, counts): mean value of each nonempty bin, within
+        [min, max], and its number of values.
+        """
+        nonzero = self.histogram.counts > 0
+        counts = self.histogram.counts[nonzero]
+        values = self.histogram.sums[nonzero] / counts
+        return np.clip(values, self.stats.min, self.stats.max), counts
+
+    def percentile(self, q):
+        if not self.stats.count:
+            return np.nan
+        if q <= 0:
+            return self.stats.min
+        if q >= 100:
+            return self.stats.max
+        values, counts = self.samples()
+        i = np.searchsorted(np.cumsum(counts), q / 100.0 * self.stats.count)
+        return values[min(i, len(values) - 1)]
+
+    def save(self, filename):
+        values, counts = self.samples()
+        header = "value,count (count=%d mean=%g std=%g min=%g max=%g nan=%d)" % (
+            self.stats.count, self.mean(), self.stats.std,
+            self.stats.min, self.stats.max, self.nan)
+        np.savetxt(filename, np.stack([values, counts], axis=1),
+                   delimiter=",", header=header)
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def strictly_below(radius):
+    """
+    KD-tree radius queries include points at distance == radius: the
+    largest float below radius gives the same result as `distance < radius`.
+    """
+    return np.nextafter(radius, 0)
+
+
+class PointMatching(object):
+    """
+    Distances between predicted points (proposals, ROI centers) and ground
+    truth points, with one KD-tree per set instead of the full
+    predicted x ground truth distance matrix.
+    """
+    def __init__(self, predictions, gt):
+        self.predictions = np.asarray(predictions, dtype=np.float64)
+        self.gt = np.asarray(gt, dtype=np.float64)
+        self.predictions_tree = cKDTree(self.predictions)
+        self.gt_tree = cKDTree(self.gt)
+        self.distances_to_closest_gt = self.gt_tree.query(self.predictions)[0]
+        self.distances_to_closest_pred = self.predictions_tree.query(self.gt)[0]
+
+    def count_gt_closer_than(self, radius):
+        """
+        For each predicted point, number of ground truth points at
+        distance < radius.
+        """
+        return self.gt_tree.query_ball_point(self.predictions,
+                                             strictly_below(radius),
+                                             return_length=True)
+
+    def unmatched_predictions(self, radius):
+        """
+        Number of predicted points with no ground truth point within
+        distance <= radius.
+        """
+        return np.count_nonzero(self.distances_to_closest_gt > radius)
+
+    def unmatched_gt(self, radius):
+        """
+        Number of ground truth points with no predicted point within
+        distance <= radius.
+        """
+        return np.count_nonzero(self.distances_to_closest_pred > radius)
+
+
+def count_in_boxes(points, centers, half_size):
+    """
+    For each center, number of points inside the open box of half width
+    half_size around it (max coordinate difference < half_size).
+    """
+    tree = cKDTree(np.asarray(points, dtype=np.float64))
+    return tree.query_ball_point(np.asarray(centers, dtype=np.float64),
+                                 strictly_below(half_size), p=np.inf,
+                                 return_length=True)
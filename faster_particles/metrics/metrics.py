@@ -6,14 +6,40 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import os
+from faster_particles.metrics.accumulators import StreamingSeries
+from faster_particles.metrics.sink import MetricsSink
 
 
 class Metrics(object):
+    """
+    Each metric is a series of values (one per event, ROI, proposal...),
+    stored as a list, or as a constant memory StreamingSeries if
+    cfg.METRICS_STREAMING is set. Metrics are declared with add_series
+    and updated with record.
+
+    If cfg.METRICS_FLUSH > 0, recorded values are also written to a
+    MetricsSink in self.dir/<name> every METRICS_FLUSH events (calls of
+    commit, once all the blobs of an event are added). With
+    cfg.METRICS_RESUME, the values of an existing sink are loaded back
+    and the sink is extended: the caller skips the events already in it
+    (see resume_events).
+    """
+    name = 'metrics'
+
     def __init__(self, cfg):
         self.cfg = cfg
+        self.streaming = cfg.METRICS_STREAMING
+        self.series_kwargs = {}  # name -> bins of declared metrics
         self.dir = os.path.join(cfg.DISPLAY_DIR, 'metrics')
         if not os.path.isdir(self.dir):
             os.makedirs(self.dir)
+        self.sink = None
+        if cfg.METRICS_FLUSH > 0 or cfg.METRICS_RESUME:
+            self.sink = MetricsSink(os.path.join(self.dir, self.name),
+                                    flush_every=cfg.METRICS_FLUSH,
+                                    resume=cfg.METRICS_RESUME)
+            if self.sink.events:
+                print("Resuming %s metrics after %d events" % (self.name, self.sink.events))
 
     def add(self, blob, results):
         raise NotImplementedError
@@ -21,10 +47,112 @@ class Metrics(object):
     def plot(self):
         raise NotImplementedError
 
+    def new_series(self, **kwargs):
+        if self.streaming:
+            return StreamingSeries(**kwargs)
+        return []
+
+    def add_series(self, name, keys=None, **kwargs):
+        """
+        Declare metric `name` (a dict of series if keys is given).
+        kwargs set the histogram bins in streaming mode, see LogHistogram:
+        low is the smallest expected value, scale * precision the bin
+        width close to low.
+        """
+        if keys is None:
+            setattr(self, name, self.new_series(**kwargs))
+        else:
+            setattr(self, name, dict((k, self.new_series(**kwargs)) for k in keys))
+        self.series_kwargs[name] = kwargs
+        if self.sink is not None:
+            for key in ([None] if keys is None else keys):
+                values = self.sink.read(self.sink_name(name, key))
+                if len(values):
+                    self.accumulate(name, values, key=key)
+
+    @staticmethod
+    def sink_name(name, key=None):
+        return name if key is None else "%s_%d" % (name, key)
+
+    def record(self, name, values, key=None):
+        """
+        Add a value or an array of values to metric `name`.
+        """
+        self.accumulate(name, values, key=key)
+        if self.sink is not None:
+            self.sink.add(self.sink_name(name, key), values)
+
+    def commit(self):
+        """
+        End of the values of one event (all its blobs/crops).
+        """
+        if self.sink is not None:
+            self.sink.end_event()
+
+    def flush(self):
+        if self.sink is not None:
+            self.sink.flush()
+
+    def accumulate(self, name, values, key=None):
+        series = getattr(self, name)
+        if key is not None:
+            series = series[key]
+        if isinstance(series, StreamingSeries):
+            series.add(values)
+        elif np.ndim(values) == 0:
+            series.append(values)
+        else:
+            series.extend(values)
+
+    def merge(self, other):
+        """
+        Add the values of other (e.g. computed in another process).
+        """
+        for name in self.series_kwargs:
+            series, other_series = getattr(self, name), getattr(other, name)
+            if isinstance(series, dict):
+                pairs = [(series[k], other_series[k]) for k in series]
+            else:
+                pairs = [(series, other_series)]
+            for s, o in pairs:
+                if isinstance(s, StreamingSeries):
+                    s.merge(o)
+                else:
+                    s.extend(o)
+
+    def reset(self, name):
+        setattr(self, name, self.new_series(**self.series_kwargs[name]))
+
+    def mean(self, name):
+        series = getattr(self, name)
+        if isinstance(series, StreamingSeries):
+            return series.mean()
+        return np.mean(series)
+
+    def percentile(self, name, q):
+        series = getattr(self, name)
+        if isinstance(series, StreamingSeries):
+            return series.percentile(q)
+        return np.percentile(series, q)
+
+    def save(self, series, filename):
+        """
+        Write the values of a series to a CSV file in self.dir. In
+        streaming mode, one row per histogram bin (mean value, count).
+        """
+        filename = os.path.join(self.dir, filename)
+        if isinstance(series, StreamingSeries):
+            series.save(filename)
+        else:
+            np.savetxt(filename, series, delimiter=",")
+
     def make_plot(self, data, bins=None, xlabel="", ylabel="", filename=""):
         """
         If bins is None: discrete histogram
         """
+        weights = None
+        if isinstance(data, StreamingSeries):
+            data, weights = data.samples()
         data = np.array(data)
         if bins is None:
             a = np.diff(np.unique(data))
@@ -36,7 +164,7 @@ class Metrics(object):
             else:
                 bins = 100
 
-        plt.hist(data, bins)
+        plt.hist(data, bins, weights=weights)
         plt.xlabel(xlabel)
         plt.ylabel(ylabel)
         plt.savefig(os.path.join(self.dir, filename))
@@ -7,6 +7,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import sys, os
+from faster_particles.metrics.sink import load_sink
 
 #ppn1_distances_to_closest_gt = np.genfromtxt(os.path.join(directory, "ppn1_distances_to_closest_gt.csv"), delimiter=",")
 #ppn1_distances_to_closest_pred = np.genfromtxt(os.path.join(directory, "ppn1_distances_to_closest_pred.csv"), delimiter=",")
@@ -33,6 +34,12 @@ def make_plot(data_2d, data_3d, bins=None, xlabel="", ylabel="", filename="", li
     plt.gcf().clear()
 
 def load(directory):
+    # Values written during the run (--metrics-flush), if any
+    if os.path.isfile(os.path.join(directory, 'ppn', 'manifest.json')):
+        values = load_sink(os.path.join(directory, 'ppn'))
+        return tuple(values.get(name, np.zeros(0)) for name in [
+            'ppn2_distances_to_closest_gt', 'ppn2_distances_to_closest_pred',
+            'ppn2_false_positives', 'ppn2_false_negatives'])
     ppn2_distances_to_closest_gt = np.genfromtxt(os.path.join(directory, "ppn2_distances_to_closest_gt.csv"), delimiter=",")
     ppn2_distances_to_closest_pred = np.genfromtxt(os.path.join(directory, "ppn2_distances_to_closest_pred.csv"), delimiter=",")
     ppn2_false_positives = np.genfromtxt(os.path.join(directory, "ppn2_false_positives.csv"), delimiter=",")
@@ -6,32 +6,29 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import os
-import scipy
 from faster_particles.display_utils import display_original_image, \
                                             display_im_proposals
 from faster_particles.metrics.metrics import Metrics
+from faster_particles.metrics.matching import PointMatching, count_in_boxes
 
 
 class PPNMetrics(Metrics):
+    name = 'ppn'
+
     def __init__(self, cfg, dim1=8, dim2=4):
         super(PPNMetrics, self).__init__(cfg)
-        self.im_labels = []
-        self.im_scores = []
-        self.im_proposals = []
-        self.ppn1_gt_points_per_roi = []
-        self.ppn1_ratio_gt_points_roi = []
-        self.ppn1_distances_to_closest_gt = []
-        self.ppn1_distances_to_closest_pred = []
-        self.ppn1_ambiguity = []
-        self.ppn1_false_positives = []
-        self.ppn1_false_negatives = []
-        self.ppn1_outliers = []
-        self.ppn2_distances_to_closest_gt = []
-        self.ppn2_distances_to_closest_pred = []
-        self.ppn2_ambiguity = []
-        self.ppn2_false_positives = []
-        self.ppn2_false_negatives = []
-        self.ppn2_outliers = []
+        for name in ['im_labels', 'im_scores', 'ppn1_gt_points_per_roi',
+                     'ppn1_ratio_gt_points_roi',
+                     'ppn1_distances_to_closest_gt',
+                     'ppn1_distances_to_closest_pred', 'ppn1_ambiguity',
+                     'ppn1_false_positives', 'ppn1_false_negatives',
+                     'ppn1_outliers', 'ppn2_distances_to_closest_gt',
+                     'ppn2_distances_to_closest_pred', 'ppn2_ambiguity',
+                     'ppn2_false_positives', 'ppn2_false_negatives',
+                     'ppn2_outliers']:
+            self.add_series(name)
+        # Coordinates of all proposals, not kept in streaming mode
+        self.im_proposals = None if self.streaming else []
 
         self.dim1, self.dim2 = dim1, dim2
         self.threshold_ambiguity = 10
@@ -40,29 +37,28 @@ class PPNMetrics(Metrics):
         self.threshold_outliers = 15
 
     def add(self, blob, results):
-        self.im_labels.extend(results['im_labels'])
-        self.im_scores.extend(results['im_scores'])
-        self.im_proposals.extend(results['im_proposals'])
-        self.ppn1_gt_points_per_roi.extend(self.gt_points_per_roi(blob['gt_pixels'], results['rois']))
-        self.ppn1_ratio_gt_points_roi.append(len(blob['gt_pixels'] / float(len(results['rois']))))
+        self.record('im_labels', results['im_labels'])
+        self.record('im_scores', results['im_scores'])
+        if self.im_proposals is not None:
+            self.im_proposals.extend(results['im_proposals'])
+        self.record('ppn1_gt_points_per_roi', self.gt_points_per_roi(blob['gt_pixels'], results['rois']))
+        self.record('ppn1_ratio_gt_points_roi', len(blob['gt_pixels'] / float(len(results['rois']))))
 
-        # self.distances[i][j] = distance between im_proposals_filtered[j] and blob['gt_pixels'][i]
         gt_pixels = blob['gt_pixels'][:, :-1]
         im_proposals = results['im_proposals']
 
-        distances_ppn2 = scipy.spatial.distance.cdist(im_proposals, gt_pixels)
-        self.ppn2_distances_to_closest_gt.extend(np.amin(distances_ppn2, axis=1))
-        self.ppn2_distances_to_closest_pred.extend(np.amin(distances_ppn2, axis=0))
+        matching_ppn2 = PointMatching(im_proposals, gt_pixels)
+        closest_gt = matching_ppn2.distances_to_closest_gt
+        self.record('ppn2_distances_to_closest_gt', closest_gt)
+        self.record('ppn2_distances_to_closest_pred', matching_ppn2.distances_to_closest_pred)
 
-        self.ppn2_ambiguity.extend(np.count_nonzero(distances_ppn2 < self.threshold_ambiguity, axis=1))
-        self.ppn2_false_positives.append(np.count_nonzero(np.all(distances_ppn2 > self.threshold_false_positive, axis=1)) / im_proposals.shape[0])
-        self.ppn2_false_negatives.append(np.count_nonzero(np.all(distances_ppn2 > self.threshold_false_negative, axis=0)) / gt_pixels.shape[0])
-        self.ppn2_outliers.append(np.count_nonzero(np.all(distances_ppn2 > self.threshold_outliers, axis=1)))
+        self.record('ppn2_ambiguity', matching_ppn2.count_gt_closer_than(self.threshold_ambiguity))
+        self.record('ppn2_false_positives', matching_ppn2.unmatched_predictions(self.threshold_false_positive) / im_proposals.shape[0])
+        self.record('ppn2_false_negatives', matching_ppn2.unmatched_gt(self.threshold_false_negative) / gt_pixels.shape[0])
+        self.record('ppn2_outliers', matching_ppn2.unmatched_predictions(self.threshold_outliers))
 
-        #if np.logical_and(distances_ppn2 > 5, distances_ppn2 < 6).any():
-        #    print(im_proposals_filtered, distances_ppn2)
-        if np.logical_and(np.amin(distances_ppn2, axis=1) > 5, np.amin(distances_ppn2, axis=1) < 10).any():
-            print(im_proposals, np.amin(distances_ppn2, axis=1))
+        if np.logical_and(closest_gt > 5, closest_gt < 10).any():
+            print(im_proposals, closest_gt)
             # --- FIGURE 2 : PPN2 predictions ---
             fig2 = plt.figure()
             ax2 = fig2.add_subplot(111, aspect='equal', projection='3d')
@@ -81,25 +77,26 @@ class PPNMetrics(Metrics):
         # Go back to original coordinates and get center of ROI
         rois = self.dim1 * self.dim2 * rois + self.dim1
 
-        distances_ppn1 = scipy.spatial.distance.cdist(rois, gt_pixels)
-        self.ppn1_distances_to_closest_gt.extend(np.amin(distances_ppn1, axis=0))
-        self.ppn1_distances_to_closest_pred.extend(np.amin(distances_ppn1, axis=1))
-        self.ppn1_ambiguity.extend(np.count_nonzero(distances_ppn1 < self.threshold_ambiguity, axis=1))
+        matching_ppn1 = PointMatching(rois, gt_pixels)
+        self.record('ppn1_distances_to_closest_gt', matching_ppn1.distances_to_closest_pred)
+        self.record('ppn1_distances_to_closest_pred', matching_ppn1.distances_to_closest_gt)
+        self.record('ppn1_ambiguity', matching_ppn1.count_gt_closer_than(self.threshold_ambiguity))
         # FIXME rounding ROI to inner circle of radius self.dim1
-        self.ppn1_false_positives.append(np.count_nonzero(np.all(distances_ppn1 > self.dim1, axis=1)) / rois.shape[0])
-        self.ppn1_false_negatives.append(np.count_nonzero(np.all(distances_ppn1 > self.dim1, axis=0)) / gt_pixels.shape[0])
-        self.ppn1_outliers.append(np.count_nonzero(np.all(distances_ppn1 > self.threshold_outliers, axis=1)))
+        self.record('ppn1_false_positives', matching_ppn1.unmatched_predictions(self.dim1) / rois.shape[0])
+        self.record('ppn1_false_negatives', matching_ppn1.unmatched_gt(self.dim1) / gt_pixels.shape[0])
+        self.record('ppn1_outliers', matching_ppn1.unmatched_predictions(self.threshold_outliers))
 
     def plot(self):
+        self.flush()
         # Save data
-        np.savetxt(os.path.join(self.dir, "ppn1_distances_to_closest_gt.csv"), self.ppn1_distances_to_closest_gt, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn1_distances_to_closest_pred.csv"), self.ppn1_distances_to_closest_pred, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn1_false_positives.csv"), self.ppn1_false_positives, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn1_false_negatives.csv"), self.ppn1_false_negatives, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn2_distances_to_closest_gt.csv"), self.ppn2_distances_to_closest_gt, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn2_distances_to_closest_pred.csv"), self.ppn2_distances_to_closest_pred, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn2_false_positives.csv"), self.ppn2_false_positives, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "ppn2_false_negatives.csv"), self.ppn2_false_negatives, delimiter=",")
+        self.save(self.ppn1_distances_to_closest_gt, "ppn1_distances_to_closest_gt.csv")
+        self.save(self.ppn1_distances_to_closest_pred, "ppn1_distances_to_closest_pred.csv")
+        self.save(self.ppn1_false_positives, "ppn1_false_positives.csv")
+        self.save(self.ppn1_false_negatives, "ppn1_false_negatives.csv")
+        self.save(self.ppn2_distances_to_closest_gt, "ppn2_distances_to_closest_gt.csv")
+        self.save(self.ppn2_distances_to_closest_pred, "ppn2_distances_to_closest_pred.csv")
+        self.save(self.ppn2_false_positives, "ppn2_false_positives.csv")
+        self.save(self.ppn2_false_negatives, "ppn2_false_negatives.csv")
         #self.ppn2_scores()
         self.plot_distances_to_closest_gt()
         self.plot_distances_to_closest_pred()
@@ -110,21 +107,15 @@ class PPNMetrics(Metrics):
         self.plot_gt_points_per_roi()
         self.plot_ratio_gt_points_roi()
         #self.ppn2_distance_to_nearest_neighbour()
-        print("Mean of PPN2 distances to closest gt = ", np.mean(self.ppn2_distances_to_closest_gt))
+        print("Mean of PPN2 distances to closest gt = ", self.mean('ppn2_distances_to_closest_gt'))
 
     def gt_points_per_roi(self, gt_pixels, rois):
-        gt_points_per_roi_list = []
-        for roi in rois:
-            if self.cfg.DATA_3D:
-                x, y, z = roi[2], roi[1], roi[0]
-                x, y, z = x*self.dim1*self.dim2, y*self.dim2*self.dim1, z*self.dim1*self.dim2
-                coords = np.array([x, y, z])
-            else:
-                x, y = roi[1], roi[0]
-                x, y = x*self.dim1*self.dim2, y*self.dim1*self.dim2
-                coords = np.array([x, y])
-            gt_points_per_roi_list.append(np.count_nonzero(np.all(np.absolute(gt_pixels[:, :-1]  - coords) < self.dim1, axis=1)))
-        return gt_points_per_roi_list
+        """
+        Number of ground truth pixels within dim1 of each ROI (all
+        coordinates), ROI coordinates in reverse order.
+        """
+        coords = rois[:, ::-1] * self.dim1 * self.dim2
+        return count_in_boxes(gt_pixels[:, :-1], coords, self.dim1)
 
     def plot_distances_to_closest_gt(self):
         bins = np.linspace(0, 100, 100)
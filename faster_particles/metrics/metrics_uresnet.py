@@ -9,91 +9,125 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 
+def sum_moments(values, chunk_size=2**20):
+    """
+    Sum and sum of squares of a (strided) 1D array, in float64, by chunks
+    to avoid a temporary copy of the whole array.
+    """
+    total, total2 = 0.0, 0.0
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i+chunk_size].astype(np.float64)
+        total += chunk.sum()
+        total2 += np.dot(chunk, chunk)
+    return total, total2
+
+
 class UResNetMetrics(Metrics):
+    name = 'uresnet'
+
     def __init__(self, cfg):
         super(UResNetMetrics, self).__init__(cfg)
-        self.acc_all, self.acc_nonzero = [], []
-        self.label_softmax_mean = []
-        self.label_softmax_std = []
-        self.num_voxels = []
-        self.label_softmax_nonzero_mean = []
-        self.label_softmax_nonzero_std = []
-        self.class_npx, self.class_acc = {}, {}
-        self.class_score_mean, self.class_score_std = {}, {}
-        for class_label in np.arange(self.cfg.NUM_CLASSES):
-            self.class_npx[class_label] = []
-            self.class_acc[class_label] = []
-            self.class_score_mean[class_label] = []
-            self.class_score_std[class_label] = []
+        for name in ['acc_all', 'acc_nonzero', 'label_softmax_mean',
+                     'label_softmax_std', 'num_voxels',
+                     'label_softmax_nonzero_mean',
+                     'label_softmax_nonzero_std']:
+            self.add_series(name)
+        classes = np.arange(self.cfg.NUM_CLASSES)
+        self.add_series('class_npx', keys=classes)
+        # -1 when the class is absent from the image
+        for name in ['class_acc', 'class_score_mean', 'class_score_std']:
+            self.add_series(name, keys=classes, low=-1.0)
         if cfg.DETAIL_LOG:
             self.store_attr = ['acc_all', 'acc_nonzero']
             self.detail_log = {}
             for attr in self.store_attr:
                 self.detail_log[attr] = []
             self.steps = []
+            if self.sink is not None:
+                # Values of previous snapshots are in detail_log
+                self.steps = list(self.sink.read('steps'))
+                for attr in self.store_attr:
+                    self.detail_log[attr] = list(self.sink.read('%s_detail_log' % attr))
+                    self.reset(attr)
 
-    def add(self, blob_original, results):
-        blob = blob_original.copy()
-        blob['labels'] = np.squeeze(blob['labels'])
-        results['predictions'] = np.squeeze(results['predictions'])
-        results['softmax'] = np.squeeze(results['softmax'])
+    def add(self, blob, results):
+        """
+        Only nonzero voxels are visited: predictions and softmax are
+        gathered at the nonzero label coordinates, and background (label
+        0) values are deduced from whole image counts and sums.
+        """
+        num_classes = self.cfg.NUM_CLASSES
+        labels = np.ravel(blob['labels'])
+        predictions = np.ravel(results['predictions'])
+        softmax = np.reshape(results['softmax'], (-1, num_classes))
+        total = labels.size
 
-        acc_all = np.mean(results['predictions'] == blob['labels'])
+        nonzero_px = np.flatnonzero(labels)
+        nonzero_label = labels[nonzero_px].astype(np.int64)
+        nonzero_prediction = predictions[nonzero_px]
+        nonzero_correct = nonzero_prediction == nonzero_label
+        # Softmax score of the true class of each nonzero voxel
+        nonzero_score = softmax[nonzero_px, nonzero_label].astype(np.float64)
+        num_nonzero = len(nonzero_px)
 
-        # Nonzero accuracy
-        nonzero_px = np.where(blob['labels'] > 0)
-        nonzero_prediction = results['predictions'][nonzero_px]
-        nonzero_label = blob['labels'][nonzero_px]
-        acc_nonzero = np.mean(nonzero_prediction == nonzero_label)
+        # Per class pixel count, correct predictions, sum of scores and of
+        # squared scores. Background: whole image minus nonzero voxels.
+        npx = np.bincount(nonzero_label, minlength=num_classes)[:num_classes]
+        correct = np.bincount(nonzero_label[nonzero_correct], minlength=num_classes)[:num_classes]
+        score_sum = np.bincount(nonzero_label, weights=nonzero_score, minlength=num_classes)[:num_classes].astype(np.float64)
+        score_sum2 = np.bincount(nonzero_label, weights=nonzero_score**2, minlength=num_classes)[:num_classes].astype(np.float64)
+        background_sum, background_sum2 = sum_moments(softmax[:, 0])
+        background_score = softmax[nonzero_px, 0].astype(np.float64)
+        npx[0] = total - num_nonzero
+        correct[0] = total - np.count_nonzero(predictions) - np.count_nonzero(nonzero_prediction == 0)
+        score_sum[0] = background_sum - background_score.sum()
+        score_sum2[0] = background_sum2 - np.sum(background_score**2)
 
-        # Softmax average
-        label_softmax = np.zeros_like(blob['labels'])
-        for class_label in np.arange(self.cfg.NUM_CLASSES):
-            class_mask = np.where(blob['labels'] == class_label)
-            class_softmax = results['softmax'][..., class_label]
-            label_softmax[class_mask] = class_softmax[class_mask]
-
-        self.acc_all.append(acc_all)
-        self.label_softmax_mean.append(label_softmax.mean())
-        self.label_softmax_std.append(label_softmax.std())
-        self.num_voxels.append((blob['labels'] > 0).astype(np.int32).sum())
-        self.acc_nonzero.append(acc_nonzero)
-        self.label_softmax_nonzero_mean.append(label_softmax[nonzero_px].mean())
-        self.label_softmax_nonzero_std.append(label_softmax[nonzero_px].std())
-
-        # Class-wise accuracy, mean/std score value
-        for class_label in np.arange(self.cfg.NUM_CLASSES):
-            # Create a mask to select this class
-            class_mask = np.where(blob['labels'] == class_label)
-            # compute pixel count for this class
-            npx = blob['labels'][class_mask].size
-            # If npx > 0 compute class accuracy and softmax score mean/std
+        acc_all = np.sum(correct) / total
+        mean = np.sum(score_sum) / total
+        self.record('acc_all', acc_all)
+        self.record('label_softmax_mean', mean)
+        self.record('label_softmax_std', np.sqrt(max(np.sum(score_sum2) / total - mean**2, 0.0)))
+        self.record('num_voxels', num_nonzero)
+        if num_nonzero:
+            self.record('acc_nonzero', np.mean(nonzero_correct))
+            self.record('label_softmax_nonzero_mean', nonzero_score.mean())
+            self.record('label_softmax_nonzero_std', nonzero_score.std())
+        else:
+            self.record('acc_nonzero', np.nan)
+            self.record('label_softmax_nonzero_mean', np.nan)
+            self.record('label_softmax_nonzero_std', np.nan)
+
+        # Class-wise accuracy, mean/std score value, -1 if class is absent
+        for class_label in np.arange(num_classes):
+            n = npx[class_label]
             class_acc, class_score_mean, class_score_std = -1., -1., -1.
-            if npx:
-                # compute class accuracy
-                class_prediction = results['predictions'][class_mask]
-                class_acc = np.mean(class_prediction == class_label)
-                # compute softmax score mean value
-                class_score = results['softmax'][..., class_label][class_mask]
-                class_score_mean = class_score.mean()
-                class_score_std = class_score.std()
-            self.class_npx[class_label].append(npx)
-            self.class_acc[class_label].append(class_acc)
-            self.class_score_mean[class_label].append(class_score_mean)
-            self.class_score_std[class_label].append(class_score_std)
+            if n:
+                class_acc = correct[class_label] / n
+                class_score_mean = score_sum[class_label] / n
+                class_score_std = np.sqrt(max(score_sum2[class_label] / n - class_score_mean**2, 0.0))
+            self.record('class_npx', n, key=class_label)
+            self.record('class_acc', class_acc, key=class_label)
+            self.record('class_score_mean', class_score_mean, key=class_label)
+            self.record('class_score_std', class_score_std, key=class_label)
 
     def snapshot(self, step):
         self.steps.append(step)
         for attr in self.store_attr:
-            self.detail_log[attr].append(np.mean(getattr(self, attr)))
-            setattr(self, attr, [])
+            self.detail_log[attr].append(self.mean(attr))
+            self.reset(attr)
+        if self.sink is not None:
+            self.sink.add('steps', step)
+            for attr in self.store_attr:
+                self.sink.add('%s_detail_log' % attr, self.detail_log[attr][-1])
+            self.sink.flush()
 
     def plot_snapshot(self):
         indices = np.argsort(self.steps)
         np.savetxt(os.path.join(self.dir, "steps_detail_log.csv"), np.take(self.steps, indices), delimiter=",")
 
         for attr in self.store_attr:
-            np.savetxt(os.path.join(self.dir, "%s_detail_log.csv"), np.take(self.detail_log[attr], indices), delimiter=",")
+            np.savetxt(os.path.join(self.dir, "%s_detail_log.csv" % attr), np.take(self.detail_log[attr], indices), delimiter=",")
             plt.plot(np.take(self.steps, indices), np.take(self.detail_log[attr], indices))
             plt.xlabel("Iterations")
             plt.ylabel("%s" % attr)
@@ -101,19 +135,20 @@ class UResNetMetrics(Metrics):
             plt.gcf().clear()
 
     def plot(self):
+        self.flush()
         # Save data
-        np.savetxt(os.path.join(self.dir, "acc_all.csv"), self.acc_all, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "acc_nonzero.csv"), self.acc_nonzero, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "label_softmax_mean.csv"), self.label_softmax_mean, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "label_softmax_std.csv"), self.label_softmax_std, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "num_voxels.csv"), self.num_voxels, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "label_softmax_nonzero_mean.csv"), self.label_softmax_nonzero_mean, delimiter=",")
-        np.savetxt(os.path.join(self.dir, "label_softmax_nonzero_std.csv"), self.label_softmax_nonzero_std, delimiter=",")
+        self.save(self.acc_all, "acc_all.csv")
+        self.save(self.acc_nonzero, "acc_nonzero.csv")
+        self.save(self.label_softmax_mean, "label_softmax_mean.csv")
+        self.save(self.label_softmax_std, "label_softmax_std.csv")
+        self.save(self.num_voxels, "num_voxels.csv")
+        self.save(self.label_softmax_nonzero_mean, "label_softmax_nonzero_mean.csv")
+        self.save(self.label_softmax_nonzero_std, "label_softmax_nonzero_std.csv")
         for class_label in np.arange(self.cfg.NUM_CLASSES):
-            np.savetxt(os.path.join(self.dir, "class_npx_%d.csv" % class_label), self.class_npx[class_label], delimiter=",")
-            np.savetxt(os.path.join(self.dir, "class_acc_%d.csv" % class_label), self.class_acc[class_label], delimiter=",")
-            np.savetxt(os.path.join(self.dir, "class_score_mean_%d.csv" % class_label), self.class_score_mean[class_label], delimiter=",")
-            np.savetxt(os.path.join(self.dir, "class_score_std_%d.csv" % class_label), self.class_score_std[class_label], delimiter=",")
+            self.save(self.class_npx[class_label], "class_npx_%d.csv" % class_label)
+            self.save(self.class_acc[class_label], "class_acc_%d.csv" % class_label)
+            self.save(self.class_score_mean[class_label], "class_score_mean_%d.csv" % class_label)
+            self.save(self.class_score_std[class_label], "class_score_std_%d.csv" % class_label)
         self.plot_acc_all()
         self.plot_acc_nonzero()
         self.plot_label_softmax_mean()
@@ -125,9 +160,9 @@ class UResNetMetrics(Metrics):
         self.plot_class_acc()
         self.plot_class_score_mean()
         self.plot_class_score_std()
-        print("Min, max and mean accuracy = %f, %f, %f" % (np.amin(self.acc_nonzero), np.amax(self.acc_nonzero), np.mean(self.acc_nonzero)))
-        print("80-percentile = %f" % np.percentile(self.acc_nonzero, 80))
-        print("50-percentile (median) = %f" % np.median(self.acc_nonzero))
+        print("Min, max and mean accuracy = %f, %f, %f" % (self.percentile('acc_nonzero', 0), self.percentile('acc_nonzero', 100), self.mean('acc_nonzero')))
+        print("80-percentile = %f" % self.percentile('acc_nonzero', 80))
+        print("50-percentile (median) = %f" % self.percentile('acc_nonzero', 50))
 
     def plot_acc_all(self):
         self.make_plot(
@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import json
+import os
+import numpy as np
+
+
+class MetricsSink(object):
+    """
+    Append-only binary storage of metric values, written while metrics
+    are computed rather than at the end of a run.
+
+    Values of each metric are buffered and written every flush_every
+    events as a new chunk `<name>_<chunk>.npy`. manifest.json lists the
+    number of events and of chunks per metric; it is replaced atomically
+    after the chunks are written, so that an interrupted run leaves a
+    consistent sink (unlisted chunks are ignored and overwritten).
+    With resume=True an existing sink is extended, otherwise it is
+    cleared.
+    """
+    def __init__(self, directory, flush_every=100, resume=False):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.buffers = {}
+        self.events = 0
+        self.chunks = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = os.path.join(directory, 'manifest.json')
+        if resume and os.path.isfile(manifest):
+            with open(manifest) as f:
+                content = json.load(f)
+            self.events = content['events']
+            self.chunks = content['chunks']
+        else:
+            for filename in glob.glob(os.path.join(directory, '*.npy')) + [manifest]:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    def filename(self, name, chunk):
+        return os.path.join(self.directory, '%s_%06d.npy' % (name, chunk))
+
+    def add(self, name, values):
+        self.buffers.setdefault(name, []).append(np.atleast_1d(values))
+
+    def end_event(self):
+        """
+        Flush every flush_every calls.
+        """
+        self.events += 1
+        if self.flush_every > 0 and self.events % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for name, buffer in self.buffers.items():
+            if not buffer:
+                continue
+            chunk = self.chunks.get(name, 0)
+            filename = self.filename(name, chunk)
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, np.concatenate(buffer))
+            os.rename(filename + '.tmp', filename)
+            self.chunks[name] = chunk + 1
+        self.buffers = {}
+        manifest = os.path.join(self.directory, 'manifest.json')
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump({'events': self.events, 'chunks': self.chunks}, f)
+        os.rename(manifest + '.tmp', manifest)
+
+    def names(self):
+        return sorted(self.chunks.keys())
+
+    def read(self, name):
+        """
+        All flushed values of metric `name`, empty array if none.
+        """
+        chunks = [np.load(self.filename(name, i))
+                  for i in range(self.chunks.get(name, 0))]
+        if not chunks:
+            return np.zeros(0)
+        return np.concatenate(chunks)
+
+
+def resume_events(cfg, names):
+    """
+    Number of events already written to the sinks `names` (e.g. 'ppn',
+    'uresnet') of DISPLAY_DIR/metrics if cfg.METRICS_RESUME, 0 otherwise.
+    """
+    if not cfg.METRICS_RESUME:
+        return 0
+    events = set()
+    for name in names:
+        manifest = os.path.join(cfg.DISPLAY_DIR, 'metrics', name, 'manifest.json')
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                events.add(json.load(f)['events'])
+        else:
+            events.add(0)
+    if len(events) > 1:
+        raise Exception("Metrics sinks were interrupted at different events %s, cannot resume." % sorted(events))
+    return events.pop() if events else 0
+
+
+def load_sink(directory):
+    """
+    Returns a dictionary metric name -> array of all values of the sink
+    in directory.
+    """
+    sink = MetricsSink(directory, resume=True)
+    return dict((name, sink.read(name)) for name in sink.names())
+
+
+def rebuild(cfg):
+    """
+    Rebuild plots and CSV files of the metrics of cfg.DISPLAY_DIR from
+    their sinks, e.g. after an interrupted run.
+    """
+    from faster_particles.metrics import PPNMetrics, UResNetMetrics
+    cfg.METRICS_RESUME = True
+    metrics = []
+    if cfg.NET in ['full', 'base'] and cfg.BASE_NET == 'uresnet':
+        metrics.append(UResNetMetrics(cfg))
+    if cfg.NET in ['full', 'ppn', 'ppn_ext']:
+        metrics.append(PPNMetrics(cfg))
+    for m in metrics:
+        print("%s: %d events" % (type(m).__name__, m.sink.events))
+        m.plot()
+        if cfg.DETAIL_LOG and isinstance(m, UResNetMetrics):
+            m.plot_snapshot()
@@ -12,9 +12,10 @@ import tensorflow.contrib.slim as slim
 
 from faster_particles.ppn_utils import include_gt_pixels, \
     compute_positives_ppn2, compute_positives_ppn1, \
-    assign_gt_pixels, generate_anchors, \
+    assign_gt_pixels, closest_gt_pixels, generate_anchors, \
     predicted_pixels, top_R_pixels, slice_rois, crop_pool_layer
-from faster_particles.ppn_postprocessing import filter_points, nms
+from faster_particles.ppn_postprocessing import filter_points, nms, \
+    dbscan_eps
 from faster_particles.base_net.vgg import VGG
 
 
@@ -131,7 +132,12 @@ class PPN(object):
             self.dim = 3
             self.ppn1_channels, self.ppn2_channels = 16, 16
 
-    def create_architecture(self, is_training=True, reuse=None, scope="ppn"):
+    def create_architecture(self, is_training=True, reuse=None, scope="ppn",
+                            base_layers=None):
+        """
+        base_layers: optional (F3, F5) feature maps of a base network already
+        built on image_placeholder, to share it instead of building a new one.
+        """
         self.is_training = is_training
         self.reuse = reuse
 
@@ -145,10 +151,12 @@ class PPN(object):
                             biases_regularizer=biases_regularizer,
                             biases_initializer=tf.constant_initializer(0.0)):
             # Returns F3 and F5 feature maps
-            net, net2 = self.base_net.build_base_net(
-                self.image_placeholder,
-                is_training=(self.is_training and not self.cfg.FREEZE),
-                reuse=self.reuse)
+            if base_layers is None:
+                base_layers = self.base_net.build_base_net(
+                    self.image_placeholder,
+                    is_training=(self.is_training and not self.cfg.FREEZE),
+                    reuse=self.reuse)
+            net, net2 = base_layers
             self.intermediate_layer = net
             self.last_layer = net2
             with tf.variable_scope(scope, reuse=self.reuse):
@@ -201,6 +209,8 @@ class PPN(object):
                     # im_labels = tf.gather_nd(im_labels, keep, name="im_labels")
                     im_scores = tf.gather_nd(im_scores, keep, name="im_scores")
                     self.before_nms = im_proposals
+                    self.before_nms_scores = im_scores
+                    self.before_nms_labels = im_labels
                     # Postprocessing of proposals
                     if self.cfg.POSTPROCESSING == 'nms':  # Pixel NMS equivalent
                         im_proposals, keep = nms(im_proposals, im_scores)
@@ -213,7 +223,7 @@ class PPN(object):
                             filter_points,
                             [im_proposals,
                              im_scores,
-                             15.0 if self.cfg.DATA_3D else 20.0],
+                             dbscan_eps(self.cfg)],
                             [tf.float32, tf.float32, tf.int64])
                         im_labels = tf.gather(im_labels, keep)
 
@@ -222,14 +232,10 @@ class PPN(object):
                     self._predictions['im_scores'] = im_scores
 
                 if self.is_training:
-                    distances = tf.zeros((tf.shape(im_proposals)[0], tf.shape(self.gt_pixels_placeholder)[0]))
-                    for i in range(self.dim):
-                        x1, x2 = tf.meshgrid(self.gt_pixels_placeholder[:, i], im_proposals[:, i])
-                        distances = distances + tf.pow(x1 - x2, 2)
-                    distances = tf.sqrt(distances, name="final_distances")
-                    closest_distance = tf.reduce_min(distances,
-                                                     axis=1,
-                                                     name="final_closest_distance")
+                    _, closest_distance = closest_gt_pixels(
+                        im_proposals, self.get_gt_pixels())
+                    closest_distance = tf.identity(
+                        closest_distance[:, 0], name="final_closest_distance")
                     # Final loss for points: mean for all proposed points of distance to closest gt point
                     self._losses['distance_final_point'] = tf.reduce_mean(tf.reduce_mean(closest_distance), name="distance_final_point")
 
@@ -3,13 +3,27 @@
 
 import numpy as np
 import tensorflow as tf
-from sklearn.cluster import DBSCAN
 
+from faster_particles.profiler.stages import timer
 
+# Postprocessing parameters, shared by the PPN graph and frozen graphs
+# (see export.FrozenNet) which apply it outside of the graph.
+NMS_THRESHOLD = 0.01  # Maximal IoU between kept proposals
+NMS_SIZE = 6.0  # Half width of the box around each proposal
+DBSCAN_EPS_2D = 20.0
+DBSCAN_EPS_3D = 15.0
+
+
+def dbscan_eps(cfg):
+    return DBSCAN_EPS_3D if cfg.DATA_3D else DBSCAN_EPS_2D
+
+
+@timer.timed('dbscan_postprocessing')
 def filter_points(im_proposals, im_scores, eps):
     """
     DBSCAN postprocessing on point proposals.
     """
+    from sklearn.cluster import DBSCAN
     db = DBSCAN(eps=eps, min_samples=1).fit_predict(im_proposals)
     index = {}
     new_proposals = []
@@ -49,7 +63,7 @@ def nms_step(order, areas, proposals, new_proposals, keep, threshold, size, *arg
     return (new_order, areas, proposals, new_proposals, keep, threshold, size) + args
 
 
-def nms2(im_proposals, im_scores, threshold=0.01, size=6.0):
+def nms2(im_proposals, im_scores, threshold=NMS_THRESHOLD, size=NMS_SIZE):
     """
     Performs NMS (non maximal suppression) postprocessing on proposed pixels.
     - Look at pixels in order of decreasing score
@@ -117,5 +131,5 @@ def nms_numpy(im_proposals, im_scores, threshold, size):
     return im_proposals, keep
 
 
-def nms(im_proposals, im_scores, threshold=0.01, size=6.0):
+def nms(im_proposals, im_scores, threshold=NMS_THRESHOLD, size=NMS_SIZE):
     return tf.py_func(nms_numpy, [im_proposals, im_scores, threshold, size], (tf.float32, tf.int64))
@@ -10,6 +10,10 @@ def crop(patch_centers, N, data, use_smear=False, return_labels=True):
     Slice patches of size N centered at patch_centers in data.
     Assumes data has shape (1, M, M, M, channels)
     or (1, M, M, channels)
+    Patches are clipped to the image and zero-padded (at the beginning of
+    an axis if the patch starts at 0, at the end otherwise).
+    Labels are 1 for nonzero voxels, 2 for nonzero voxels in the 3x3(x3)
+    window around the center of the patch.
     """
     coords0 = np.floor(patch_centers - N/2.0)  # bottom left corner
     coords1 = np.floor(patch_centers + N/2.0)  # top right corner
@@ -18,53 +22,31 @@ def crop(patch_centers, N, data, use_smear=False, return_labels=True):
     image_size = data.shape[1]
     coords0 = np.clip(coords0 + smear, 0, image_size).astype(int)
     coords1 = np.clip(coords1 + smear, 0, image_size).astype(int)
-    crops = np.zeros((coords0.shape[0],) + (N,) * dim + (data.shape[-1],))
+    num_crops = coords0.shape[0]
+
+    # Index of each voxel of the patches in data, along each axis.
+    # Padding goes at the beginning of an axis if the patch starts at 0.
+    start = np.where(coords0 == 0, coords1 - N, coords0)
+    indices, valid = [], np.ones((num_crops,) + (N,) * dim, dtype=bool)
+    for d in range(dim):
+        shape = [num_crops] + [1] * dim
+        shape[d + 1] = N
+        index = np.reshape(start[:, d, np.newaxis] + np.arange(N), shape)
+        valid &= (index >= np.reshape(coords0[:, d], [-1] + [1] * dim)) & \
+            (index < np.reshape(coords1[:, d], [-1] + [1] * dim))
+        indices.append(np.clip(index, 0, image_size - 1))
+    crops = np.where(valid[..., np.newaxis], data[0][tuple(indices)], 0)
+    crops = crops.astype(np.float64)
+
     crops_labels = np.zeros_like(crops)
-    for j in range(len(coords0)):
-        padding = []
-        for d in range(dim):
-            pad = np.maximum(N - (coords1[j, d] - coords0[j, d]), 0)
-            if coords0[j, d] == 0.0:
-                padding.append((pad, 0))
-            else:
-                padding.append((0, pad))
-        padding.append((0, 0))
-        if dim == 2:
-            crops[j] = np.pad(data[0,
-                                   coords0[j, 0]:coords1[j, 0],
-                                   coords0[j, 1]:coords1[j, 1],
-                                   :],
-                              padding, 'constant')
-        else:  # dim == 3
-            crops[j] = np.pad(data[0,
-                                   coords0[j, 0]:coords1[j, 0],
-                                   coords0[j, 1]:coords1[j, 1],
-                                   coords0[j, 2]:coords1[j, 2],
-                                   :],
-                              padding, 'constant')
-        if return_labels:
-            indices = np.where(crops[j] > 0)
-            # FIXME check that crop_labels still works with batch size
-            crops_labels[j][indices] = 1
-            # Define vertex window to be 3x3
-            if dim == 2:
-                indices = np.where(crops[j,
-                                         int(N/2-1-smear[0]):int(N/2+2-smear[0]),
-                                         int(N/2-1-smear[1]):int(N/2+2-smear[1]),
-                                         :] > 0)
-                a = indices[1] + int(N/2 - 1-smear[0])
-                b = indices[2] + int(N/2 - 1-smear[1])
-                crops_labels[j][a, b, indices[3]] = 2
-            else:
-                indices = np.where(crops[j,
-                                         int(N/2-1-smear[0]):int(N/2+2-smear[0]),
-                                         int(N/2-1-smear[1]):int(N/2+2-smear[1]),
-                                         int(N/2-1-smear[2]):int(N/2+2-smear[2]),
-                                         :] > 0)
-                a = indices[0] + int(N/2 - 1-smear[0])
-                b = indices[1] + int(N/2 - 1-smear[1])
-                c = indices[2] + int(N/2 - 1-smear[2])
-                crops_labels[j][a, b, c, indices[3]] = 2
+    if return_labels:
+        # FIXME check that crop_labels still works with batch size
+        crops_labels[crops > 0] = 1
+        # Define vertex window to be 3x3
+        window = (slice(None),) + tuple(
+            slice(int(N/2-1-smear[d]), int(N/2+2-smear[d])) for d in range(dim))
+        vertex_labels = crops_labels[window]
+        vertex_labels[crops[window] > 0] = 2
     return crops, crops_labels
 
 
@@ -75,9 +57,12 @@ def generate_anchors(im_shape, repeat=1):
     """
     with tf.variable_scope("generate_anchors"):
         dim = len(im_shape)  # 2D or 3D
-        anchors = np.indices(im_shape).transpose(tuple(range(1, dim+1)) + (0,))
-        anchors = anchors + 0.5
-        anchors = tf.reshape(tf.constant(anchors, dtype=tf.float32), (-1, dim))
+        # Built from ranges rather than a constant so that the graph size
+        # does not depend on the feature map size.
+        grid = tf.meshgrid(*[tf.range(n, dtype=tf.float32) for n in im_shape],
+                           indexing='ij')
+        anchors = tf.stack(grid, axis=-1) + 0.5
+        anchors = tf.reshape(anchors, (-1, dim))
         return tf.tile(anchors, tf.stack([repeat, 1]), name="anchors")
 
 
@@ -265,6 +250,50 @@ def compute_positives_ppn2(closest_gt_distance, threshold=2):
         return mask
 
 
+def closest_gt_pixels(points, gt_pixels, chunk_size=256):
+    """
+    points shape: [P, dim], gt_pixels shape: [G, dim]
+    For each point, find the index of and distance to the closest gt pixel.
+    Distances are computed against blocks of at most chunk_size gt pixels at
+    a time while keeping a running argmin, so that memory grows like
+    P * chunk_size instead of P * G. The returned distance is recomputed from
+    the selected gt pixel only, which keeps gradients (and values) identical
+    to a full pairwise reduce_min.
+    Returns closest (shape [P], int64) and distance (shape [P, 1])
+    """
+    with tf.variable_scope("closest_gt_pixels"):
+        nb_gt = tf.shape(gt_pixels)[0]
+        search_points = tf.expand_dims(tf.stop_gradient(points), axis=1)
+        search_gt = tf.stop_gradient(gt_pixels)
+
+        def cond(start, best_distance, best_index):
+            return start < nb_gt
+
+        def body(start, best_distance, best_index):
+            chunk = tf.expand_dims(search_gt[start:start+chunk_size], axis=0)
+            # Squared distances, shape [P, chunk_size]
+            distances = tf.reduce_sum(tf.pow(search_points - chunk, 2), axis=2)
+            chunk_distance = tf.reduce_min(distances, axis=1)
+            chunk_index = tf.argmin(distances, axis=1) + tf.cast(start, tf.int64)
+            # Strict comparison: on ties the earliest gt pixel wins, as argmin
+            closer = tf.less(chunk_distance, best_distance)
+            return (start + chunk_size,
+                    tf.where(closer, chunk_distance, best_distance),
+                    tf.where(closer, chunk_index, best_index))
+
+        _, _, closest = tf.while_loop(
+            cond, body,
+            [tf.constant(0),
+             tf.ones_like(points[:, 0]) * np.inf,
+             tf.zeros_like(points[:, 0], dtype=tf.int64)],
+            back_prop=False)
+        closest = tf.identity(closest, name="closest_gt")
+        distance = tf.sqrt(tf.reduce_sum(
+            tf.pow(points - tf.gather(gt_pixels, closest), 2),
+            axis=1, keepdims=True))
+        return closest, distance
+
+
 def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None):
     """
     Proposals shape: [A*N*N, 2] (N=16 or 64)
@@ -277,7 +306,6 @@ def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None):
     with tf.variable_scope("assign_gt_pixels"):
         dim = proposals.get_shape().as_list()[-1]
         gt_pixels = tf.slice(gt_pixels_placeholder, [0, 0], [-1, dim])
-        gt_pixels = tf.expand_dims(gt_pixels, axis=0)
         # convert proposals to real image coordinates in order to compare with
         # ground truth pixels coordinates
         if rois is not None:  # means PPN2
@@ -287,30 +315,15 @@ def assign_gt_pixels(gt_pixels_placeholder, proposals, dim1, dim2, rois=None):
             # Convert from F5 coordinates
             proposals = proposals * dim1 * dim2
 
-        # Tile to have shape (A*N*N, None, 2)
-        all_gt_pixels = tf.tile(gt_pixels, tf.stack([tf.shape(proposals)[0], 1, 1]))
-        # assert all_gt_pixels.get_shape().as_list() == [None, None, dim]
-        # Reshape proposals to [A*N*N, 1, 2]
-        proposals = tf.expand_dims(proposals, axis=1)
-        distances = tf.sqrt(tf.reduce_sum(tf.pow(proposals - all_gt_pixels, 2), axis=2))
-        # distances.shape = [A*N*N, None]
-        #if rois is not None:
-        #   distances = distances + tf.scatter_nd(tf.cast(tf.where(all_gt_pixels_mask), tf.int32), tf.fill((tf.shape(tf.where(all_gt_pixels_mask))[0],), 10000.0), tf.shape(all_gt_pixels_mask))
-
         # closest_gt.shape = [A*N*N,]
         # closest_gt[i] = indice of closest gt in gt_pixels_placeholder
-        closest_gt = tf.argmin(distances, axis=1)
-        closest_gt_distance = tf.reduce_min(distances, axis=1, keepdims=True,
-                                            name="closest_gt_distance")
+        closest_gt, closest_gt_distance = closest_gt_pixels(proposals,
+                                                            gt_pixels)
+        closest_gt_distance = tf.identity(closest_gt_distance,
+                                          name="closest_gt_distance")
         gt_pixels_labels = tf.slice(gt_pixels_placeholder, [0, dim], [-1, 1])
-        closest_gt_label = tf.reshape(tf.gather_nd(
-            gt_pixels_labels,
-            tf.concat([tf.reshape(
-                tf.range(0, tf.shape(closest_gt_distance)[0]),
-                (-1, 1)),
-                       tf.cast(tf.reshape(closest_gt, (-1, 1)), tf.int32)],
-                      axis=1)
-            ), (-1, 1), name="closest_gt_label")
+        closest_gt_label = tf.reshape(tf.gather(gt_pixels_labels, closest_gt),
+                                      (-1, 1), name="closest_gt_label")
         return closest_gt, closest_gt_distance, closest_gt_label
 
 
@@ -7,7 +7,6 @@ from __future__ import print_function
 
 import numpy as np
 import tensorflow as tf
-from tensorflow.python.client import timeline
 import os
 import glob
 import time
@@ -18,10 +17,9 @@ from faster_particles.ppn import PPN
 from faster_particles.base_net.uresnet import UResNet
 from faster_particles.base_net import basenets
 from faster_particles.metrics import PPNMetrics, UResNetMetrics
-from faster_particles.data import ToydataGenerator, LarcvGenerator, \
-                                HDF5Generator, CSVGenerator
 from faster_particles.cropping import cropping_algorithms
 from faster_particles.demo_ppn import get_data, load_weights
+from faster_particles.profiler.tracing import TraceHook, traced
 
 
 def test_cropping(cfg):
@@ -59,16 +57,10 @@ def main(cfg):
 
     net.init_placeholders()
     net.create_architecture(is_training=True)
-    duration = 0
+    # Durations of the untraced runs only, tracing slows runs down
+    durations = []
 
-    if cfg.PROFILE:
-        print('WARNING PROFILING ENABLED')
-        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-        # print(getargspec(self.sess.run))
-        run_metadata = tf.RunMetadata()
-        old_run = tf.Session.run
-        new_run = lambda self, fetches, feed_dict=None: old_run(self, fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
-        tf.Session.run = new_run
+    trace_hook = TraceHook.from_config(cfg)
 
     crop_algorithm = cropping_algorithms[cfg.CROP_ALGO](cfg)
     with tf.Session() as sess:
@@ -103,40 +95,19 @@ def main(cfg):
                 # _ = sess.run([net.before_nms], feed_dict=feed_dict)
                 # _ = sess.run([net.after_nms], feed_dict=feed_dict)
                 # _ = sess.run([net._predictions['im_proposals']], feed_dict=feed_dict)
-                _ = sess.run([net.train_op], feed_dict=feed_dict)
+                _ = traced(sess, trace_hook).run([net.train_op], feed_dict=feed_dict)
                 end = time.time()
-                duration += end - start
-
-    if cfg.PROFILE:
-        # Create the Timeline object, and write it to a json
-        tl = timeline.Timeline(run_metadata.step_stats)
-        ctf = tl.generate_chrome_trace_format()
-        with open(cfg.PROFILE_NAME, 'w') as f:
-            f.write(ctf)
-            print("Wrote timeline to %s" % cfg.PROFILE_NAME)
-
-        # Print to stdout an analysis of the memory usage and the timing information
-        # broken down by python codes.
-        ProfileOptionBuilder = tf.profiler.ProfileOptionBuilder
-        opts = ProfileOptionBuilder(ProfileOptionBuilder.time_and_memory()
-            ).with_node_names(show_name_regexes=['.*uresnet.*']).build()
-
-        tf.profiler.profile(
-            tf.get_default_graph(),
-            run_meta=run_metadata,
-            cmd='code',
-            options=opts)
-
-        # Print to stdout an analysis of the memory usage and the timing information
-        # broken down by operation types.
-        tf.profiler.profile(
-            tf.get_default_graph(),
-            run_meta=run_metadata,
-            cmd='op',
-            options=tf.profiler.ProfileOptionBuilder.time_and_memory())
-
-    duration /= cfg.MAX_STEPS
-    print("Average duration of inference = %f ms" % duration)
+                if trace_hook is None or trace_hook.run_metadata is None:
+                    durations.append(end - start)
+
+    if trace_hook is not None:
+        trace_hook.report()
+
+    if durations:
+        print("Average duration of inference = %f ms (%d untraced runs)"
+              % (1000.0 * np.mean(durations), len(durations)))
+    else:
+        print("Every run was traced, no inference duration to report.")
 
 
 if __name__ == '__main__':
@@ -194,7 +165,7 @@ if __name__ == '__main__':
         NET = 'base'
         ENABLE_CROP = False
         SLICE_SIZE = 64
-        MAX_STEPS = 1
+        MAX_STEPS = 10
         CROP_ALGO = 'proba'
         DISPLAY_DIR = 'display/profile'
         OUTPUT_DIR = 'output/profile'
@@ -217,7 +188,11 @@ if __name__ == '__main__':
         PPN1_INDEX = 3
         NUM_STRIDES = 5
         PROFILE = True
-        PROFILE_NAME = 'timeline_uresnet_memory.json'
+        PROFILE_TIMELINE = 'timeline_uresnet_memory.json'
+        PROFILE_EVERY = 5
+        PROFILE_START = None
+        PROFILE_STOP = None
+        PROFILE_DIR = 'log/profile'
         NEXT_INDEX = 0
         BATCH_SIZE = 1
         R = 20
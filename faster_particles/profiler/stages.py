@@ -0,0 +1,134 @@
+# *-* encoding: utf-8 *-*
+# Always-on wall time instrumentation of the stages of a step
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+
+class StageTimer(object):
+    """
+    Registry of wall time counters, one per stage name: number of calls,
+    total and max duration since the last write. Stages can be nested
+    (e.g. voxel_extraction happens inside display), so their totals may
+    add up to more than the wall time of a step.
+
+    Usage:
+        with timer.stage('data'):
+            blob = data.forward()
+        ...
+        timer.write(step, filename, summary_writer)
+    """
+    def __init__(self):
+        self.stages = {}
+        self.start = default_timer()
+
+    def add(self, name, duration):
+        counter = self.stages.get(name)
+        if counter is None:
+            self.stages[name] = [1, duration, duration]
+        else:
+            counter[0] += 1
+            counter[1] += duration
+            if duration > counter[2]:
+                counter[2] = duration
+
+    @contextmanager
+    def stage(self, name):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add(name, default_timer() - start)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as stage name.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                start = default_timer()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.add(name, default_timer() - start)
+            return wrapper
+        return decorator
+
+    def iterate(self, name, iterable):
+        """
+        Iterate over iterable, timing each step of the iteration (e.g. a
+        generator building batches) as stage name.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, default_timer() - start)
+            yield item
+
+    def reset(self):
+        self.stages = {}
+        self.start = default_timer()
+
+    def summary(self):
+        """
+        Counters since the last write (durations in seconds).
+        """
+        return {
+            'wall': default_timer() - self.start,
+            'stages': dict((name, {'count': c[0],
+                                   'total': c[1],
+                                   'mean': c[1] / c[0],
+                                   'max': c[2]})
+                           for name, c in self.stages.items())
+        }
+
+    def write(self, step, filename=None, summary_writer=None, reset=True):
+        """
+        Append the counters to filename as one JSON line and/or add them
+        to a Tensorflow summary writer as timing/<stage> scalars (total
+        seconds since the last write), then reset them.
+        """
+        summary = self.summary()
+        summary['step'] = step
+        if filename is not None:
+            with open(filename, 'a') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
+        if summary_writer is not None and 'tensorflow' in sys.modules:
+            tf = sys.modules['tensorflow']
+            values = [tf.Summary.Value(tag='timing/%s' % name,
+                                       simple_value=s['total'])
+                      for name, s in summary['stages'].items()]
+            values.append(tf.Summary.Value(tag='timing/wall',
+                                           simple_value=summary['wall']))
+            summary_writer.add_summary(tf.Summary(value=values), step)
+        if reset:
+            self.reset()
+        return summary
+
+    def report(self):
+        """
+        Print the share of wall time spent in each stage since the last
+        write.
+        """
+        summary = self.summary()
+        print("%-20s %8s %10s %10s %7s" % ('stage', 'count', 'total (s)', 'mean (ms)', 'wall %'))
+        for name, s in sorted(summary['stages'].items(), key=lambda x: -x[1]['total']):
+            print("%-20s %8d %10.3f %10.3f %6.1f%%" % (
+                name, s['count'], s['total'], s['mean'] * 1000.0,
+                100.0 * s['total'] / summary['wall']))
+
+
+# Default registry shared by all modules
+timer = StageTimer()
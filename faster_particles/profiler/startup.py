@@ -0,0 +1,79 @@
+# *-* encoding: utf-8 *-*
+# Cold start benchmark of the ppn command line
+# Usage: python -m faster_particles.profiler.startup [-r 5] [-importtime]
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import subprocess
+import sys
+import time
+import numpy as np
+
+from faster_particles.config import COMMANDS
+
+# Each case runs in a fresh interpreter: `ppn --help`, and for subcommands
+# the time until their function is ready to be called, i.e. what every run
+# pays before doing any work.
+CASES = {
+    'help': "import sys; sys.argv = ['ppn', '--help']; "
+            "from faster_particles.bin.ppn import main; main()",
+    'train': "from faster_particles.config import PPNConfig, load_function; "
+             "PPNConfig(); load_function(%r)" % COMMANDS['train'],
+    'demo': "from faster_particles.config import PPNConfig, load_function; "
+            "PPNConfig(); load_function(%r)" % COMMANDS['demo']
+}
+
+
+def run(code, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', code]
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    duration = time.time() - start
+    if process.returncode != 0:
+        print(err.decode('utf-8', 'replace'))
+        raise Exception("Command failed: %s" % code)
+    return duration, err.decode('utf-8', 'replace')
+
+
+def slowest_imports(err, num=10):
+    """
+    Parse the output of `python -X importtime` (Python >= 3.7) and return
+    the num top-level imports with the largest cumulative time.
+    """
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Top-level imports are not indented
+        if cumulative.strip().isdigit() and not name[1:].startswith(' '):
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:num]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark of ppn")
+    parser.add_argument("-r", "--repeat", default=5, type=int, help="Number of runs per case.")
+    parser.add_argument("-c", "--cases", nargs='+', default=sorted(CASES), choices=sorted(CASES), help="Cases to run.")
+    parser.add_argument("-importtime", "--importtime", action='store_true', help="List the slowest imports of each case.")
+    args = parser.parse_args()
+
+    for case in args.cases:
+        durations = [run(CASES[case])[0] for _ in range(args.repeat)]
+        print("%-8s min = %.3f s  mean = %.3f s  (%d runs)" % (
+            case, np.min(durations), np.mean(durations), args.repeat))
+        if args.importtime:
+            _, err = run(CASES[case], importtime=True)
+            for duration, name in slowest_imports(err):
+                print("    %.3f s  %s" % (duration, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# *-* encoding: utf-8 *-*
+# Sampled Tensorflow tracing of session runs
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# Ops are attributed to the first of these variable scopes found in their
+# name, `other` otherwise. Gradients get a `/gradients` suffix.
+SCOPES = ['final_proposals', 'ppn1', 'ppn2', 'uresnet', 'vgg_16']
+
+
+def get_scope(node_name):
+    components = node_name.split('/')
+    for scope in SCOPES:
+        if scope in components:
+            if 'gradients' in components:
+                return scope + '/gradients'
+            return scope
+    return 'other'
+
+
+def get_devices(step_stats):
+    """
+    On GPU, kernel times are in the `stream:all` device while the GPU
+    device itself only holds launch times: keep stream:all and CPU devices.
+    """
+    devices = [d for d in step_stats.dev_stats]
+    if any('stream:all' in d.device for d in devices):
+        devices = [d for d in devices if 'stream:all' in d.device
+                   or ('gpu' not in d.device.lower() and 'memcpy' not in d.device)]
+    return devices
+
+
+class TraceHook(object):
+    """
+    Decides which session runs are traced (every `every` runs and/or the
+    runs in [start, stop)), writes one Chrome timeline per traced run and
+    aggregates op-level time and output memory over all traced runs, per
+    op and per scope (see SCOPES).
+    """
+    def __init__(self, directory, every=0, start=None, stop=None,
+                 prefix='timeline'):
+        self.directory = directory
+        self.every = every
+        self.start = start
+        self.stop = stop
+        self.prefix = prefix
+        self.step = -1
+        self.traced_steps = []
+        self.run_metadata = None  # of the last run if it was traced
+        self.ops = {}  # name -> [count, micros, bytes]
+        self.scopes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """
+        Hook configured by cfg.PROFILE_EVERY, cfg.PROFILE_START,
+        cfg.PROFILE_STOP and cfg.PROFILE_DIR, or None if profiling is
+        disabled (cfg.PROFILE).
+        """
+        if not cfg.PROFILE:
+            return None
+        print('WARNING PROFILING ENABLED')
+        directory = cfg.PROFILE_DIR
+        if directory is None:
+            directory = os.path.join(cfg.LOG_DIR, 'profile')
+        return cls(directory, every=cfg.PROFILE_EVERY,
+                   start=cfg.PROFILE_START, stop=cfg.PROFILE_STOP,
+                   prefix=os.path.splitext(cfg.PROFILE_TIMELINE)[0])
+
+    def should_trace(self, step):
+        in_window = (self.start is not None or self.stop is not None) \
+            and (self.start is None or step >= self.start) \
+            and (self.stop is None or step < self.stop)
+        sampled = self.every > 0 and step % self.every == 0
+        return in_window or sampled
+
+    def run(self, sess, fetches, feed_dict=None, options=None,
+            run_metadata=None):
+        """
+        sess.run, with a full trace if this step is traced: the caller's
+        options are kept (on a copy) with trace_level set to FULL_TRACE, and
+        the trace is written to the caller's run_metadata if given.
+        """
+        self.step += 1
+        self.run_metadata = None
+        if not self.should_trace(self.step):
+            return sess.run(fetches, feed_dict=feed_dict, options=options,
+                            run_metadata=run_metadata)
+        traced_options = tf.RunOptions()
+        if options is not None:
+            traced_options.CopyFrom(options)
+        traced_options.trace_level = tf.RunOptions.FULL_TRACE
+        self.run_metadata = tf.RunMetadata() if run_metadata is None \
+            else run_metadata
+        results = sess.run(fetches, feed_dict=feed_dict,
+                           options=traced_options,
+                           run_metadata=self.run_metadata)
+        self.add(self.step, self.run_metadata)
+        return results
+
+    def add(self, step, run_metadata):
+        self.traced_steps.append(step)
+        tl = timeline.Timeline(run_metadata.step_stats)
+        filename = os.path.join(self.directory,
+                                '%s_%d.json' % (self.prefix, step))
+        with open(filename, 'w') as f:
+            f.write(tl.generate_chrome_trace_format())
+
+        for device in get_devices(run_metadata.step_stats):
+            for node in device.node_stats:
+                name = node.node_name.split(':')[0]
+                micros = node.op_end_rel_micros - node.op_start_rel_micros
+                if micros <= 0:
+                    micros = node.all_end_rel_micros
+                memory = sum(output.tensor_description.allocation_description.requested_bytes
+                             for output in node.output)
+                for registry, key in [(self.ops, name),
+                                      (self.scopes, get_scope(name))]:
+                    counter = registry.setdefault(key, [0, 0, 0])
+                    counter[0] += 1
+                    counter[1] += micros
+                    counter[2] += memory
+
+    def summary(self, num_ops=30):
+        """
+        Mean time (ms) and output memory (MB) per traced run, per scope and
+        for the num_ops most expensive ops.
+        """
+        n = max(len(self.traced_steps), 1)
+
+        def row(c):
+            return {'count': c[0] / n, 'ms': c[1] / 1000.0 / n,
+                    'MB': c[2] / 1e6 / n}
+        ops = sorted(self.ops.items(), key=lambda x: -x[1][1])[:num_ops]
+        return {
+            'traced_steps': self.traced_steps,
+            'scopes': dict((k, row(c)) for k, c in self.scopes.items()),
+            'ops': [dict(name=k, **row(c)) for k, c in ops]
+        }
+
+    def report(self, filename=None):
+        """
+        Print the per-scope breakdown and write the summary as JSON.
+        """
+        if not self.traced_steps:
+            print("No traced step.")
+            return
+        summary = self.summary()
+        total = sum(s['ms'] for s in summary['scopes'].values())
+        print("Traced %d steps, timelines in %s" % (len(self.traced_steps), self.directory))
+        print("%-28s %10s %7s %10s" % ('scope', 'ms/step', '%', 'MB/step'))
+        for scope, s in sorted(summary['scopes'].items(), key=lambda x: -x[1]['ms']):
+            print("%-28s %10.2f %6.1f%% %10.2f" % (scope, s['ms'], 100.0 * s['ms'] / total, s['MB']))
+        if filename is None:
+            filename = os.path.join(self.directory, '%s_summary.json' % self.prefix)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print("Wrote %s" % filename)
+
+
+class TracedSession(object):
+    """
+    Wraps a tf.Session so that its run calls go through a TraceHook. Only
+    the code given this object is traced, other sessions are untouched.
+    """
+    def __init__(self, sess, hook):
+        self._sess = sess
+        self._hook = hook
+
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        return self._hook.run(self._sess, fetches, feed_dict=feed_dict,
+                              options=options, run_metadata=run_metadata)
+
+    def __getattr__(self, name):
+        return getattr(self._sess, name)
+
+
+def traced(sess, hook):
+    """
+    sess wrapped by hook, or sess itself if hook is None (no profiling).
+    """
+    return sess if hook is None else TracedSession(sess, hook)
@@ -0,0 +1,324 @@
+# *-* encoding: utf-8 *-*
+# Local inference server batching incoming events
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import threading
+import time
+import numpy as np
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request as HTTPRequest, urlopen
+except ImportError:  # Python 2
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request as HTTPRequest, urlopen
+
+
+class ServerStats(object):
+    """
+    Thread-safe counters for the stats endpoint: number of requests,
+    batch size distribution and latency percentiles over the last
+    `window` requests.
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = dict(self.batch_sizes)
+            requests, errors = self.requests, self.errors
+        p50, p99 = (np.percentile(latencies, [50, 99]).tolist()
+                    if len(latencies) else (None, None))
+        return {
+            'requests': requests,
+            'errors': errors,
+            'batches': sum(batch_sizes.values()),
+            'batch_sizes': dict((str(k), v) for k, v in batch_sizes.items()),
+            'latency_p50': p50,
+            'latency_p99': p99
+        }
+
+
+class PendingRequest(object):
+    def __init__(self, event):
+        self.event = event
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchScheduler(object):
+    """
+    Collect submitted events into dynamic batches.
+    A batch is run as soon as it holds max_batch_size events, or when the
+    oldest event in it has waited max_latency seconds.
+    `run_batch` takes a list of events and returns a list of results.
+    `prepare` (optional) is applied to each event in the submitting thread,
+    before it is queued: it should raise ValueError for invalid events, so
+    that they fail alone instead of failing the whole batch.
+    """
+    def __init__(self, run_batch, max_batch_size=8, max_latency=0.01,
+                 prepare=None):
+        self.run_batch = run_batch
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.stats = ServerStats()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, event):
+        """
+        Blocks until the event has been processed, returns its result.
+        """
+        if self.prepare is not None:
+            start = time.time()
+            try:
+                event = self.prepare(event)
+            except Exception:
+                self.stats.add_request(time.time() - start, error=True)
+                raise
+        request = PendingRequest(event)
+        self.queue.put(request)
+        request.done.wait()
+        self.stats.add_request(time.time() - request.arrival,
+                               error=request.error is not None)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while not self._stop.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            self.stats.add_batch(len(batch))
+            try:
+                results = self.run_batch([r.event for r in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def summary(self):
+        summary = self.stats.summary()
+        summary['queue_depth'] = self.queue.qsize()
+        return summary
+
+
+def densify(event, N, dim):
+    """
+    Check a sparse event and return its coordinates and dense image of size
+    N, raise ValueError if it is invalid.
+    """
+    if not isinstance(event, dict) or 'coords' not in event:
+        raise ValueError("An event needs `coords`.")
+    coords = np.array(event['coords'], dtype=np.int64)
+    if coords.size == 0:
+        coords = np.reshape(coords, (0, dim))
+    if coords.ndim != 2 or coords.shape[1] != dim:
+        raise ValueError("Coordinates should have shape (N, %d), got %s."
+                         % (dim, coords.shape))
+    if np.any(coords < 0) or np.any(coords >= N):
+        raise ValueError("Coordinates out of image of size %d." % N)
+    values = np.array(event.get('values', np.ones((coords.shape[0],))),
+                      dtype=np.float32)
+    if values.shape != (coords.shape[0],):
+        raise ValueError("Expected %d values, got shape %s."
+                         % (coords.shape[0], values.shape))
+    data = np.zeros((1,) + (N,) * dim + (1,), dtype=np.float32)
+    data[(0,) + tuple(coords.T) + (0,)] = values
+    return coords, data
+
+
+class NetworkRunner(object):
+    """
+    Run batches of sparse events through frozen networks (see `ppn export`).
+    An event is a dictionary with `coords` (list of voxel indices in the
+    image) and optionally `values` (defaults to 1). Events go through
+    `densify` before being batched. Results are sparse: segmentation and
+    scores at the input coordinates, PPN proposals.
+    """
+    def __init__(self, cfg):
+        from faster_particles.export import FrozenNet
+        if cfg.FROZEN_BASE is None and cfg.FROZEN_PPN is None:
+            raise Exception("Need at least one frozen graph to serve.")
+        self.N = cfg.IMAGE_SIZE
+        self.dim = 3 if cfg.DATA_3D else 2
+        self.base = None if cfg.FROZEN_BASE is None else FrozenNet(cfg, cfg.FROZEN_BASE)
+        self.ppn = None if cfg.FROZEN_PPN is None else FrozenNet(cfg, cfg.FROZEN_PPN)
+
+    def densify(self, event):
+        return densify(event, self.N, self.dim)
+
+    def __call__(self, events):
+        """
+        events: list of (coords, data) returned by densify.
+        """
+        coords, data = zip(*events)
+        results = [{} for _ in events]
+        if self.base is not None:
+            r = self.base.run({'data': np.concatenate(data, axis=0)})
+            for i, c in enumerate(coords):
+                index = (i,) + tuple(c.T)
+                results[i]['segmentation'] = r['predictions'][index].tolist()
+                results[i]['scores'] = r['scores'][index].tolist()
+                results[i]['softmax'] = r['softmax'][index].tolist()
+        if self.ppn is not None:
+            # PPN placeholder has a batch size of 1
+            for i in range(len(events)):
+                r = self.ppn.run({'data': data[i]})
+                for key in ['im_proposals', 'im_scores', 'im_labels']:
+                    results[i][key] = np.asarray(r[key]).tolist()
+        return results
+
+    def close(self):
+        for net in [self.base, self.ppn]:
+            if net is not None:
+                net.close()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    POST /infer with a JSON event, GET /stats.
+    """
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.scheduler.summary())
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            event = json.loads(self.rfile.read(length).decode('utf-8'))
+            result = self.server.scheduler.submit(event)
+        except ValueError as e:
+            # Invalid event (or JSON), the other events are not affected
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scheduler):
+        HTTPServer.__init__(self, address, InferenceHandler)
+        self.scheduler = scheduler
+
+
+class InferenceClient(object):
+    """
+    Minimal client for InferenceServer.
+    """
+    def __init__(self, host='127.0.0.1', port=8000):
+        self.url = 'http://%s:%d' % (host, port)
+
+    def infer(self, coords, values=None):
+        event = {'coords': np.asarray(coords).tolist()}
+        if values is not None:
+            event['values'] = np.asarray(values).tolist()
+        request = HTTPRequest(self.url + '/infer',
+                              data=json.dumps(event).encode('utf-8'),
+                              headers={'Content-Type': 'application/json'})
+        return json.loads(urlopen(request).read().decode('utf-8'))
+
+    def stats(self):
+        return json.loads(urlopen(self.url + '/stats').read().decode('utf-8'))
+
+
+def serve(cfg):
+    """
+    Load the frozen networks once and serve them until interrupted.
+    """
+    runner = NetworkRunner(cfg)
+    scheduler = BatchScheduler(runner,
+                               max_batch_size=cfg.MAX_BATCH_SIZE,
+                               max_latency=cfg.MAX_LATENCY,
+                               prepare=runner.densify)
+    scheduler.start()
+    server = InferenceServer((cfg.SERVER_HOST, cfg.SERVER_PORT), scheduler)
+    print("Serving on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
+        runner.close()
@@ -0,0 +1,349 @@
+# *-* encoding: utf-8 *-*
+# Evaluate a directory of checkpoints in parallel on cached events
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import re
+import numpy as np
+
+from faster_particles.config import ConfigSnapshot
+
+# Means of these metrics attributes are written for each checkpoint.
+SUMMARY_METRICS = {
+    'uresnet': ['acc_all', 'acc_nonzero', 'label_softmax_nonzero_mean'],
+    'ppn': ['ppn1_distances_to_closest_gt', 'ppn1_false_positives',
+            'ppn1_false_negatives', 'ppn2_distances_to_closest_gt',
+            'ppn2_false_positives', 'ppn2_false_negatives']
+}
+
+# Configuration the cached events depend on, stored in the cache manifest:
+# a cache decoded with different values is rebuilt.
+CACHE_CONFIG = ['DATA', 'TEST_DATA', 'DATA_TYPE', 'IMAGE_SIZE', 'DATA_3D',
+                'BATCH_SIZE', 'ENABLE_CROP', 'CROP_ALGO', 'SLICE_SIZE', 'NET']
+
+
+def cache_config(cfg):
+    return dict((name, getattr(cfg, name, None)) for name in CACHE_CONFIG)
+
+
+class EventCache(object):
+    """
+    Decoded blobs stored once on disk, one .npy file per blob key with all
+    blobs concatenated along the first axis. Files are memory-mapped when
+    read, so that worker processes share the same pages instead of each
+    holding a copy of the events.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, self.MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.arrays, self.offsets = {}, {}
+        for key in self.manifest['keys']:
+            self.arrays[key] = np.load(self.filename(directory, key),
+                                       mmap_mode='r')
+            self.offsets[key] = np.load(self.filename(directory, key,
+                                                      'offsets'))
+
+    def __len__(self):
+        return self.manifest['num_blobs']
+
+    def __getitem__(self, i):
+        return dict((key, self.arrays[key][self.offsets[key][i]:self.offsets[key][i+1]])
+                    for key in self.arrays)
+
+    @staticmethod
+    def filename(directory, key, suffix='data'):
+        if suffix == 'raw':
+            return os.path.join(directory, '%s_data.raw' % key)
+        return os.path.join(directory, '%s_%s.npy' % (key, suffix))
+
+    @classmethod
+    def exists(cls, directory, num_events, config=None):
+        """
+        Whether a complete cache of num_events events decoded with config
+        (see cache_config) is in directory.
+        """
+        filename = os.path.join(directory, cls.MANIFEST)
+        if not os.path.isfile(filename):
+            return False
+        with open(filename) as f:
+            manifest = json.load(f)
+        return manifest['num_events'] == num_events \
+            and manifest.get('config') == config
+
+    @classmethod
+    def write(cls, directory, events, config=None, chunk_size=2**26):
+        """
+        events: iterable of lists of blobs (crops), decoded with config
+        (stored in the manifest, see exists). Only numpy array values
+        are kept, they must have the same shape for all blobs except along
+        the first axis (and are cast to the dtype of the first blob).
+        Blobs are appended to one raw file per key as they arrive, so that
+        events are never all held in memory, then copied into the .npy files
+        by chunks of chunk_size bytes.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Invalidate a previous cache until this one is complete
+        if os.path.isfile(os.path.join(directory, cls.MANIFEST)):
+            os.remove(os.path.join(directory, cls.MANIFEST))
+        files, lengths, num_events, num_blobs = {}, {}, 0, 0
+        try:
+            for blobs in events:
+                num_events += 1
+                for blob in blobs:
+                    num_blobs += 1
+                    for key in blob:
+                        value = blob[key]
+                        if not isinstance(value, np.ndarray) or value.ndim == 0:
+                            continue
+                        if key not in files:
+                            files[key] = (open(cls.filename(directory, key, 'raw'), 'wb'),
+                                          value.dtype, value.shape[1:])
+                            lengths[key] = []
+                        f, dtype, shape = files[key]
+                        if value.shape[1:] != shape:
+                            raise Exception("Blobs have different shapes for key %s: %s and %s."
+                                            % (key, shape, value.shape[1:]))
+                        f.write(np.ascontiguousarray(value, dtype=dtype).tobytes())
+                        lengths[key].append(value.shape[0])
+        finally:
+            for f, _, _ in files.values():
+                f.close()
+        keys = [key for key in files if len(lengths[key]) == num_blobs]
+        for key in files:
+            raw = cls.filename(directory, key, 'raw')
+            if key in keys:
+                _, dtype, shape = files[key]
+                cls.copy_raw(raw, cls.filename(directory, key), dtype,
+                             (sum(lengths[key]),) + shape, chunk_size)
+                np.save(cls.filename(directory, key, 'offsets'),
+                        np.concatenate([[0], np.cumsum(lengths[key])]).astype(np.int64))
+            os.remove(raw)
+        # Written last: a cache without manifest is incomplete
+        with open(os.path.join(directory, cls.MANIFEST), 'w') as f:
+            json.dump({'keys': keys,
+                       'num_events': num_events,
+                       'num_blobs': num_blobs,
+                       'config': config}, f)
+        return cls(directory)
+
+    @staticmethod
+    def copy_raw(raw, filename, dtype, shape, chunk_size):
+        """
+        Copy the raw file of an array of given dtype and shape to a .npy.
+        """
+        output = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                           shape=shape)
+        if output.size:
+            output = output.reshape(-1)
+            data = np.memmap(raw, dtype=dtype, mode='r', shape=output.shape)
+            step = max(chunk_size // output.itemsize, 1)
+            for start in range(0, output.size, step):
+                output[start:start + step] = data[start:start + step]
+            del data
+        output.flush()
+        del output
+
+
+def list_checkpoints(directory):
+    """
+    Returns a list of (step, checkpoint path) sorted by step.
+    """
+    checkpoints = []
+    for meta in glob.glob(os.path.join(directory, "*.ckpt.meta")):
+        w = meta[:-5]
+        step = re.findall(r'model-(\d+)', w)
+        checkpoints.append((int(step[0]) if step else -1, w))
+    return sorted(checkpoints)
+
+
+def summary_fields():
+    """
+    Columns of the CSV files of evaluated checkpoints.
+    """
+    fields = ['step', 'checkpoint']
+    for name in SUMMARY_METRICS:
+        fields.extend(SUMMARY_METRICS[name])
+    return fields
+
+
+def read_done(filename):
+    """
+    Checkpoints already evaluated in a previous (possibly partial) sweep.
+    """
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename) as f:
+        return set(row['checkpoint'] for row in csv.DictReader(f))
+
+
+def decode_events(cfg):
+    """
+    Generator of the lists of blobs (crops) of cfg.MAX_STEPS test events.
+    """
+    from faster_particles.demo_ppn import get_data
+    from faster_particles.cropping import cropping_algorithms
+    crop_algorithm = cropping_algorithms[cfg.CROP_ALGO](cfg)
+    if cfg.ENABLE_CROP:
+        cfg.BATCH_SIZE = 1
+    _, data = get_data(cfg)
+    for i in range(cfg.MAX_STEPS):
+        blob = data.forward()
+        if cfg.ENABLE_CROP:
+            batch_blobs, _, _ = crop_algorithm.process(blob)
+        else:
+            batch_blobs = [blob]
+        yield batch_blobs
+
+
+def prepare_cache(cfg, name):
+    """
+    Decode cfg.MAX_STEPS test events into cfg.CACHE_DIR (default
+    DISPLAY_DIR/name) unless they are already there, decoded with the same
+    CACHE_CONFIG values. Returns the cache directory.
+    """
+    if not os.path.isdir(cfg.DISPLAY_DIR):
+        os.makedirs(cfg.DISPLAY_DIR)
+    cache_dir = cfg.CACHE_DIR
+    if cache_dir is None:
+        cache_dir = os.path.join(cfg.DISPLAY_DIR, name)
+    config = cache_config(cfg)
+    if EventCache.exists(cache_dir, cfg.MAX_STEPS, config):
+        print("Using cached events in %s" % cache_dir)
+    else:
+        print("Decoding %d events into %s..." % (cfg.MAX_STEPS, cache_dir))
+        EventCache.write(cache_dir, decode_events(ConfigSnapshot(cfg)), config)
+    print("Done.")
+    return cache_dir
+
+
+# State of a worker process, built once by init_worker.
+_worker = {}
+
+
+def init_worker(cfg, cache_dir):
+    # Tensorflow is only imported in the workers, the parent process never
+    # creates a session.
+    import tensorflow as tf
+    from faster_particles.ppn import PPN
+    from faster_particles.base_net import basenets
+    from faster_particles.demo_ppn import FullNet
+    from faster_particles.metrics import PPNMetrics, UResNetMetrics
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = cfg.GPU
+    # Metrics are rebuilt for each checkpoint, possibly in several
+    # processes: they must not share (and clear) a metrics sink.
+    cfg.METRICS_FLUSH = 0
+    cfg.METRICS_RESUME = False
+    if cfg.NET == 'full':
+        net = FullNet(cfg)
+    elif cfg.NET == 'base':
+        net = basenets[cfg.BASE_NET](cfg=cfg)
+    else:
+        net = PPN(cfg=cfg, base_net=basenets[cfg.BASE_NET])
+    net.init_placeholders()
+    net.create_architecture(is_training=False)
+    config = tf.ConfigProto(intra_op_parallelism_threads=cfg.INTRA_OP_THREADS,
+                            inter_op_parallelism_threads=1)
+    sess = tf.Session(config=config)
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+
+    _worker.update({
+        'cfg': cfg,
+        'net': net,
+        'sess': sess,
+        'cache': EventCache(cache_dir),
+        'metrics': {'uresnet': UResNetMetrics, 'ppn': PPNMetrics}
+    })
+
+
+def evaluate_checkpoint(checkpoint, summaries=None):
+    """
+    Restore one checkpoint in the worker graph and compute the mean of
+    SUMMARY_METRICS over all cached blobs. Network summaries of each blob
+    are appended to summaries if given.
+    """
+    from faster_particles.demo_ppn import load_weights
+    step, w = checkpoint
+    cfg, net, sess = _worker['cfg'], _worker['net'], _worker['sess']
+    if cfg.NET in ['full', 'base']:
+        cfg.WEIGHTS_FILE_BASE = w
+    if cfg.NET in ['full', 'ppn']:
+        cfg.WEIGHTS_FILE_PPN = w
+    load_weights(cfg, sess)
+
+    metrics = {}
+    if cfg.NET in ['full', 'base'] and cfg.BASE_NET == 'uresnet':
+        metrics['uresnet'] = _worker['metrics']['uresnet'](cfg)
+    if cfg.NET in ['full', 'ppn']:
+        metrics['ppn'] = _worker['metrics']['ppn'](cfg, dim1=net.dim1,
+                                                   dim2=net.dim2)
+    for i in range(len(_worker['cache'])):
+        blob = _worker['cache'][i]
+        summary, results = net.test_image(sess, blob)
+        if summaries is not None:
+            summaries.append(summary)
+        for m in metrics.values():
+            m.add(blob, results)
+
+    row = {'step': step, 'checkpoint': w}
+    for name, m in metrics.items():
+        for attr in SUMMARY_METRICS[name]:
+            row[attr] = m.mean(attr)
+    return row
+
+
+def sweep(cfg):
+    """
+    Evaluate all checkpoints of cfg.CHECKPOINT_DIR on the same test events.
+    Events are decoded once into a cache shared by cfg.NUM_WORKERS worker
+    processes, each running one checkpoint at a time with
+    cfg.INTRA_OP_THREADS threads. One row per checkpoint is appended to
+    DISPLAY_DIR/sweep.csv as soon as it is evaluated; checkpoints already
+    present in that file are skipped, so an interrupted sweep can resume.
+    """
+    if cfg.NET not in ['ppn', 'base', 'full']:
+        raise Exception("Sweep is only available for `ppn`, `base` and `full` nets.")
+    cfg = ConfigSnapshot(cfg)
+    cache_dir = prepare_cache(cfg, 'sweep_cache')
+
+    filename = os.path.join(cfg.DISPLAY_DIR, 'sweep.csv')
+    done = read_done(filename)
+    checkpoints = [c for c in list_checkpoints(cfg.CHECKPOINT_DIR)
+                   if c[1] not in done]
+    print("%d checkpoints to evaluate (%d already done)" % (len(checkpoints), len(done)))
+    if not checkpoints:
+        return
+
+    fields = summary_fields()
+    # Workers must not inherit a forked Tensorflow/data loading state
+    context = multiprocessing.get_context('spawn') \
+        if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(min(cfg.NUM_WORKERS, len(checkpoints)),
+                        initializer=init_worker, initargs=(cfg, cache_dir))
+    write_header = not os.path.isfile(filename)
+    with open(filename, 'a') as f:
+        writer = csv.DictWriter(f, fields, restval='')
+        if write_header:
+            writer.writeheader()
+        try:
+            for i, row in enumerate(pool.imap_unordered(evaluate_checkpoint,
+                                                        checkpoints)):
+                writer.writerow(row)
+                f.flush()
+                print("%d/%d step %d" % (i + 1, len(checkpoints), row['step']))
+        finally:
+            pool.terminate()
+            pool.join()
+    print("Wrote %s" % filename)
@@ -0,0 +1,71 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for streaming metric accumulators
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from faster_particles.metrics.accumulators import RunningStats, StreamingSeries
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.random = np.random.RandomState(123)
+
+    def test_running_stats(self):
+        values = self.random.exponential(5.0, size=1000)
+        a, b = RunningStats(), RunningStats()
+        for chunk in np.array_split(values[:600], 7):
+            a.add(chunk)
+        b.add(values[600:])
+        a.merge(b)
+        self.assertEqual(a.count, 1000)
+        self.assertAlmostEqual(a.mean, np.mean(values))
+        self.assertAlmostEqual(a.std, np.std(values))
+        self.assertEqual(a.min, np.min(values))
+        self.assertEqual(a.max, np.max(values))
+
+    def test_percentile(self):
+        values = self.random.exponential(5.0, size=10000)
+        series = StreamingSeries()
+        series.add(values)
+        histogram = series.histogram
+        sorted_values = np.sort(values)
+        for q in [1, 25, 50, 75, 99]:
+            # Nearest rank percentile, approximated by the mean of its bin
+            expected = sorted_values[int(np.ceil(q / 100.0 * len(values))) - 1]
+            # Width of the bin of expected (twice for rounding at bin edges)
+            width = histogram.precision * (expected - histogram.low + histogram.scale)
+            self.assertLessEqual(abs(series.percentile(q) - expected), 2 * width)
+        self.assertEqual(series.percentile(0), np.min(values))
+        self.assertEqual(series.percentile(100), np.max(values))
+
+    def test_merge(self):
+        values = self.random.uniform(-1.0, 1.0, size=2000)
+        a = StreamingSeries(low=-1.0)
+        b = StreamingSeries(low=-1.0)
+        a.add(values[:500])
+        b.add(values[500:])
+        b.add([np.nan])
+        a.merge(b)
+        self.assertEqual(len(a), 2000)
+        self.assertEqual(a.nan, 1)
+        self.assertAlmostEqual(a.mean(), np.mean(values))
+        self.assertEqual(a.histogram.counts.sum(), 2000)
+        with self.assertRaises(Exception):
+            a.merge(StreamingSeries())
+
+    def test_discrete(self):
+        # Integer counts (e.g. ambiguity) are kept exactly
+        values = self.random.randint(0, 50, size=1000)
+        series = StreamingSeries()
+        series.add(values)
+        samples, counts = series.samples()
+        unique, unique_counts = np.unique(values, return_counts=True)
+        np.testing.assert_allclose(samples, unique)
+        np.testing.assert_array_equal(counts, unique_counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
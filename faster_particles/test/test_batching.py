@@ -0,0 +1,56 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for patch batching
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from faster_particles.cropping.batching import PatchBatcher
+
+
+def make_patches(event, n, N=4):
+    return [{'data': np.full((1, N, N, N, 1), event * 100 + j + 1.0),
+             'labels': np.ones((1, N, N, N), dtype=np.int32),
+             'gt_pixels': np.ones((j, 4))}
+            for j in range(n)]
+
+
+class Test(unittest.TestCase):
+    def test_no_patch_lost(self):
+        batcher = PatchBatcher(4)
+        sizes = [3, 6, 1]
+        for event, n in enumerate(sizes):
+            batcher.add(event, make_patches(event, n))
+        seen = []
+        for batch, slots in batcher.batches():
+            # The last batch is not padded
+            self.assertEqual(batch['data'].shape[0], len(slots))
+            self.assertEqual(batch['labels'].shape[0], len(slots))
+            self.assertFalse('mask' in batch)
+            # Fake network result: one value per slot
+            result = {'predictions': batch['data'][:, 0, 0, 0, 0],
+                      'im_scores': np.arange(3)}
+            for event, patch, r in PatchBatcher.split(result, slots):
+                self.assertEqual(r['predictions'], event * 100 + patch + 1.0)
+                self.assertTrue(np.array_equal(r['im_scores'], np.arange(3)))
+                seen.append((event, patch))
+        self.assertEqual(seen, [(e, p) for e, n in enumerate(sizes)
+                                for p in range(n)])
+        self.assertEqual(len(batcher), 0)
+
+    def test_keep_pending(self):
+        batcher = PatchBatcher(4)
+        batcher.add(0, make_patches(0, 6))
+        batches = list(batcher.batches(flush=False))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batcher), 2)
+
+    def test_keepdims(self):
+        result = {'predictions': np.zeros((2, 4, 4))}
+        r = PatchBatcher.split(result, [(0, 0), (0, 1)], keepdims=True)
+        self.assertEqual(r[1][2]['predictions'].shape, (1, 4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
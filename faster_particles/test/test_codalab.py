@@ -0,0 +1,50 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the sparse submission writer
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import tables
+from faster_particles.demo_codalab import SparseSubmissionWriter, \
+    read_event, sparse_to_dense
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sparse_to_dense(self):
+        N = 8
+        filename = os.path.join(self.directory, 'submission.hdf5')
+        writer = SparseSubmissionWriter(filename, num_classes=3, softmax=True)
+        dense = np.random.randint(1, 3, size=(4, N, N, N))
+        dense[np.random.random(dense.shape) > 0.1] = 0
+        for event in dense:
+            coords = np.argwhere(event > 0)
+            softmax = np.random.random((len(coords), 3))
+            writer.add(coords, event[tuple(coords.T)], softmax)
+        writer.close()
+
+        with tables.open_file(filename, 'r') as f:
+            coords, labels, softmax = read_event(f, 2)
+            self.assertEqual(coords.dtype, np.uint16)
+            self.assertEqual(labels.dtype, np.uint8)
+            self.assertEqual(softmax.dtype, np.float16)
+            self.assertEqual(len(labels), np.count_nonzero(dense[2]))
+
+        output = os.path.join(self.directory, 'dense.hdf5')
+        sparse_to_dense(filename, output, N=N)
+        with tables.open_file(output, 'r') as f:
+            self.assertTrue(np.array_equal(f.root.pred[:], dense))
+
+
+if __name__ == '__main__':
+    unittest.main()
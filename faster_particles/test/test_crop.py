@@ -0,0 +1,80 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for ppn_utils.crop
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from faster_particles.ppn_utils import crop
+
+
+def crop_np(patch_centers, N, data, use_smear=False, return_labels=True):
+    """
+    Reference implementation, one patch at a time.
+    """
+    coords0 = np.floor(patch_centers - N/2.0)
+    coords1 = np.floor(patch_centers + N/2.0)
+    dim = patch_centers.shape[1]
+    smear = np.random.randint(-N/2+1, high=N/2, size=dim) if use_smear else np.zeros((dim,))
+    image_size = data.shape[1]
+    coords0 = np.clip(coords0 + smear, 0, image_size).astype(int)
+    coords1 = np.clip(coords1 + smear, 0, image_size).astype(int)
+    crops = np.zeros((coords0.shape[0],) + (N,) * dim + (data.shape[-1],))
+    crops_labels = np.zeros_like(crops)
+    for j in range(len(coords0)):
+        padding = []
+        for d in range(dim):
+            pad = np.maximum(N - (coords1[j, d] - coords0[j, d]), 0)
+            if coords0[j, d] == 0.0:
+                padding.append((pad, 0))
+            else:
+                padding.append((0, pad))
+        padding.append((0, 0))
+        patch = data[(0,) + tuple(slice(coords0[j, d], coords1[j, d])
+                                  for d in range(dim))]
+        crops[j] = np.pad(patch, padding, 'constant')
+        if return_labels:
+            crops_labels[j][crops[j] > 0] = 1
+            window = tuple(slice(int(N/2-1-smear[d]), int(N/2+2-smear[d]))
+                           for d in range(dim))
+            indices = np.where(crops[j][window] > 0)
+            vertex = tuple(indices[d] + int(N/2-1-smear[d]) for d in range(dim))
+            crops_labels[j][vertex + (indices[dim],)] = 2
+    return crops, crops_labels
+
+
+class Test(unittest.TestCase):
+    def crop(self, dim, use_smear):
+        M, N = 32, 8
+        data = np.random.rand(*((1,) + (M,) * dim + (2,)))
+        data[data < 0.7] = 0
+        data = data.astype(np.float32)
+        # Include patches overlapping the borders of the image
+        patch_centers = np.random.uniform(-N, M + N, size=(20, dim))
+        state = np.random.get_state()
+        crops, crops_labels = crop(patch_centers, N, data,
+                                   use_smear=use_smear)
+        np.random.set_state(state)
+        crops_ref, crops_labels_ref = crop_np(patch_centers, N, data,
+                                              use_smear=use_smear)
+        self.assertEqual(crops.dtype, crops_ref.dtype)
+        self.assertTrue(np.array_equal(crops, crops_ref))
+        self.assertTrue(np.array_equal(crops_labels, crops_labels_ref))
+        self.assertTrue(np.any(crops_labels == 2))
+
+    def test_crop_2d(self):
+        self.crop(2, False)
+
+    def test_crop_3d(self):
+        self.crop(3, False)
+
+    def test_crop_smear_2d(self):
+        self.crop(2, True)
+
+    def test_crop_smear_3d(self):
+        self.crop(3, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
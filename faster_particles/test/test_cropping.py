@@ -14,6 +14,7 @@ class MyCfg:
     CROP_SIZE = 24
     SLICE_SIZE = 128
     DISPLAY_DIR = "display/train_uresnet3d"
+    DISPLAY_MAX_VOXELS = 20000
 
 
 cfg = MyCfg()
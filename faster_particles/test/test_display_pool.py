@@ -0,0 +1,70 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the display worker pool
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from faster_particles.display_pool import DisplayPool, SparseArray, snapshot, restore
+
+
+class Config(object):
+    DATA_3D = True
+    IMAGE_SIZE = 32
+
+
+def write_display(blob, cfg, index=0, name='display', directory=None, delay=0.0):
+    time.sleep(delay)
+    np.save(os.path.join(directory, '%s_%d.npy' % (name, index)), blob['data'])
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot(self):
+        data = np.zeros((1, 32, 32, 32, 1), dtype=np.float32)
+        data[0, 1, 2, 3, 0] = 5.0
+        blob = {'data': data, 'gt_pixels': np.array([[1, 2, 3, 1]]), 'entries': [0]}
+        copy = snapshot(blob)
+        self.assertIsInstance(copy['data'], SparseArray)
+        self.assertEqual(len(copy['data'].values), 1)
+        data[0, 1, 2, 3, 0] = 0.0
+        restored = restore(copy)
+        self.assertEqual(restored['data'][0, 1, 2, 3, 0], 5.0)
+        self.assertEqual(restored['data'].dtype, np.float32)
+        np.testing.assert_array_equal(restored['gt_pixels'], blob['gt_pixels'])
+        self.assertEqual(restored['entries'], [0])
+
+    def test_synchronous(self):
+        pool = DisplayPool(num_workers=0)
+        blob = {'data': np.ones((4, 4))}
+        pool.submit(write_display, blob, Config(), index=1, directory=self.directory)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'display_1.npy')))
+        pool.close()
+
+    def test_coalesce(self):
+        pool = DisplayPool(num_workers=1, max_pending=1)
+        directory = os.path.join(self.directory, 'displays')
+        for i in range(4):
+            blob = {'data': np.full((4, 4), i)}
+            pool.submit(write_display, blob, Config(), index=i,
+                        directory=directory, delay=0.5)
+        pool.close()
+        # The first display is drawn, the second and third are replaced by
+        # the last one while the worker is busy.
+        self.assertEqual(sorted(os.listdir(directory)), ['display_0.npy', 'display_3.npy'])
+        self.assertEqual(np.load(os.path.join(directory, 'display_3.npy'))[0, 0], 3)
+        self.assertEqual(pool.dropped, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
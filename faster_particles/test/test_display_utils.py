@@ -0,0 +1,49 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for batched voxel rendering helpers
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from faster_particles.display_utils import cube_faces, visible_faces, \
+    compute_voxel_overlap, compute_voxel_core
+
+
+class Test(unittest.TestCase):
+    def test_visible_faces(self):
+        # Two voxels side by side along x hide one face each
+        voxels = np.array([[0, 0, 0], [1, 0, 0], [5, 5, 5]])
+        visible = visible_faces(voxels)
+        self.assertEqual(visible.shape, (3, 6))
+        self.assertEqual(visible.sum(), 16)
+        self.assertFalse(visible[0, 3])
+        self.assertFalse(visible[1, 2])
+        self.assertTrue(np.all(visible[2]))
+        # Non integer coordinates: nothing is culled
+        self.assertTrue(np.all(visible_faces(voxels + 0.5)))
+
+    def test_cube_faces(self):
+        faces = cube_faces(np.array([[1.0, 2.0, 3.0]]), 2)
+        self.assertEqual(faces.shape, (1, 6, 4, 3))
+        np.testing.assert_array_equal(faces.min(axis=(0, 1, 2)), [1, 2, 3])
+        np.testing.assert_array_equal(faces.max(axis=(0, 1, 2)), [3, 4, 5])
+
+    def test_overlap(self):
+        coords = np.random.randint(0, 64, size=(1000, 3))
+        patch_centers = np.random.randint(0, 64, size=(20, 3))
+        patch_sizes = np.random.randint(8, 32, size=(20,))
+        overlap = compute_voxel_overlap(coords, patch_centers, patch_sizes[:, np.newaxis])
+        core = compute_voxel_core(coords, patch_centers, 16)
+        for i in range(0, 1000, 97):
+            voxel = coords[i]
+            self.assertEqual(overlap[i], np.sum(np.all(np.logical_and(
+                patch_centers - patch_sizes[:, np.newaxis]/2.0 <= voxel,
+                patch_centers + patch_sizes[:, np.newaxis]/2.0 >= voxel), axis=1)))
+            self.assertEqual(core[i], np.any(np.all(np.logical_and(
+                patch_centers - 8.0 <= voxel,
+                patch_centers + 8.0 >= voxel), axis=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
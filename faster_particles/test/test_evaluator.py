@@ -0,0 +1,63 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the checkpoints evaluator
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+import tensorflow as tf
+from faster_particles.evaluator import mean_summary
+from faster_particles import sweep
+
+
+class Config(object):
+    NET = 'base'
+    BASE_NET = 'vgg'
+    WEIGHTS_FILE_BASE = None
+    WEIGHTS_FILE_PPN = None
+    WEIGHTS_FILE_SMALL = None
+
+
+class NoSummaryNet(object):
+    """
+    Like FullNet, test_image returns no summary.
+    """
+    def test_image(self, sess, blob):
+        return None, {'predictions': blob['data']}
+
+
+class Test(unittest.TestCase):
+    def test_mean_summary(self):
+        summaries = []
+        for loss in [1.0, 2.0, 6.0]:
+            summaries.append(tf.Summary(value=[
+                tf.Summary.Value(tag='loss', simple_value=loss),
+                tf.Summary.Value(tag='image', image=tf.Summary.Image())
+            ]).SerializeToString())
+        summary = mean_summary(summaries, {'step': 1000, 'checkpoint': 'model-1000.ckpt',
+                                           'acc_all': 0.5})
+        values = dict((v.tag, v.simple_value) for v in summary.value)
+        self.assertEqual(values, {'loss': 3.0, 'metrics/acc_all': 0.5})
+
+    def test_no_summary(self):
+        sweep._worker.update({
+            'cfg': Config(),
+            'net': NoSummaryNet(),
+            'sess': None,
+            'cache': [{'data': np.zeros((1, 4, 4, 1))}] * 3,
+            'metrics': {}
+        })
+        summaries = []
+        # No variable to restore in an empty graph
+        with tf.Graph().as_default():
+            row = sweep.evaluate_checkpoint((1000, 'model-1000.ckpt'),
+                                            summaries=summaries)
+        sweep._worker.clear()
+        self.assertEqual(summaries, [None] * 3)
+        summary = mean_summary(summaries, row)
+        self.assertEqual(len(summary.value), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for KD-tree matching of PPN points with ground truth
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+import numpy as np
+from scipy.spatial.distance import cdist
+from faster_particles.metrics.matching import PointMatching, count_in_boxes
+
+
+class Test(unittest.TestCase):
+    def test_matching(self):
+        # Integer coordinates: many distances exactly equal to thresholds
+        predictions = np.random.randint(0, 64, size=(300, 3))
+        gt = np.random.randint(0, 64, size=(50, 3))
+        distances = cdist(predictions, gt)
+        matching = PointMatching(predictions, gt)
+        np.testing.assert_allclose(matching.distances_to_closest_gt, np.amin(distances, axis=1))
+        np.testing.assert_allclose(matching.distances_to_closest_pred, np.amin(distances, axis=0))
+        for threshold in [5, 10, 15]:
+            np.testing.assert_array_equal(matching.count_gt_closer_than(threshold),
+                                          np.count_nonzero(distances < threshold, axis=1))
+            self.assertEqual(matching.unmatched_predictions(threshold),
+                             np.count_nonzero(np.all(distances > threshold, axis=1)))
+            self.assertEqual(matching.unmatched_gt(threshold),
+                             np.count_nonzero(np.all(distances > threshold, axis=0)))
+
+    def test_count_in_boxes(self):
+        points = np.random.randint(0, 64, size=(500, 2))
+        centers = np.random.randint(0, 16, size=(40, 2)) * 4.0
+        counts = count_in_boxes(points, centers, 8)
+        for center, count in zip(centers, counts):
+            self.assertEqual(count, np.count_nonzero(np.all(np.absolute(points - center) < 8, axis=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for UResNet metrics computed from nonzero voxels
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from faster_particles.metrics import UResNetMetrics
+
+
+class Config(object):
+    NUM_CLASSES = 3
+    DETAIL_LOG = False
+    METRICS_STREAMING = False
+    METRICS_FLUSH = 0
+    METRICS_RESUME = False
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.cfg = Config()
+        self.cfg.DISPLAY_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cfg.DISPLAY_DIR)
+
+    def test_add(self):
+        N, C = 16, self.cfg.NUM_CLASSES
+        labels = np.zeros((1, N, N, N), dtype=np.int32)
+        voxels = np.random.randint(0, N, size=(200, 3))
+        labels[0, voxels[:, 0], voxels[:, 1], voxels[:, 2]] = np.random.randint(1, C, size=200)
+        softmax = np.random.uniform(size=(1, N, N, N, C)).astype(np.float32)
+        softmax /= softmax.sum(axis=-1, keepdims=True)
+        predictions = np.argmax(softmax, axis=-1)
+        metrics = UResNetMetrics(self.cfg)
+        metrics.add({'labels': labels}, {'predictions': predictions, 'softmax': softmax})
+        self.assertEqual(predictions.shape, (1, N, N, N))
+
+        # Dense reference
+        labels, predictions, softmax = labels[0], predictions[0], softmax[0]
+        label_softmax = np.take_along_axis(softmax, labels[..., np.newaxis], axis=-1)[..., 0]
+        nonzero = labels > 0
+        self.assertAlmostEqual(metrics.acc_all[0], np.mean(predictions == labels))
+        self.assertAlmostEqual(metrics.acc_nonzero[0], np.mean(predictions[nonzero] == labels[nonzero]))
+        self.assertEqual(metrics.num_voxels[0], np.count_nonzero(nonzero))
+        self.assertAlmostEqual(metrics.label_softmax_mean[0], label_softmax.mean(), places=5)
+        self.assertAlmostEqual(metrics.label_softmax_std[0], label_softmax.std(), places=5)
+        self.assertAlmostEqual(metrics.label_softmax_nonzero_mean[0], label_softmax[nonzero].mean(), places=5)
+        self.assertAlmostEqual(metrics.label_softmax_nonzero_std[0], label_softmax[nonzero].std(), places=5)
+        for c in range(C):
+            mask = labels == c
+            self.assertEqual(metrics.class_npx[c][0], np.count_nonzero(mask))
+            self.assertAlmostEqual(metrics.class_acc[c][0], np.mean(predictions[mask] == c))
+            self.assertAlmostEqual(metrics.class_score_mean[c][0], softmax[..., c][mask].mean(), places=5)
+            self.assertAlmostEqual(metrics.class_score_std[c][0], softmax[..., c][mask].std(), places=5)
+
+    def test_empty(self):
+        N, C = 8, self.cfg.NUM_CLASSES
+        metrics = UResNetMetrics(self.cfg)
+        metrics.add({'labels': np.zeros((1, N, N, N))},
+                    {'predictions': np.zeros((1, N, N, N), dtype=np.int64),
+                     'softmax': np.full((1, N, N, N, C), 1.0 / C)})
+        self.assertEqual(metrics.acc_all[0], 1.0)
+        self.assertTrue(np.isnan(metrics.acc_nonzero[0]))
+        self.assertEqual(metrics.class_acc[1][0], -1.0)
+        self.assertAlmostEqual(metrics.class_score_mean[0][0], 1.0 / C)
+
+
+if __name__ == '__main__':
+    unittest.main()
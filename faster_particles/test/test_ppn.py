@@ -273,6 +273,15 @@ class Test(unittest.TestCase):
         proposals_np = np.array([[1.0, 1.0, 0.43], [7, 75, 2.3], [98, 10, 45], [5, 34, 72]])
         return self.assign_gt_pixels(gt_pixels_np, proposals_np, dim1, dim2)
 
+    def test_assign_gt_pixels_chunks(self):
+        # More gt pixels than one distance block in closest_gt_pixels
+        dim1, dim2 = 8.0, 4.0
+        gt_pixels_np = np.concatenate([np.random.rand(1000, 3) * 512,
+                                       np.random.randint(1, 3, size=(1000, 1))],
+                                      axis=1)
+        proposals_np = np.random.rand(64, 3) * 16
+        return self.assign_gt_pixels(gt_pixels_np, proposals_np, dim1, dim2)
+
     def crop_pool_layer(self, net, rois_np, dim2, dim):
         rois = np.array(rois_np * dim2).astype(int)
         nb_channels = net.shape[-1]
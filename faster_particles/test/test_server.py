@@ -0,0 +1,143 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the batching inference server
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+from faster_particles.server import BatchScheduler, InferenceServer, \
+    InferenceClient, densify
+
+
+def count_voxels(events):
+    return [{'n': len(event['coords'])} for event in events]
+
+
+class Test(unittest.TestCase):
+    def submit_all(self, scheduler, events):
+        results = [None] * len(events)
+
+        def submit(i):
+            results[i] = scheduler.submit(events[i])
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(len(events))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_dynamic_batches(self):
+        scheduler = BatchScheduler(count_voxels, max_batch_size=4,
+                                   max_latency=0.5)
+        scheduler.start()
+        events = [{'coords': [[0, 0]] * i} for i in range(10)]
+        results = self.submit_all(scheduler, events)
+        scheduler.stop()
+        self.assertEqual([r['n'] for r in results], list(range(10)))
+        summary = scheduler.summary()
+        self.assertEqual(summary['requests'], 10)
+        self.assertEqual(summary['queue_depth'], 0)
+        sizes = dict((int(k), v) for k, v in summary['batch_sizes'].items())
+        self.assertEqual(sum(k * v for k, v in sizes.items()), 10)
+        self.assertTrue(max(sizes) <= 4)
+
+    def test_max_latency(self):
+        scheduler = BatchScheduler(count_voxels, max_batch_size=64,
+                                   max_latency=0.05)
+        scheduler.start()
+        start = time.time()
+        scheduler.submit({'coords': [[1, 2]]})
+        scheduler.stop()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(scheduler.summary()['batch_sizes'], {'1': 1})
+
+    def test_errors(self):
+        def fail(events):
+            raise ValueError("bad event")
+        scheduler = BatchScheduler(fail, max_batch_size=2, max_latency=0.01)
+        scheduler.start()
+        self.assertRaises(ValueError, scheduler.submit, {'coords': []})
+        scheduler.stop()
+        self.assertEqual(scheduler.summary()['errors'], 1)
+
+    def test_densify(self):
+        coords, data = densify({'coords': [[1, 2], [3, 0]], 'values': [2, 5]}, 4, 2)
+        self.assertEqual(data.shape, (1, 4, 4, 1))
+        self.assertEqual(data[0, 1, 2, 0], 2.0)
+        self.assertEqual(data[0, 3, 0, 0], 5.0)
+        self.assertEqual(data.sum(), 7.0)
+        coords, data = densify({'coords': []}, 4, 2)
+        self.assertEqual(coords.shape, (0, 2))
+        for event in [{'coords': [[1, 4]]},  # out of image
+                      {'coords': [1, 2, 3, 0]},  # bad shape
+                      {'coords': [[1, 2, 3]]},
+                      {'coords': [[1, 2]], 'values': [1, 2]},
+                      {'values': [1]}]:
+            self.assertRaises(ValueError, densify, event, 4, 2)
+
+    def test_invalid_event(self):
+        def prepare(event):
+            return densify(event, 4, 2)[1]
+        scheduler = BatchScheduler(lambda events: [{'sum': float(e.sum())} for e in events],
+                                   max_batch_size=4, max_latency=0.5,
+                                   prepare=prepare)
+        scheduler.start()
+        events = [{'coords': [[1, 1]], 'values': [i + 1]} for i in range(3)]
+        events[1]['coords'] = [[5, 1]]
+        results = [None] * len(events)
+
+        def submit(i):
+            try:
+                results[i] = scheduler.submit(events[i])
+            except ValueError as e:
+                results[i] = e
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(len(events))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        scheduler.stop()
+        # Only the invalid event fails
+        self.assertEqual(results[0], {'sum': 1.0})
+        self.assertTrue(isinstance(results[1], ValueError))
+        self.assertEqual(results[2], {'sum': 3.0})
+        summary = scheduler.summary()
+        self.assertEqual(summary['requests'], 3)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['batch_sizes'], {'2': 1})
+
+    def test_http(self):
+        def prepare(event):
+            return {'coords': densify(event, 8, 3)[0]}
+        scheduler = BatchScheduler(count_voxels, max_batch_size=4,
+                                   max_latency=0.01, prepare=prepare)
+        scheduler.start()
+        server = InferenceServer(('127.0.0.1', 0), scheduler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client = InferenceClient(*server.server_address[:2])
+        result = client.infer([[1, 2, 3], [4, 5, 6]], values=[1.0, 2.0])
+        try:
+            client.infer([[1, 2, 3]], values=[1.0, 2.0])
+            bad_request = None
+        except Exception as e:
+            bad_request = getattr(e, 'code', None)
+        stats = client.stats()
+        server.shutdown()
+        server.server_close()
+        scheduler.stop()
+        self.assertEqual(result, {'n': 2})
+        self.assertEqual(bad_request, 400)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertTrue(stats['latency_p50'] is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()
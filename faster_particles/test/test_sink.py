@@ -0,0 +1,87 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the metrics sink
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from faster_particles.metrics.sink import MetricsSink, load_sink, resume_events
+from faster_particles.metrics import UResNetMetrics
+
+
+class Config(object):
+    NUM_CLASSES = 3
+    DETAIL_LOG = False
+    METRICS_STREAMING = False
+    METRICS_FLUSH = 2
+    METRICS_RESUME = False
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_flush(self):
+        sink = MetricsSink(self.directory, flush_every=2)
+        for i in range(5):
+            sink.add('a', [i, i])
+            sink.add('b', i)
+            sink.end_event()
+        # The last event is not flushed yet
+        values = load_sink(self.directory)
+        np.testing.assert_array_equal(values['a'], [0, 0, 1, 1, 2, 2, 3, 3])
+        np.testing.assert_array_equal(values['b'], [0, 1, 2, 3])
+
+        # Resume after an interruption
+        sink = MetricsSink(self.directory, flush_every=2, resume=True)
+        self.assertEqual(sink.events, 4)
+        sink.add('b', 4)
+        sink.flush()
+        np.testing.assert_array_equal(load_sink(self.directory)['b'], np.arange(5))
+
+        # Without resume the sink starts over
+        sink = MetricsSink(self.directory, flush_every=2)
+        self.assertEqual(sink.events, 0)
+        self.assertEqual(load_sink(self.directory), {})
+        self.assertFalse(os.listdir(self.directory))
+
+    def test_resume_metrics(self):
+        cfg = Config()
+        cfg.DISPLAY_DIR = self.directory
+        N = 8
+        blob = {'labels': np.zeros((1, N, N, N))}
+        blob['labels'][0, 1, 2, 3] = 1
+        results = {'predictions': np.zeros((1, N, N, N), dtype=np.int64),
+                   'softmax': np.full((1, N, N, N, 3), 1.0 / 3)}
+        metrics = UResNetMetrics(cfg)
+        for i in range(3):
+            # Two crops per event
+            metrics.add(blob, results)
+            metrics.add(blob, results)
+            metrics.commit()
+        cfg.METRICS_RESUME = True
+        metrics = UResNetMetrics(cfg)
+        self.assertEqual(metrics.sink.events, 2)
+        self.assertEqual(resume_events(cfg, ['uresnet']), 2)
+        self.assertEqual(len(metrics.acc_all), 4)
+        self.assertEqual(len(metrics.class_npx[1]), 4)
+        metrics.add(blob, results)
+        metrics.commit()
+        metrics.flush()
+        values = load_sink(os.path.join(self.directory, 'metrics', 'uresnet'))
+        self.assertEqual(len(values['acc_nonzero']), 5)
+        np.testing.assert_array_equal(values['class_npx_1'], [1, 1, 1, 1, 1])
+        # Sinks of different metrics must agree on the number of events
+        with self.assertRaises(Exception):
+            resume_events(cfg, ['uresnet', 'ppn'])
+
+
+if __name__ == '__main__':
+    unittest.main()
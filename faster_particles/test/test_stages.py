@@ -0,0 +1,59 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for stage timing
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from faster_particles.profiler.stages import StageTimer
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_counters(self):
+        timer = StageTimer()
+        for i in range(3):
+            with timer.stage('data'):
+                pass
+        f = timer.timed('compute')(lambda x: 2 * x)
+        self.assertEqual(f(2), 4)
+        self.assertEqual(list(timer.iterate('batching', iter([1, 2]))), [1, 2])
+        summary = timer.summary()
+        self.assertEqual(summary['stages']['data']['count'], 3)
+        self.assertEqual(summary['stages']['compute']['count'], 1)
+        # The last call of next() raises StopIteration and is timed too
+        self.assertEqual(summary['stages']['batching']['count'], 3)
+        self.assertTrue(summary['stages']['data']['max'] <= summary['stages']['data']['total'])
+
+    def test_exception(self):
+        timer = StageTimer()
+        with self.assertRaises(ValueError):
+            with timer.stage('data'):
+                raise ValueError()
+        self.assertEqual(timer.summary()['stages']['data']['count'], 1)
+
+    def test_write(self):
+        timer = StageTimer()
+        filename = os.path.join(self.directory, 'timing.jsonl')
+        for step in range(2):
+            with timer.stage('data'):
+                pass
+            timer.write(step, filename)
+        self.assertEqual(timer.stages, {})
+        with open(filename) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([l['step'] for l in lines], [0, 1])
+        self.assertEqual(lines[1]['stages']['data']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
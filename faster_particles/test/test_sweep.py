@@ -0,0 +1,81 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for the checkpoint sweep event cache
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from faster_particles.sweep import EventCache, list_checkpoints, cache_config
+
+
+class Config(object):
+    DATA = 'test.root'
+    TEST_DATA = ''
+    DATA_TYPE = 'larcv'
+    IMAGE_SIZE = 4
+    DATA_3D = False
+    BATCH_SIZE = 1
+    ENABLE_CROP = False
+    CROP_ALGO = 'proba'
+    SLICE_SIZE = 64
+    NET = 'ppn'
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_event_cache(self):
+        events = []
+        for i in range(3):
+            events.append([{'data': np.full((1, 4, 4, 1), i * 10 + j),
+                            'gt_pixels': np.ones((i + j, 3)) * j,
+                            'entries': 'not an array'}
+                           for j in range(i + 1)])
+        # Not in every blob
+        events[1][0]['weight'] = np.ones((1, 4, 4))
+        # Copied by small chunks
+        cfg = Config()
+        cache = EventCache.write(self.directory, iter(events),
+                                 config=cache_config(cfg), chunk_size=40)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['data_data.npy', 'data_offsets.npy', 'gt_pixels_data.npy',
+                          'gt_pixels_offsets.npy', 'manifest.json'])
+        self.assertTrue(EventCache.exists(self.directory, 3, cache_config(cfg)))
+        self.assertFalse(EventCache.exists(self.directory, 4, cache_config(cfg)))
+        # Events decoded with another configuration
+        for name, value in [('DATA', 'other.root'), ('IMAGE_SIZE', 8),
+                            ('ENABLE_CROP', True), ('NET', 'full')]:
+            other = Config()
+            setattr(other, name, value)
+            self.assertFalse(EventCache.exists(self.directory, 3, cache_config(other)))
+        self.assertEqual(len(cache), 6)
+        blobs = [blob for blobs in events for blob in blobs]
+        cache = EventCache(self.directory)
+        for k, blob in enumerate(blobs):
+            self.assertEqual(sorted(cache[k]), ['data', 'gt_pixels'])
+            for key in ['data', 'gt_pixels']:
+                self.assertEqual(cache[k][key].shape, blob[key].shape)
+                self.assertTrue(np.array_equal(cache[k][key], blob[key]))
+
+    def test_event_cache_shapes(self):
+        events = [[{'data': np.zeros((1, 4, 4, 1))}], [{'data': np.zeros((1, 8, 8, 1))}]]
+        self.assertRaises(Exception, EventCache.write, self.directory, iter(events))
+
+    def test_list_checkpoints(self):
+        for step in [2000, 100, 30]:
+            open(os.path.join(self.directory, "model-%d.ckpt.meta" % step), 'w').close()
+        checkpoints = list_checkpoints(self.directory)
+        self.assertEqual([c[0] for c in checkpoints], [30, 100, 2000])
+        self.assertTrue(checkpoints[0][1].endswith("model-30.ckpt"))
+
+
+if __name__ == '__main__':
+    unittest.main()
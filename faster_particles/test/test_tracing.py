@@ -0,0 +1,64 @@
+# *-* encoding: utf-8 *-*
+# Unit tests for sampled Tensorflow tracing
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+import tensorflow as tf
+from faster_particles.profiler.tracing import TraceHook, get_scope
+
+
+class FakeSession(object):
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        self.options = options
+        self.run_metadata = run_metadata
+        return fetches
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scope(self):
+        self.assertEqual(get_scope('ppn/uresnet/conv_0/Conv3D'), 'uresnet')
+        self.assertEqual(get_scope('ppn/ppn1/Softmax'), 'ppn1')
+        self.assertEqual(get_scope('ppn/final_proposals/uresnet/Where'), 'final_proposals')
+        self.assertEqual(get_scope('ppn/gradients/ppn/ppn2/Sum_grad/Tile'), 'ppn2/gradients')
+        self.assertEqual(get_scope('_SOURCE'), 'other')
+
+    def test_should_trace(self):
+        hook = TraceHook(self.directory, every=10)
+        self.assertEqual([s for s in range(25) if hook.should_trace(s)], [0, 10, 20])
+        hook = TraceHook(self.directory, start=3, stop=5)
+        self.assertEqual([s for s in range(25) if hook.should_trace(s)], [3, 4])
+        hook = TraceHook(self.directory, every=10, start=3, stop=5)
+        self.assertEqual([s for s in range(25) if hook.should_trace(s)], [0, 3, 4, 10, 20])
+        hook = TraceHook(self.directory, start=22)
+        self.assertEqual([s for s in range(25) if hook.should_trace(s)], [22, 23, 24])
+
+    def test_caller_options(self):
+        hook = TraceHook(self.directory, every=2)
+        sess = FakeSession()
+        options = tf.RunOptions(timeout_in_ms=1000)
+        run_metadata = tf.RunMetadata()
+        # Traced step
+        self.assertEqual(hook.run(sess, 'x', options=options, run_metadata=run_metadata), 'x')
+        self.assertEqual(sess.options.trace_level, tf.RunOptions.FULL_TRACE)
+        self.assertEqual(sess.options.timeout_in_ms, 1000)
+        self.assertEqual(options.trace_level, tf.RunOptions.NO_TRACE)
+        self.assertTrue(sess.run_metadata is run_metadata)
+        self.assertEqual(hook.traced_steps, [0])
+        # Untraced step
+        hook.run(sess, 'x', options=options, run_metadata=run_metadata)
+        self.assertTrue(sess.options is options)
+        self.assertTrue(hook.run_metadata is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,16 +6,16 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
-from tensorflow.python.client import timeline
 import os
 import sys
 import numpy as np
-from functools import partial
-from inspect import getargspec
 
 from faster_particles.demo_ppn import load_weights
 from faster_particles.display_utils import draw_slicing
-from faster_particles.cropping import cropping_algorithms
+from faster_particles.display_pool import DisplayPool
+from faster_particles.cropping import cropping_algorithms, PatchBatcher
+from faster_particles.profiler.stages import timer
+from faster_particles.profiler.tracing import TraceHook, traced
 
 
 class Trainer(object):
@@ -39,7 +39,7 @@ class Trainer(object):
             os.makedirs(self.outputdir)
 
     def process_blob(self, i, blob, real_step, saver, is_testing,
-                     summary_writer_train, summary_writer_test, run_metadata):
+                     summary_writer_train, summary_writer_test):
         """
         Runs 1 training iteration on blob.
         """
@@ -56,11 +56,14 @@ class Trainer(object):
             blob['labels'] = np.reshape(
                 blob['crops_labels'],
                 (-1,) + (self.cfg.CROP_SIZE,) * self.dim)
+            with timer.stage('sess_run'):
+                if is_testing:
+                    summary, result = self.test_net.test_image(self.traced_sess, blob)
+                else:
+                    summary, result = self.train_net.train_step(self.traced_sess, blob)
             if is_testing:
-                summary, result = self.test_net.test_image(self.sess, blob)
                 summary_writer_test.add_summary(summary, real_step)
             else:
-                summary, result = self.train_net.train_step(self.sess, blob)
                 summary_writer_train.add_summary(summary, real_step)
             for i in range(len(blob['crops'])):
                 blob_i = {
@@ -76,35 +79,39 @@ class Trainer(object):
                 if is_drawing and self.display is not None:
                     N = self.cfg.IMAGE_SIZE
                     self.cfg.IMAGE_SIZE = self.cfg.CROP_SIZE
-                    self.display(blob_i,
-                                 self.cfg,
-                                 index=real_step,
-                                 name='display_train',
-                                 directory=os.path.join(
-                                     self.cfg.DISPLAY_DIR,
-                                     'train'),
-                                 vmin=0,
-                                 vmax=1,
-                                 predictions=np.reshape(
-                                     result['predictions'][i],
-                                     (1,) + (self.cfg.CROP_SIZE,) * self.dim
-                                     )
-                                 )
+                    with timer.stage('display'):
+                        self.display_pool.submit(
+                            self.display,
+                            blob_i,
+                            self.cfg,
+                            index=real_step,
+                            name='display_train',
+                            directory=os.path.join(self.cfg.DISPLAY_DIR,
+                                                   'train'),
+                            vmin=0,
+                            vmax=1,
+                            predictions=np.reshape(
+                                result['predictions'][i],
+                                (1,) + (self.cfg.CROP_SIZE,) * self.dim
+                                )
+                            )
                     self.cfg.IMAGE_SIZE = N
         else:
             # print(blob['entries'])
             # print(np.sum(blob['weight']), np.amin(blob['weight']), np.amax(blob['weight']))
             # print(np.unique(blob['weight'], return_counts=True))
             if is_testing:
-                summary, result = self.test_net.test_image(self.sess, blob)
+                with timer.stage('sess_run'):
+                    summary, result = self.test_net.test_image(self.traced_sess, blob)
                 summary_writer_test.add_summary(summary, real_step)
-                if self.cfg.PROFILE:
-                    summary_writer_test.add_run_metadata(run_metadata, "step_%d" % real_step, real_step)
+                if self.trace_hook is not None and self.trace_hook.run_metadata is not None:
+                    summary_writer_test.add_run_metadata(self.trace_hook.run_metadata, "step_%d" % real_step, real_step)
             else:
-                summary, result = self.train_net.train_step(self.sess, blob)
+                with timer.stage('sess_run'):
+                    summary, result = self.train_net.train_step(self.traced_sess, blob)
                 summary_writer_train.add_summary(summary, real_step)
-                if self.cfg.PROFILE:
-                    summary_writer_train.add_run_metadata(run_metadata, "step_%d" % real_step, real_step)
+                if self.trace_hook is not None and self.trace_hook.run_metadata is not None:
+                    summary_writer_train.add_run_metadata(self.trace_hook.run_metadata, "step_%d" % real_step, real_step)
 
             if is_drawing and self.display is not None:
                 print('Drawing...')
@@ -114,21 +121,24 @@ class Trainer(object):
                 if self.cfg.ENABLE_CROP:
                     N = self.cfg.IMAGE_SIZE
                     self.cfg.IMAGE_SIZE = self.cfg.SLICE_SIZE
-                self.display(blob,
-                             self.cfg,
-                             index=real_step,
-                             name='display_train',
-                             directory=os.path.join(self.cfg.DISPLAY_DIR,
-                                                    'train'),
-                             **result)
+                with timer.stage('display'):
+                    self.display_pool.submit(self.display,
+                                             blob,
+                                             self.cfg,
+                                             index=real_step,
+                                             name='display_train',
+                                             directory=os.path.join(self.cfg.DISPLAY_DIR,
+                                                                    'train'),
+                                             **result)
                 if self.cfg.ENABLE_CROP:
                     self.cfg.IMAGE_SIZE = N
                 print("Done.")
 
-        if real_step % 1000 == 0:
-            save_path = saver.save(self.sess,
-                                   os.path.join(self.outputdir,
-                                                "model-%d.ckpt" % real_step))
+        if real_step % self.cfg.CHECKPOINT_EVERY == 0:
+            with timer.stage('checkpoint'):
+                save_path = saver.save(self.sess,
+                                       os.path.join(self.outputdir,
+                                                    "model-%d.ckpt" % real_step))
             print("Wrote %s" % save_path)
             print("Memory usage: ", self.sess.run(tf.contrib.memory_stats.MaxBytesInUse()))
 
@@ -154,34 +164,14 @@ class Trainer(object):
             self.cfg.dim2 = self.train_net.dim2
         print("Done.")
 
-        run_metadata = None
-        if self.cfg.PROFILE:
-            print('WARNING PROFILING ENABLED')
-            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-            # print(getargspec(self.sess.run))
-            run_metadata = tf.RunMetadata()
-            builder = tf.profiler.ProfileOptionBuilder
-            opts = builder(builder.time_and_memory()).order_by('micros').build()
-            pctx = tf.contrib.tfprof.ProfileContext('/data/profiler',
-                                      trace_steps=[],
-                                      dump_steps=[])
-            old_run = tf.Session.run
-            def new_run(self, fetches, feed_dict=None):
-                pctx.trace_next_step()
-                pctx.dump_next_step()
-                results = old_run(self, fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
-                # pctx.profiler.profile_operations(options=opts)
-                return results
-
-            # new_run = lambda self, fetches, feed_dict=None: old_run(self, fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
-            # self.sess.run = partial(self.sess.run,
-            #                         options=run_options,
-            #                         run_metadata=run_metadata)
-            # self.sess.run_old = self.sess.run
-            tf.Session.run = new_run
+        # Displays are rendered in other processes (see cfg.DISPLAY_WORKERS)
+        self.display_pool = DisplayPool.from_config(self.cfg)
 
         # with tf.Session() as sess:
         self.sess = tf.Session()
+        # Only the network steps are traced (see cfg.PROFILE_EVERY)
+        self.trace_hook = TraceHook.from_config(self.cfg)
+        self.traced_sess = traced(self.sess, self.trace_hook)
 
         self.sess.run(tf.global_variables_initializer())
         load_weights(self.cfg, self.sess)
@@ -204,17 +194,25 @@ class Trainer(object):
 
         self.batch_size = self.cfg.BATCH_SIZE
         self.cfg.BATCH_SIZE = 1
+        # Without cropping, blobs already hold a full batch of images
+        batcher = PatchBatcher(self.batch_size if self.cfg.ENABLE_CROP else 1)
 
         print("Start training...")
         real_step = 0
+        timing_file = os.path.join(self.logdir, 'timing.jsonl')
+        timer.reset()
         for step in range(self.cfg.MAX_STEPS):
             sys.stdout.flush()
-            is_testing = step % 10 == 5
+            # Without in-loop testing (TEST_EVERY = 0), checkpoints are
+            # evaluated by `ppn evaluate` in another process
+            is_testing = self.cfg.TEST_EVERY > 0 and \
+                step % self.cfg.TEST_EVERY == self.cfg.TEST_EVERY // 2
             is_drawing = step > 0 and step % 200 == 0
-            if is_testing:
-                blob = self.test_toydata.forward()
-            else:
-                blob = self.train_toydata.forward()
+            with timer.stage('data'):
+                if is_testing:
+                    blob = self.test_toydata.forward()
+                else:
+                    blob = self.train_toydata.forward()
             if step % 10 == 0:
                 print("Iteration %d/%d" % (step, self.cfg.MAX_STEPS))
 
@@ -224,10 +222,12 @@ class Trainer(object):
             if self.cfg.ENABLE_CROP:
                 batch_blobs, patch_centers, patch_sizes = crop_algorithm.process(blob)
                 if is_drawing:
-                    draw_slicing(blob, self.cfg, patch_centers, patch_sizes,
-                                 index=step, name='slices',
-                                 directory=os.path.join(self.cfg.DISPLAY_DIR,
-                                                        'cropping'))
+                    with timer.stage('display'):
+                        self.display_pool.submit(draw_slicing, blob, self.cfg,
+                                                 patch_centers, patch_sizes,
+                                                 index=step, name='slices',
+                                                 directory=os.path.join(self.cfg.DISPLAY_DIR,
+                                                                        'cropping'))
                     print("Cropping %d patches..." % len(patch_centers))
                     print("Overlap: ",
                           crop_algorithm.compute_overlap(blob['voxels'],
@@ -236,80 +236,49 @@ class Trainer(object):
             else:
                 batch_blobs = [blob]
 
-            i = 0
-            batch_results = []
-            while i+self.batch_size <= len(batch_blobs):
-                blobs = batch_blobs[i:i+self.batch_size]
-                miniblob = {}
-                for key in blobs[0]:
-                    miniblob[key] = np.concatenate([b[key] for b in blobs])
-
-                i += self.batch_size
+            # The last batch is smaller, so that no patch is left out
+            batch_results = [None] * len(batch_blobs)
+            with timer.stage('batching'):
+                batcher.add(step, batch_blobs)
+            for i, (miniblob, slots) in enumerate(timer.iterate('batching', batcher.batches())):
                 real_step, result = self.process_blob(i, miniblob, real_step,
                                                       saver, is_testing,
                                                       summary_writer_train,
-                                                      summary_writer_test,
-                                                      run_metadata)
+                                                      summary_writer_test)
                 # Temporary - check whether there are empty slices
                 x = np.sum(miniblob['data'], axis=(1, 2, 3, 4))
                 if not np.all(x > 0.0):
                     print("STOP", x)
                 # Keep results for synthesis later
-                for j in range(len(blobs)):
-                    r = {}
-                    for key in result:
-                        if key in ['im_proposals', 'im_scores', 'im_labels', 'rois']:
-                            r[key] = result[key]
-                        elif key in ['dim1', 'dim2']:
-                            pass
-                        else:
-                            r[key] = result[key][j]
-                    batch_results.append(r)
+                for _, patch, r in PatchBatcher.split(result, slots):
+                    batch_results[patch] = r
 
             if self.cfg.ENABLE_CROP:
-                final_results = crop_algorithm.reconcile(batch_results,
-                                                         patch_centers,
-                                                         patch_sizes)
+                with timer.stage('reconcile'):
+                    final_results = crop_algorithm.reconcile(batch_results,
+                                                             patch_centers,
+                                                             patch_sizes)
 
                 if is_drawing:
-                    self.display(blob,
-                                 self.cfg,
-                                 index=step,
-                                 name='display_train_final',
-                                 directory=os.path.join(self.cfg.DISPLAY_DIR,
-                                                        'train'),
-                                 **final_results)
+                    with timer.stage('display'):
+                        self.display_pool.submit(self.display,
+                                                 blob,
+                                                 self.cfg,
+                                                 index=step,
+                                                 name='display_train_final',
+                                                 directory=os.path.join(self.cfg.DISPLAY_DIR,
+                                                                        'train'),
+                                                 **final_results)
 
+            if self.cfg.TIMING_INTERVAL > 0 and (step + 1) % self.cfg.TIMING_INTERVAL == 0:
+                timer.write(step, timing_file, summary_writer_train)
+
+        if self.cfg.TIMING_INTERVAL > 0 and timer.stages:
+            timer.write(self.cfg.MAX_STEPS - 1, timing_file, summary_writer_train)
         summary_writer_train.close()
         summary_writer_test.close()
         print("Done.")
+        self.display_pool.close()
 
-        if self.cfg.PROFILE:
-            pctx.profiler.profile_operations(options=opts)
-
-            # Create the Timeline object, and write it to a json
-            tl = timeline.Timeline(run_metadata.step_stats)
-            ctf = tl.generate_chrome_trace_format()
-            with open(self.cfg.PROFILE_TIMELINE, 'w') as f:
-                f.write(ctf)
-                print("Wrote timeline to %s" % self.cfg.PROFILE_TIMELINE)
-
-            # Print to stdout an analysis of the memory usage and the timing information
-            # broken down by python codes.
-            ProfileOptionBuilder = tf.profiler.ProfileOptionBuilder
-            # opts = ProfileOptionBuilder(ProfileOptionBuilder.time_and_memory()
-            #     ).with_node_names(show_name_regexes=['.*trainer.py.*']).build()
-            opts = tf.profiler.ProfileOptionBuilder.trainable_variables_parameter()
-            tf.profiler.profile(
-                tf.get_default_graph(),
-                run_meta=run_metadata,
-                cmd='code',
-                options=opts)
-
-            # Print to stdout an analysis of the memory usage and the timing information
-            # broken down by operation types.
-            tf.profiler.profile(
-                tf.get_default_graph(),
-                run_meta=run_metadata,
-                cmd='op',
-                options=tf.profiler.ProfileOptionBuilder.time_and_memory())
+        if self.trace_hook is not None:
+            self.trace_hook.report()
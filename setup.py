@@ -20,6 +20,7 @@ setup(
     install_requires=[
         "matplotlib >= 2.2.2",
         "numpy >= 1.13.1",
+        "scipy >= 1.3.0",
         "scikit-learn >= 0.18.1",
         "scikit-image >= 0.12.3",
         "tensorflow >= 1.3.1"
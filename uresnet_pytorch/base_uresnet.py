@@ -126,7 +126,7 @@ class UResNet(nn.Module):
         # Encoding steps
         self.double_resnet = nn.ModuleList()
         current_num_outputs = self.base_num_outputs
-        for step in xrange(self._num_strides):
+        for step in range(self._num_strides):
             self.double_resnet.append(DoubleResnet(
                 is_3d = self.is_3d,
                 num_inputs = current_num_outputs,
@@ -140,24 +140,24 @@ class UResNet(nn.Module):
         self.decode_conv = nn.ModuleList()
         self.decode_conv_bn = nn.ModuleList()
         self.decode_double_resnet = nn.ModuleList()
-        for step in xrange(self._num_strides):
+        for step in range(self._num_strides):
             self.decode_conv.append(self.fn_conv_transpose(
                 in_channels = current_num_outputs,
-                out_channels = current_num_outputs / 2,
+                out_channels = current_num_outputs // 2,
                 kernel_size = 3,
                 stride = 2,
                 padding=1,
                 output_padding=1
             ))
-            self.decode_conv_bn.append(self.batch_norm(num_features=current_num_outputs / 2))
+            self.decode_conv_bn.append(self.batch_norm(num_features=current_num_outputs // 2))
             self.decode_double_resnet.append(DoubleResnet(
                 is_3d = self.is_3d,
                 num_inputs = current_num_outputs,
-                num_outputs = current_num_outputs / 2,
+                num_outputs = current_num_outputs // 2,
                 kernel = 3,
                 stride = 1
             ))
-            current_num_outputs /= 2
+            current_num_outputs //= 2
 
         self.conv2 = self.fn_conv(
             in_channels = current_num_outputs,
@@ -181,12 +181,12 @@ class UResNet(nn.Module):
         net = F.relu(self.conv1_bn(self.conv1(net)))
         self.conv_feature_map[net.size()[1]] = net
         # Encoding steps
-        for step in xrange(self._num_strides):
+        for step in range(self._num_strides):
             net = self.double_resnet[step](net)
             self.conv_feature_map[net.size()[1]] = net
         # Decoding steps
-        for step in xrange(self._num_strides):
-            num_outputs = net.size()[1] / 2
+        for step in range(self._num_strides):
+            num_outputs = net.size()[1] // 2
             decode_layer = self.decode_conv[step]
             net = F.relu(self.decode_conv_bn[step](decode_layer(net)))
             net = torch.cat((net, self.conv_feature_map[net.size()[1]]), dim=1)
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader
+
+from faster_particles.demo_ppn import get_data
+from faster_particles.display_utils import extract_voxels
+
+
+class GeneratorDataset(IterableDataset):
+    """
+    Wrap the faster_particles data generators (toydata, larcv, hdf5, csv)
+    in an IterableDataset. Each loader worker builds its own generator,
+    seeded with cfg.SEED + worker id, and yields single events:
+    - dense: `data` (channels, N, N[, N]) float32 and `labels` int64
+    - sparse: `voxels` (n, dim) int64, `voxels_value` (n, 1) float32,
+      `labels` (n,) int64 and their coordinates `label_voxels` (n, dim) int64
+      in the order of extract_voxels(labels). With keep_dense the dense
+      `data` is kept too (e.g. for display).
+    """
+    def __init__(self, cfg, is_training=True, sparse=False, num_events=None,
+                 keep_dense=False):
+        self.cfg = cfg
+        self.is_training = is_training
+        self.sparse = sparse
+        self.keep_dense = keep_dense
+        self.num_events = cfg.MAX_STEPS if num_events is None else num_events
+
+    def events_per_worker(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return 0, self.num_events
+        # Split num_events as evenly as possible between workers
+        num_events = self.num_events // worker_info.num_workers
+        if worker_info.id < self.num_events % worker_info.num_workers:
+            num_events += 1
+        return worker_info.id, num_events
+
+    def make_generator(self, worker_id):
+        cfg = copy.copy(self.cfg)
+        cfg.BATCH_SIZE = 1
+        cfg.SEED = cfg.SEED + worker_id
+        np.random.seed(cfg.SEED)
+        train_data, test_data = get_data(cfg)
+        return train_data if self.is_training else test_data
+
+    def __iter__(self):
+        worker_id, num_events = self.events_per_worker()
+        data = self.make_generator(worker_id)
+        for _ in range(num_events):
+            yield self.sample(data.forward())
+
+    def sample(self, blob):
+        data = np.ascontiguousarray(np.moveaxis(blob['data'][0], -1, 0), dtype=np.float32)
+        if self.sparse:
+            label_voxels, labels = extract_voxels(blob['labels'][0])
+            sample = {
+                'voxels': np.ascontiguousarray(blob['voxels'], dtype=np.int64),
+                'voxels_value': np.reshape(blob['voxels_value'], (-1, 1)).astype(np.float32),
+                'labels': labels.astype(np.int64),
+                'label_voxels': label_voxels.astype(np.int64)
+            }
+            if self.keep_dense:
+                sample['data'] = data
+            return sample
+        return {
+            'data': data,
+            'labels': blob['labels'][0].astype(np.int64)
+        }
+
+
+def collate_dense(samples):
+    return {
+        'data': torch.from_numpy(np.stack([s['data'] for s in samples])),
+        'labels': torch.from_numpy(np.stack([s['labels'] for s in samples]))
+    }
+
+
+def collate_sparse(samples):
+    """
+    Concatenate the voxels of all events, with the event index in the batch
+    as last coordinate (sparseconvnet InputLayer convention).
+    """
+    def with_batch_index(key):
+        return np.concatenate([
+            np.concatenate([s[key], np.full((len(s[key]), 1), i, dtype=np.int64)], axis=1)
+            for i, s in enumerate(samples)])
+
+    batch = {
+        'voxels': torch.from_numpy(with_batch_index('voxels')),
+        'voxels_value': torch.from_numpy(np.concatenate([s['voxels_value'] for s in samples])),
+        'labels': torch.from_numpy(np.concatenate([s['labels'] for s in samples])),
+        'label_voxels': torch.from_numpy(with_batch_index('label_voxels'))
+    }
+    if 'data' in samples[0]:
+        batch['data'] = torch.from_numpy(np.stack([s['data'] for s in samples]))
+    return batch
+
+
+def make_loader(cfg, is_training=True, sparse=False, batch_size=1,
+                num_workers=0, pin_memory=False, prefetch_factor=2,
+                num_events=None, keep_dense=False):
+    """
+    DataLoader over GeneratorDataset. Events are read by num_workers
+    processes (in the main process if 0), each keeping prefetch_factor
+    batches ready. pin_memory only helps when copying batches to a GPU.
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+    return DataLoader(
+        GeneratorDataset(cfg, is_training=is_training, sparse=sparse,
+                         num_events=num_events, keep_dense=keep_dense),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        collate_fn=collate_sparse if sparse else collate_dense,
+        **kwargs)
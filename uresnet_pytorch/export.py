@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from faster_particles.config import PPNConfig
+from uresnet_pytorch.base_uresnet import UResNet
+from uresnet_pytorch.dataset import make_loader
+from uresnet_pytorch.uresnet import get_device, get_memory_format
+
+# Stored in the scripted model archive, read back by infer
+CONFIG_FILE = 'config.json'
+CONFIG_KEYS = ['IMAGE_SIZE', 'DATA_3D', 'NUM_STRIDES', 'BASE_NUM_OUTPUTS']
+
+
+def fuse_batch_norm(net):
+    """
+    Fold every batch norm `<name>_bn` into the convolution `<name>` that
+    precedes it (also for ModuleLists of convolutions, e.g. decode_conv),
+    and replace the batch norm with an identity. net must be in eval mode.
+    """
+    for module in list(net.modules()):
+        children = module._modules
+        for name in list(children):
+            if name + '_bn' not in children:
+                continue
+            conv, bn = children[name], children[name + '_bn']
+            if isinstance(conv, nn.ModuleList):
+                for i in range(len(conv)):
+                    conv[i] = fuse_conv_bn_eval(conv[i], bn[i], transpose=isinstance(conv[i], nn.modules.conv._ConvTransposeNd))
+                    bn[i] = nn.Identity()
+            else:
+                children[name] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.modules.conv._ConvTransposeNd))
+                children[name + '_bn'] = nn.Identity()
+    return net
+
+
+def export(cfg, weights, output):
+    """
+    Build the dense UResNet, restore weights, fuse batch norms and save it
+    as a frozen TorchScript module for cfg.IMAGE_SIZE images.
+    """
+    net = UResNet(cfg.DATA_3D,
+                  num_strides=cfg.NUM_STRIDES,
+                  base_num_outputs=cfg.BASE_NUM_OUTPUTS)
+    print('Restoring weights from %s...' % weights)
+    with open(weights, 'rb') as f:
+        checkpoint = torch.load(f, map_location='cpu')
+        net.load_state_dict(checkpoint['state_dict'])
+    print('Done.')
+    net.eval()
+    fuse_batch_norm(net)
+
+    dim = 3 if cfg.DATA_3D else 2
+    example = torch.zeros((cfg.BATCH_SIZE, 1) + (cfg.IMAGE_SIZE,) * dim)
+    with torch.no_grad():
+        # Padding sizes depend on the image size only, tracing is enough
+        traced = torch.jit.trace(net, example)
+    traced = torch.jit.freeze(traced)
+    config = dict((key, getattr(cfg, key)) for key in CONFIG_KEYS)
+    torch.jit.save(traced, output, _extra_files={CONFIG_FILE: json.dumps(config)})
+    print('Saved %s' % output)
+
+
+def load(filename, device):
+    """
+    Returns the scripted model and the configuration it was exported with.
+    """
+    extra_files = {CONFIG_FILE: ''}
+    model = torch.jit.load(filename, map_location=device, _extra_files=extra_files)
+    return model, json.loads(extra_files[CONFIG_FILE])
+
+
+def infer(cfg, filename):
+    """
+    Run the scripted model on cfg.MAX_STEPS batches of the test data and
+    report the throughput, with and without data loading.
+    """
+    device = get_device(cfg)
+    model, config = load(filename, device)
+    cfg.IMAGE_SIZE, cfg.DATA_3D = config['IMAGE_SIZE'], config['DATA_3D']
+    memory_format = get_memory_format(cfg, device, False)
+    loader = make_loader(cfg, is_training=False,
+                         batch_size=cfg.BATCH_SIZE,
+                         num_workers=cfg.DATA_WORKERS,
+                         pin_memory=device.type == 'cuda',
+                         num_events=cfg.MAX_STEPS * cfg.BATCH_SIZE)
+
+    num_events, durations, acc_nonzero = 0, [], []
+    start_all = time.time()
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            image = batch['data'].to(device, memory_format=memory_format)
+            start = time.time()
+            predictions = torch.argmax(model(image), dim=1).cpu()
+            durations.append(time.time() - start)
+            num_events += image.size(0)
+            nonzero = batch['labels'] > 0
+            if nonzero.any():
+                acc_nonzero.append((predictions[nonzero] == batch['labels'][nonzero]).float().mean().item())
+    duration_all = time.time() - start_all
+
+    # The first batch includes one-off optimizations of the graph
+    forward = np.sum(durations[1:]) if len(durations) > 1 else np.sum(durations)
+    forward_events = num_events - cfg.BATCH_SIZE if len(durations) > 1 else num_events
+    print('%d events in %f s: %f events/s' % (num_events, duration_all, num_events / duration_all))
+    print('Forward only: %f events/s' % (forward_events / forward))
+    print('Mean nonzero accuracy = %f' % np.mean(acc_nonzero))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TorchScript UResNet")
+    subparsers = parser.add_subparsers(title="Modules", description="Export or run a scripted UResNet", dest='script')
+    export_parser = subparsers.add_parser("export", help="Export a checkpoint to TorchScript.")
+    export_parser.add_argument("-w", "--weights", required=True, type=str, help="Checkpoint file (model-*.ckpt).")
+    export_parser.add_argument("-o", "--output", required=True, type=str, help="Scripted model file.")
+    export_parser.add_argument("-N", "--image-size", default=192, type=int, help="Width (and height, depth) of image.")
+    export_parser.add_argument("-3d", "--data-3d", action='store_true', help="Use 3D instead of 2D.")
+    export_parser.add_argument("-bno", "--base-num-outputs", default=16, type=int, help="Base number of filters for UResNet.")
+    export_parser.add_argument("-ns", "--num-strides", default=5, type=int, help="Number of strides (spatial depth) for UResNet.")
+    export_parser.add_argument("-bs", "--batch-size", default=1, type=int, help="Batch size of the example input used for tracing.")
+
+    infer_parser = subparsers.add_parser("infer", help="Run a scripted model and report throughput.")
+    infer_parser.add_argument("-i", "--model", required=True, type=str, help="Scripted model file.")
+    infer_parser.add_argument("-d", "--data", required=True, type=str, help="Path to data files.")
+    infer_parser.add_argument("-dt", "--data-type", default='hdf5', type=str, choices=['hdf5', 'csv'], help="Type of the data files.")
+    infer_parser.add_argument("-bs", "--batch-size", default=1, type=int, help="Batch size.")
+    infer_parser.add_argument("-m", "--max-steps", default=100, type=int, help="Number of batches.")
+    infer_parser.add_argument("-dw", "--data-workers", default=2, type=int, help="Number of DataLoader worker processes.")
+    infer_parser.add_argument("-it", "--intra-op-threads", default=0, type=int, help="Number of torch threads on CPU (0 = default).")
+    infer_parser.add_argument("-g", "--gpu", default='', type=str, help="GPU to use, CPU if empty.")
+    args = parser.parse_args()
+
+    if args.script == 'export':
+        cfg = PPNConfig(IMAGE_SIZE=args.image_size,
+                        DATA_3D=args.data_3d,
+                        BASE_NUM_OUTPUTS=args.base_num_outputs,
+                        NUM_STRIDES=args.num_strides,
+                        BATCH_SIZE=args.batch_size)
+        export(cfg, args.weights, args.output)
+    elif args.script == 'infer':
+        cfg = PPNConfig(DATA=args.data,
+                        TEST_DATA=args.data,
+                        DATA_TYPE=args.data_type,
+                        BATCH_SIZE=args.batch_size,
+                        MAX_STEPS=args.max_steps,
+                        DATA_WORKERS=args.data_workers,
+                        INTRA_OP_THREADS=args.intra_op_threads,
+                        GPU=args.gpu)
+        infer(cfg, args.model)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class Metadata(object):
+    """
+    Active sites of one batch of events at every level of the UNet, and the
+    rulebooks of the convolutions between them. Rulebooks are built the
+    first time a layer needs them and reused by all the other layers of the
+    same level during the forward pass.
+
+    Sites are identified by a linear key of (batch index, coordinates),
+    looked up with a binary search in the sorted keys of the level.
+    Duplicate input coordinates are merged into one site, whose features
+    are the sum of theirs (like sparseconvnet InputLayer mode 3).
+    """
+    def __init__(self, coords, dim, spatial_size):
+        self.dim = dim
+        coords = coords.long()
+        if coords.size(1) == dim:  # Single event, batch index 0
+            coords = torch.cat([coords, torch.zeros_like(coords[:, :1])], dim=1)
+        coords = coords[:, :dim + 1]  # Batch index as last column
+        if coords.size(0) > 0:
+            coords, self.input_sites = torch.unique(coords, dim=0, return_inverse=True)
+        else:
+            self.input_sites = torch.zeros_like(coords[:, 0])
+        self.coords = [coords[:, :dim].contiguous()]
+        self.batch = [coords[:, dim].contiguous()]
+        self.spatial_size = [spatial_size]
+        self.keys = [None]
+        self.submanifold = {}
+        self.downsample = {}
+        self.offsets = torch.tensor(list(itertools.product([-1, 0, 1], repeat=dim)),
+                                    dtype=torch.long, device=coords.device)
+
+    def key(self, level, coords):
+        # Coordinates are shifted by 1 so that neighbours outside of the
+        # image (-1 or spatial_size) get a key of their own.
+        size = self.spatial_size[level] + 2
+        key = self.batch[level]
+        for d in range(self.dim):
+            key = key * size + coords[..., d] + 1
+        return key
+
+    def sorted_keys(self, level):
+        if self.keys[level] is None:
+            self.keys[level] = torch.sort(self.key(level, self.coords[level]))
+        return self.keys[level]
+
+    def get_submanifold_rules(self, level):
+        """
+        List of (input sites, output sites) per kernel offset, None for the
+        center offset (every site is its own input). Empty if the level has
+        no active site.
+        """
+        if level not in self.submanifold:
+            sorted_keys, order = self.sorted_keys(level)
+            n = sorted_keys.size(0)
+            rules = []
+            for offset in self.offsets:
+                if n == 0:  # Empty event, nothing to convolve
+                    break
+                if not offset.any():
+                    rules.append(None)
+                    continue
+                query = self.key(level, self.coords[level] + offset)
+                position = torch.searchsorted(sorted_keys, query).clamp_(max=n - 1)
+                found = sorted_keys[position] == query
+                rules.append((order[position[found]], found.nonzero().view(-1)))
+            self.submanifold[level] = rules
+        return self.submanifold[level]
+
+    def get_downsample_rules(self, level):
+        """
+        Active sites of level + 1 are the 2x2(x2) blocks containing at least
+        one site of level. Returns, for each site of level, the index of its
+        block and its position in the block (kernel index).
+        """
+        if level not in self.downsample:
+            coords = self.coords[level]
+            kernel = torch.zeros_like(coords[:, 0])
+            for d in range(self.dim):
+                kernel = kernel * 2 + coords[:, d] % 2
+            coarse = torch.cat([coords // 2, self.batch[level][:, None]], dim=1)
+            if coarse.size(0) > 0:
+                coarse, inverse = torch.unique(coarse, dim=0, return_inverse=True)
+            else:
+                inverse = kernel
+            self.coords.append(coarse[:, :self.dim].contiguous())
+            self.batch.append(coarse[:, self.dim].contiguous())
+            self.spatial_size.append(int(math.ceil(self.spatial_size[level] / 2.0)))
+            self.keys.append(None)
+            self.downsample[level] = (inverse, kernel)
+        return self.downsample[level]
+
+    def num_sites(self, level):
+        return self.coords[level].size(0)
+
+    def input_features(self, features):
+        """
+        Features of the input coordinates summed per site of level 0.
+        """
+        output = features.new_zeros((self.num_sites(0), features.size(1)))
+        return output.index_add_(0, self.input_sites, features)
+
+    def output_features(self, features):
+        """
+        Features of the sites of level 0 for each input coordinate.
+        """
+        return features[self.input_sites]
+
+
+def init_weight(weight):
+    std = math.sqrt(2.0 / (weight.size(0) * weight.size(1)))
+    weight.data.normal_(0, std)
+
+
+class SubmanifoldConvolution(nn.Module):
+    """
+    Convolution computed only at active sites, from the active sites of
+    their neighbourhood: gather -> matmul -> scatter-add per kernel offset.
+    """
+    def __init__(self, dim, num_inputs, num_outputs, filter_size=3, bias=False):
+        super(SubmanifoldConvolution, self).__init__()
+        assert filter_size == 3
+        self.weight = nn.Parameter(torch.empty(filter_size ** dim, num_inputs, num_outputs))
+        init_weight(self.weight)
+        self.bias = nn.Parameter(torch.zeros(num_outputs)) if bias else None
+
+    def forward(self, features, metadata, level):
+        rules = metadata.get_submanifold_rules(level)
+        output = features.new_zeros((features.size(0), self.weight.size(2)))
+        for k, rule in enumerate(rules):
+            if rule is None:
+                output += torch.mm(features, self.weight[k])
+            else:
+                input_sites, output_sites = rule
+                output.index_add_(0, output_sites, torch.mm(features[input_sites], self.weight[k]))
+        if self.bias is not None:
+            output += self.bias
+        return output
+
+
+class Convolution(nn.Module):
+    """
+    Filter size 2, stride 2 convolution to the next level.
+    """
+    def __init__(self, dim, num_inputs, num_outputs):
+        super(Convolution, self).__init__()
+        self.weight = nn.Parameter(torch.empty(2 ** dim, num_inputs, num_outputs))
+        init_weight(self.weight)
+
+    def forward(self, features, metadata, level):
+        inverse, kernel = metadata.get_downsample_rules(level)
+        output = features.new_zeros((metadata.num_sites(level + 1), self.weight.size(2)))
+        for k in range(self.weight.size(0)):
+            sites = (kernel == k).nonzero().view(-1)
+            output.index_add_(0, inverse[sites], torch.mm(features[sites], self.weight[k]))
+        return output
+
+
+class Deconvolution(nn.Module):
+    """
+    Filter size 2, stride 2 transposed convolution from the next level,
+    back to the active sites of level.
+    """
+    def __init__(self, dim, num_inputs, num_outputs):
+        super(Deconvolution, self).__init__()
+        self.weight = nn.Parameter(torch.empty(2 ** dim, num_inputs, num_outputs))
+        init_weight(self.weight)
+
+    def forward(self, features, metadata, level):
+        inverse, kernel = metadata.get_downsample_rules(level)
+        output = features.new_empty((inverse.size(0), self.weight.size(2)))
+        for k in range(self.weight.size(0)):
+            sites = (kernel == k).nonzero().view(-1)
+            output[sites] = torch.mm(features[inverse[sites]], self.weight[k])
+        return output
+
+
+class BatchNormReLU(nn.BatchNorm1d):
+    def __init__(self, num_features, leakiness=0.0):
+        super(BatchNormReLU, self).__init__(num_features, eps=1e-4, momentum=0.1)
+        self.leakiness = leakiness
+
+    def forward(self, features):
+        return F.leaky_relu(super(BatchNormReLU, self).forward(features), self.leakiness)
+
+
+class UNet(nn.Module):
+    """
+    Same layout as sparseconvnet.UNet without residual blocks: reps
+    (BatchNormLeakyReLU, SubmanifoldConvolution) per level, with the
+    output of the deeper levels concatenated to the features of the
+    current one.
+    """
+    def __init__(self, dim, reps, num_planes, leakiness=0.333):
+        super(UNet, self).__init__()
+        self.num_planes = num_planes
+        self.encode = self.block(dim, reps, num_planes[0], num_planes[0], leakiness)
+        if len(num_planes) > 1:
+            self.down_bn = BatchNormReLU(num_planes[0], leakiness)
+            self.down = Convolution(dim, num_planes[0], num_planes[1])
+            self.inner = UNet(dim, reps, num_planes[1:], leakiness)
+            self.up_bn = BatchNormReLU(num_planes[1], leakiness)
+            self.up = Deconvolution(dim, num_planes[1], num_planes[0])
+            self.decode = self.block(dim, reps, 2 * num_planes[0], num_planes[0], leakiness)
+
+    @staticmethod
+    def block(dim, reps, num_inputs, num_outputs, leakiness):
+        layers = nn.ModuleList()
+        for i in range(reps):
+            layers.append(BatchNormReLU(num_inputs if i == 0 else num_outputs, leakiness))
+            layers.append(SubmanifoldConvolution(dim, num_inputs if i == 0 else num_outputs, num_outputs, 3, False))
+        return layers
+
+    @staticmethod
+    def run_block(layers, features, metadata, level):
+        for bn, conv in zip(layers[::2], layers[1::2]):
+            features = conv(bn(features), metadata, level)
+        return features
+
+    def forward(self, features, metadata, level=0):
+        features = self.run_block(self.encode, features, metadata, level)
+        if len(self.num_planes) > 1:
+            inner = self.down(self.down_bn(features), metadata, level)
+            inner = self.inner(inner, metadata, level + 1)
+            inner = self.up(self.up_bn(inner), metadata, level)
+            features = torch.cat([features, inner], dim=1)
+            features = self.run_block(self.decode, features, metadata, level)
+        return features
+
+
+class UResNet(nn.Module):
+    """
+    Sparse UResNet in plain PyTorch, drop-in replacement for
+    uresnet_pytorch.sparse_uresnet.UResNet (same constructor and
+    forward(coords, features)) which does not need sparseconvnet.
+    Compute and memory scale with the number of active voxels.
+    """
+    def __init__(self, is_3d, num_strides=3, base_num_outputs=16, num_classes=3, spatialSize=192):
+        nn.Module.__init__(self)
+        self.dimension = 3 if is_3d else 2
+        self.spatial_size = spatialSize
+        reps = 2  # Conv block repetition factor
+        m = base_num_outputs  # Unet number of features
+        nPlanes = [i*m for i in range(1, num_strides+1)]  # UNet number of features per level
+        nInputFeatures = 1
+        self.input_conv = SubmanifoldConvolution(self.dimension, nInputFeatures, m, 3, False)
+        self.unet = UNet(self.dimension, reps, nPlanes)
+        self.bn = BatchNormReLU(m)
+        self.linear = nn.Linear(m, num_classes)
+
+    def forward(self, coords, features):
+        """
+        coords: (N_voxels, dim) or (N_voxels, dim + 1) with the batch index
+        as last column. features: (N_voxels, 1).
+        Returns N_voxels x num_classes scores, in the order of coords (the
+        features of duplicate coordinates are summed, they get the same
+        scores).
+        """
+        metadata = Metadata(coords, self.dimension, self.spatial_size)
+        x = self.input_conv(metadata.input_features(features), metadata, 0)
+        x = self.unet(x, metadata)
+        x = self.bn(x)
+        x = self.linear(x)
+        return metadata.output_features(x)
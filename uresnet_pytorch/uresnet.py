@@ -4,9 +4,8 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 
-from faster_particles.demo_ppn import get_data
 from faster_particles.config import PPNConfig
-from faster_particles.display_utils import display_uresnet, extract_voxels
+from faster_particles.display_utils import display_uresnet
 
 import numpy as np
 import os
@@ -14,41 +13,117 @@ import time
 import glob
 import re
 
-# Normal UResNet and sparse version
+# Normal UResNet, sparse versions are imported by get_sparse_uresnet
 from uresnet_pytorch.base_uresnet import UResNet
-from uresnet_pytorch.sparse_uresnet import UResNet as UResNetSparse
-
-# Accelerate *if all input sizes are same*
-torch.backends.cudnn.benchmark = True
-
-# def dataloader(i):
-#     print("loading data ", i)
-#     i = i % num_img
-#     data = f.root.data[i].reshape((batch_size, 1, N, N, N))
-#     label = f.root.label[i].astype(int).reshape((batch_size, N, N, N))
-#     return torch.from_numpy(data).cuda(), torch.from_numpy(label).cuda()
-
-
-def train_demo(cfg, net, criterion, optimizer, lr_scheduler):
-    # Data generator
-    train_data, test_data = get_data(cfg)
-    if is_training:
-        data = train_data
+from uresnet_pytorch.dataset import make_loader
+
+
+def get_sparse_uresnet(cfg):
+    """
+    Sparse UResNet class for cfg.SPARSE_BACKEND: 'scn' (sparseconvnet
+    extension) or 'torch' (plain PyTorch, no compiled dependency).
+    """
+    if cfg.SPARSE_BACKEND == 'scn':
+        from uresnet_pytorch.sparse_uresnet import UResNet as UResNetSparse
+    elif cfg.SPARSE_BACKEND == 'torch':
+        from uresnet_pytorch.torch_sparse_uresnet import UResNet as UResNetSparse
     else:
-        data = test_data
+        raise Exception("Unknown sparse backend %s" % cfg.SPARSE_BACKEND)
+    return UResNetSparse
+
+
+def get_device(cfg):
+    """
+    GPU cfg.GPU if there is one, otherwise CPU with cfg.INTRA_OP_THREADS
+    threads (torch default if 0).
+    """
+    if cfg.GPU != '':
+        os.environ['CUDA_VISIBLE_DEVICES'] = cfg.GPU
+    if cfg.GPU != '' and torch.cuda.is_available():
+        # Accelerate *if all input sizes are same*
+        torch.backends.cudnn.benchmark = True
+        return torch.device('cuda')
+    if cfg.INTRA_OP_THREADS > 0:
+        torch.set_num_threads(cfg.INTRA_OP_THREADS)
+    return torch.device('cpu')
+
+
+def get_memory_format(cfg, device, sparse):
+    """
+    Channels-last layout for the dense network on CPU, where oneDNN
+    convolutions avoid reordering their inputs.
+    """
+    if sparse or device.type != 'cpu':
+        return torch.contiguous_format
+    return torch.channels_last_3d if cfg.DATA_3D else torch.channels_last
+
+
+def get_loader(cfg, is_training, sparse, device, num_events, keep_dense=False):
+    return make_loader(cfg, is_training=is_training, sparse=sparse,
+                       batch_size=cfg.BATCH_SIZE,
+                       num_workers=cfg.DATA_WORKERS,
+                       pin_memory=device.type == 'cuda',
+                       num_events=num_events * cfg.BATCH_SIZE,
+                       keep_dense=keep_dense)
+
+
+def to_device(batch, sparse, device, memory_format):
+    """
+    Returns network inputs and labels of a collated batch on device.
+    """
+    non_blocking = device.type == 'cuda'
+    labels = batch['labels'].to(device, non_blocking=non_blocking)
+    if sparse:
+        coords = batch['voxels'].to(device, non_blocking=non_blocking)
+        features = batch['voxels_value'].to(device, non_blocking=non_blocking)
+        return (coords, features), labels
+    image = batch['data'].to(device, non_blocking=non_blocking,
+                             memory_format=memory_format)
+    return (image,), labels
+
+
+def to_blob(batch, sparse, predicted_labels):
+    """
+    Dense blob and predictions of the first event of a batch, for display.
+    """
+    data = batch['data'][:1].numpy()
+    blob = {'data': np.moveaxis(data, 1, -1), 'entries': [0]}
+    predictions = predicted_labels.cpu().data.numpy()
+    if sparse:
+        label_voxels = batch['label_voxels'].numpy()
+        first = label_voxels[:, -1] == 0
+        indices = tuple(label_voxels[first, :-1].T)
+        blob['labels'] = np.zeros(data.shape[:1] + data.shape[2:], dtype=np.int64)
+        blob['labels'][(0,) + indices] = batch['labels'].numpy()[first]
+        final_predictions = np.zeros_like(blob['labels'])
+        final_predictions[(0,) + indices] = predictions[first]
+        return blob, final_predictions
+    blob['labels'] = batch['labels'][:1].numpy()
+    return blob, predictions[:1]
+
+
+def train_demo(cfg, net, criterion, optimizer, lr_scheduler,
+               is_training=True, sparse=False, device=None):
+    if device is None:
+        device = get_device(cfg)
+    memory_format = get_memory_format(cfg, device, sparse)
+    # Data loader, events are read by cfg.DATA_WORKERS processes
+    loader = get_loader(cfg, is_training, sparse, device, cfg.MAX_STEPS,
+                        keep_dense=not is_training)
 
     # Initialize the network the right way
     # net.train and net.eval account for differences in dropout/batch norm
     # during training and testing
     start = 0
+    net.to(device, memory_format=memory_format)
     if is_training:
-        net.train().cuda()
+        net.train()
     else:
-        net.eval().cuda()
+        net.eval()
     if cfg.WEIGHTS_FILE_BASE is not None and cfg.WEIGHTS_FILE_BASE != '':
         print('Restoring weights from %s...' % cfg.WEIGHTS_FILE_BASE)
         with open(cfg.WEIGHTS_FILE_BASE, 'rb') as f:
-            checkpoint = torch.load(f)
+            checkpoint = torch.load(f, map_location=device)
             net.load_state_dict(checkpoint['state_dict'])
             # print(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
@@ -58,10 +133,8 @@ def train_demo(cfg, net, criterion, optimizer, lr_scheduler):
     print('Done.')
 
     metrics = {'acc_all': [], 'acc_nonzero': [], 'loss': []}
-    # Only enable gradients if we are training
-    # with torch.set_grad_enabled(is_training):
     durations = []
-    for i in range(cfg.MAX_STEPS):  # use with torch.no_grad() for test network
+    for i, batch in enumerate(loader):
         # Check parameters for nan
         # print('Check for nan...')
         # had_nan = False
@@ -81,30 +154,13 @@ def train_demo(cfg, net, criterion, optimizer, lr_scheduler):
         #     break
         # print('Done.')
 
-        # inputs, label = dataloader(i)
         print("Step %d/%d" % (i, cfg.MAX_STEPS))
-        blob = data.forward()
-        print(blob['voxels'].shape, blob['voxels_value'].shape, blob['data'].shape, blob['labels'].shape)
-        if sparse:
-            coords = torch.from_numpy(blob['voxels']).cuda()
-            features = torch.from_numpy(np.reshape(blob['voxels_value'], (-1, 1))).cuda()
-            # print(coords.type(), features.type())
-            start = time.time()
-            predictions_raw = net(coords, features)  # size N_voxels x num_classes
-            end = time.time()
-            durations.append(end-start)
-            # print(predictions_raw.size())
-            label_voxels, labels = extract_voxels(blob['labels'])
-            labels = torch.from_numpy(labels).cuda().type(torch.cuda.LongTensor)
-            # print(labels, label_voxels, blob['voxels'])
-            # print(net.parameters())
-        else:
-            image = torch.from_numpy(np.moveaxis(blob['data'], -1, 1)).cuda()
-            labels = torch.from_numpy(blob['labels']).cuda().type(torch.cuda.LongTensor)
-            start = time.time()
-            predictions_raw = net(image)
-            end = time.time()
-            durations.append(end-start)
+        inputs, labels = to_device(batch, sparse, device, memory_format)
+        start = time.time()
+        with torch.set_grad_enabled(is_training):
+            predictions_raw = net(*inputs)  # size N_voxels x num_classes if sparse
+        end = time.time()
+        durations.append(end-start)
 
         loss = criterion(predictions_raw, labels)
         if is_training:
@@ -144,28 +200,23 @@ def train_demo(cfg, net, criterion, optimizer, lr_scheduler):
 
         if not is_training:
             print('Display...')
-            if sparse:
-                final_predictions = np.zeros((1, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE, cfg.IMAGE_SIZE))
-                indices = label_voxels.T
-                final_predictions[0, indices[0], indices[1], indices[2]] = predicted_labels.cpu().data.numpy()
-                display_uresnet(blob, cfg,
-                                index=i,
-                                predictions=final_predictions)
-            else:
-                display_uresnet(blob, cfg,
-                                index=i,
-                                predictions=predicted_labels.cpu().data.numpy())
+            blob, final_predictions = to_blob(batch, sparse, predicted_labels)
+            display_uresnet(blob, cfg,
+                            index=i,
+                            predictions=final_predictions)
             print('Done.')
     print("Average duration = %f s" % np.array(durations).mean())
 
 
-def test(cfg, net):
-    _, data = get_data(cfg)
+def test(cfg, net, criterion, sparse=False, device=None):
+    if device is None:
+        device = get_device(cfg)
+    memory_format = get_memory_format(cfg, device, sparse)
 
     # Initialize the network the right way
     # net.train and net.eval account for differences in dropout/batch norm
     # during training and testing
-    net.eval().cuda()
+    net.to(device, memory_format=memory_format).eval()
     metrics = {'acc_all': [], 'acc_nonzero': [], 'loss': []}
     metrics_mean = {'acc_all': [], 'acc_nonzero': [], 'loss': []}
     metrics_std = {'acc_all': [], 'acc_nonzero': [], 'loss': []}
@@ -180,15 +231,9 @@ def test(cfg, net):
     weights.sort()
     print('Done.')
 
-    blobs = []
+    # Batches are read once and reused for every checkpoint
     print('Fetch data...')
-    for i in range(cfg.MAX_STEPS):
-        print("%d/%d" % (i, cfg.MAX_STEPS))
-        blob = data.forward()
-        blob.pop('data')
-        blob['label_voxels'], blob['label_values'] = extract_voxels(blob['labels'])
-        blob.pop('labels')
-        blobs.append(blob)
+    batches = list(get_loader(cfg, False, sparse, device, cfg.MAX_STEPS))
     print('Done.')
 
     for w in weights:
@@ -196,36 +241,22 @@ def test(cfg, net):
         steps.append(step)
         print('Restoring weights from %s...' % w)
         with open(w, 'rb') as f:
-            checkpoint = torch.load(f)
+            checkpoint = torch.load(f, map_location=device)
             net.load_state_dict(checkpoint['state_dict'])
         print('Done.')
-        for i, blob in enumerate(blobs):  # FIXME
+        for i, batch in enumerate(batches):
             print("Step %d/%d" % (i, cfg.MAX_STEPS))
-            if sparse:
-                start = time.time()
-                coords = torch.from_numpy(blob['voxels']).cuda()
-                features = torch.from_numpy(np.reshape(blob['voxels_value'], (-1, 1))).cuda()
-                label_voxels, labels = blob['label_voxels'], blob['label_values']
-                labels = torch.from_numpy(labels).cuda().type(torch.cuda.LongTensor)
-                end = time.time()
-                durations_cuda.append(end-start)
-
-                start = time.time()
-                predictions_raw = net(coords, features)  # size N_voxels x num_classes
-                end = time.time()
-                durations.append(end-start)
-
-            else:
-                start = time.time()
-                image = torch.from_numpy(np.moveaxis(blob['data'], -1, 1)).cuda()
-                labels = torch.from_numpy(blob['labels']).cuda().type(torch.cuda.LongTensor)
-                end = time.time()
-                durations_cuda.append(end - start)
-
-                start = time.time()
-                predictions_raw = net(image)
-                end = time.time()
-                durations.append(end-start)
+            # Host to device copy ('cuda' duration, also measured on CPU)
+            start = time.time()
+            inputs, labels = to_device(batch, sparse, device, memory_format)
+            end = time.time()
+            durations_cuda.append(end - start)
+
+            start = time.time()
+            with torch.no_grad():
+                predictions_raw = net(*inputs)
+            end = time.time()
+            durations.append(end-start)
 
             start = time.time()
             loss = criterion(predictions_raw, labels)
@@ -292,6 +323,7 @@ if __name__ == '__main__':
         'MAX_STEPS': 100,
         'DATA_3D': True,
         'SPARSE': True,
+        'SPARSE_BACKEND': 'scn',  # or 'torch' without sparseconvnet
         'DATA': "/data/dlprod_ppn_v08_p02_filtered/train_p02.root",
         'TEST_DATA': "/data/dlprod_ppn_v08_p02_filtered/test_p02.root",
         'WEIGHTS_FILE_BASE': '/data/sparse7',
@@ -300,6 +332,8 @@ if __name__ == '__main__':
         'GPU': '3',
         'NUM_STRIDES': 5,
         'BASE_NUM_OUTPUTS': 16,
+        'DATA_WORKERS': 4,  # DataLoader worker processes
+        'INTRA_OP_THREADS': 0,  # Torch threads when running on CPU, 0 = default
     }
     cfg = PPNConfig(**cfgargs)
     torch.manual_seed(cfg.SEED)
@@ -313,15 +347,17 @@ if __name__ == '__main__':
 
     is_training = False
     sparse = cfg.SPARSE
+    device = get_device(cfg)
 
-    # Instantiate and move to GPU the network
+    # Instantiate the network, moved to device by train_demo/test
     print('Building network...')
     if sparse:
-        net = UResNetSparse(True,
+        net = get_sparse_uresnet(cfg)(cfg.DATA_3D,
                       num_strides=cfg.NUM_STRIDES,
-                      base_num_outputs=cfg.BASE_NUM_OUTPUTS)
+                      base_num_outputs=cfg.BASE_NUM_OUTPUTS,
+                      spatialSize=cfg.IMAGE_SIZE)
     else:
-        net = UResNet(True,
+        net = UResNet(cfg.DATA_3D,
                       num_strides=cfg.NUM_STRIDES,
                       base_num_outputs=cfg.BASE_NUM_OUTPUTS)
     # print(net)
@@ -332,5 +368,6 @@ if __name__ == '__main__':
     logsoftmax = nn.LogSoftmax(dim=1)
     lr_scheduler = optim.lr_scheduler.StepLR(optimizer, 1000, gamma=0.1)
 
-    # train_demo(cfg, net, criterion, optimizer, lr_scheduler)
-    test(cfg, net)
+    # train_demo(cfg, net, criterion, optimizer, lr_scheduler,
+    #            is_training=is_training, sparse=sparse, device=device)
+    test(cfg, net, criterion, sparse=sparse, device=device)